@@ -0,0 +1,276 @@
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from exceptions import AgentError
+from factcache import VOLATILE_FACTS
+
+
+DEFAULT_SOCKET = str(Path.home() / ".network_triage" / "agent.sock")
+
+# Seconds a session may sit unused before it is closed
+IDLE_TIMEOUT = 900
+
+# Seconds between health checks of idle sessions
+CHECK_INTERVAL = 60
+
+
+def _connected(dev):
+  return bool(dev.connected and getattr(dev._conn, 'connected', False))
+
+
+def _healthy(dev):
+  from jnpr.junos.exception import RpcError
+
+  if not _connected(dev):
+    return False
+  try:
+    dev.rpc.get_system_uptime_information()
+  except RpcError:
+    # An error reply still means the session works
+    return True
+  except Exception:
+    return False
+  return True
+
+
+def _close(dev):
+  try:
+    dev.close()
+  except Exception:
+    pass
+
+
+class _Session(object):
+  __slots__ = ('key', 'device', 'lock', 'last_used', 'closed')
+
+  def __init__(self, key):
+    self.key = key
+    self.device = None
+    self.lock = threading.Lock()
+    self.last_used = time.monotonic()
+    self.closed = False
+
+
+class SessionPool(object):
+  """
+  Open devices kept between triage runs, one per host and login. A session is
+  used by one run at a time, checked with a cheap RPC while idle, reopened when
+  it stops answering and closed once it has been idle for idle_timeout seconds
+  """
+
+  def __init__(self, factory, idle_timeout=IDLE_TIMEOUT, check_interval=CHECK_INTERVAL):
+    self._factory = factory
+    self.idle_timeout = idle_timeout
+    self.check_interval = check_interval
+    self._sessions = {}
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._checker = threading.Thread(target=self._check_loop, name="session-checker", daemon=True)
+
+  def __len__(self):
+    with self._lock:
+      return sum(1 for session in self._sessions.values() if session.device is not None)
+
+  def start(self):
+    self._checker.start()
+    return self
+
+  def _acquire(self, key):
+    while True:
+      with self._lock:
+        session = self._sessions.get(key)
+        if session is None:
+          session = self._sessions[key] = _Session(key)
+      session.lock.acquire()
+      if not session.closed:
+        return session
+      # Evicted while we waited for it
+      session.lock.release()
+
+  @contextmanager
+  def lease(self, host, port=None, user=None, passwd=None, ssh_config=None, **kvargs):
+    """
+    Context manager handing out an open device for host, taking the same
+    arguments as Device. The device stays open afterwards for the next run,
+    unless an RPC timed out on it
+    """
+    from jnpr.junos.exception import RpcTimeoutError
+
+    # The password is part of the key so a session is never handed to a run
+    # that couldn't have logged in itself
+    login = hashlib.sha256(f"{user}\0{passwd}".encode()).hexdigest()
+    session = self._acquire((host, port, login, ssh_config))
+    try:
+      dev = session.device
+      if dev is not None and not _connected(dev):
+        _close(dev)
+        dev = session.device = None
+      if dev is None:
+        dev = self._factory(host=host, port=port, user=user, passwd=passwd, ssh_config=ssh_config, **kvargs)
+        dev.open()
+        session.device = dev
+      elif not isinstance(dev.facts, dict):
+        dev.facts_refresh(keys=VOLATILE_FACTS)
+      try:
+        yield dev
+      except RpcTimeoutError:
+        # The device may still be working on it, which would hold up the next
+        # run's RPCs behind it
+        _close(dev)
+        session.device = None
+        raise
+      finally:
+        if session.device is not None and not _connected(dev):
+          _close(dev)
+          session.device = None
+    finally:
+      session.last_used = time.monotonic()
+      session.lock.release()
+
+  def _evict(self, session):
+    if session.device is not None:
+      _close(session.device)
+      session.device = None
+    session.closed = True
+    with self._lock:
+      if self._sessions.get(session.key) is session:
+        del self._sessions[session.key]
+
+  def check(self):
+    """Close sessions idle for too long and reconnect the ones that stopped answering"""
+    now = time.monotonic()
+    with self._lock:
+      sessions = list(self._sessions.values())
+    for session in sessions:
+      # Sessions in use are checked next time
+      if not session.lock.acquire(blocking=False):
+        continue
+      try:
+        if session.closed:
+          continue
+        if session.device is None or now - session.last_used >= self.idle_timeout:
+          self._evict(session)
+        elif not _healthy(session.device):
+          _close(session.device)
+          try:
+            session.device.open()
+          except Exception:
+            self._evict(session)
+      finally:
+        session.lock.release()
+
+  def _check_loop(self):
+    while not self._stopped.wait(self.check_interval):
+      self.check()
+
+  def close(self):
+    self._stopped.set()
+    with self._lock:
+      sessions = list(self._sessions.values())
+    for session in sessions:
+      with session.lock:
+        self._evict(session)
+
+
+class FileCache(object):
+  """Values loaded from files, loaded again once the file changes"""
+
+  def __init__(self):
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def load(self, loader, path):
+    mtime = os.stat(path).st_mtime_ns
+    with self._lock:
+      cached = self._values.get((loader, path))
+    if cached is not None and cached[0] == mtime:
+      return cached[1]
+    value = loader(path)
+    with self._lock:
+      self._values[(loader, path)] = (mtime, value)
+    return value
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    for line in self.rfile:
+      try:
+        request = json.loads(line)
+        handler = self.server.handlers.get(request.get('op'))
+        if handler is None:
+          reply = {'error': f"unknown request {request.get('op')!r}"}
+        else:
+          reply = handler(request)
+      except Exception as err:
+        reply = {'error': f"{err.__class__.__name__}: {err}"}
+      self.wfile.write(json.dumps(reply).encode() + b"\n")
+      self.wfile.flush()
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  """
+  Line delimited JSON over a unix socket only the current user can open.
+  handlers maps each request's 'op' to a function returning the reply
+  """
+
+  daemon_threads = True
+
+  def __init__(self, path, handlers):
+    self.path = path
+    self.handlers = handlers
+    if Path(path).exists():
+      try:
+        AgentClient(path).call('ping')
+      except AgentError:
+        # Left behind by an agent that didn't shut down cleanly
+        Path(path).unlink()
+      else:
+        raise AgentError(f"already running on {path}")
+    Path(path).parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    umask = os.umask(0o177)
+    try:
+      super().__init__(path, _RequestHandler)
+    finally:
+      os.umask(umask)
+
+  def server_close(self):
+    super().server_close()
+    try:
+      Path(self.path).unlink()
+    except FileNotFoundError:
+      pass
+
+
+class AgentClient(object):
+  """Sends requests to an AgentServer, one connection per request so threads can share it"""
+
+  def __init__(self, path=DEFAULT_SOCKET):
+    self.path = path
+
+  def call(self, op, **request):
+    try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(self.path)
+        sock.sendall(json.dumps(dict(request, op=op)).encode() + b"\n")
+        with sock.makefile("rb") as f:
+          line = f.readline()
+    except OSError as err:
+      raise AgentError(f"can't reach {self.path}: {err}")
+    if not line:
+      raise AgentError("closed the connection without replying")
+    reply = json.loads(line)
+    if 'error' in reply:
+      raise AgentError(reply['error'])
+    return reply
+
+  def triage(self, **request):
+    """Run operations against one host through the agent's sessions. Returns (status, output, records)"""
+    reply = self.call('triage', **request)
+    return reply['status'], reply['output'], reply.get('records', [])
@@ -0,0 +1,190 @@
+"""
+Fleet-scale throughput benchmark for the triage operations.
+
+Synthetic replies sized from benchmarks.synthetic.PROFILES are written as replay
+fixtures, then each operation is run against --hosts replayed devices and the
+results are emitted as JSON so runs from different releases can be compared:
+
+    python -m benchmarks.bench_triage --profile mx480 --hosts 500 --workers 16 -o mx480.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from pathlib import Path
+
+import network_triage
+from benchmarks.synthetic import PROFILES, write_fixtures
+from history import CounterHistory
+from logrules import load_log_rules
+from replay import ReplayDevice
+from rpcplan import planned_device
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+OPERATIONS = ["ints", "bgp", "ospf", "logs", "info", "pem", "alarms"]
+
+
+class TimedReplayDevice(ReplayDevice):
+  """
+  ReplayDevice that adds up the time spent parsing replies and their size.
+  Streamed replies are parsed as they're checked, so their parse time is only
+  part of the latency
+  """
+
+  def __init__(self, *vargs, **kvargs):
+    super().__init__(*vargs, **kvargs)
+    # Every host replays the same fixtures. Under its own hostname, each one
+    # keeps its own rows in the counter history and the other stores
+    if isinstance(self.facts, dict):
+      self.facts = dict(self.facts, hostname=self._hostname)
+    self.parse_seconds = 0.0
+    self.reply_bytes = 0
+
+  def _load_reply(self, path):
+    start = time.perf_counter()
+    try:
+      return super()._load_reply(path)
+    finally:
+      self.parse_seconds += time.perf_counter() - start
+      self.reply_bytes += path.stat().st_size
+
+  def _stream_reply(self, path):
+    reply = super()._stream_reply(path)
+    self.reply_bytes += reply.size
+    return reply
+
+
+def _peak_rss_mb():
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is bytes on macOS and kilobytes elsewhere
+  return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _percentile(values, pct):
+  ordered = sorted(values)
+  idx = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+  return ordered[idx]
+
+
+def _run_operation(dev, operation, context):
+  if operation == 'ints':
+    network_triage.ints(dev, thresholds=context['thresholds'], history=context['history'])
+  elif operation == 'logs':
+    network_triage.logs(dev, rules=context['rules'])
+  else:
+    getattr(network_triage, operation)(dev)
+
+
+def _context(workdir):
+  return {
+    'thresholds': network_triage._load_thresholds(str(ROOT / "thresholds.json")),
+    'history': CounterHistory(str(Path(workdir) / "history.db")),
+    'rules': load_log_rules(str(ROOT / "log_rules.json")),
+  }
+
+
+def bench_operation(replay_dir, workdir, operation, hosts, workers, latency):
+  """Run one operation against every host. Runs in its own process so peak RSS is per operation"""
+  os.chdir(workdir)
+  context = _context(workdir)
+  network_triage._prime_text_tables()
+  rss_before = _peak_rss_mb()
+
+  def triage(idx):
+    with planned_device(TimedReplayDevice)(host=f"bench{idx:05}", replay_dir=replay_dir, latency=latency) as dev:
+      start = time.perf_counter()
+      _run_operation(dev, operation, context)
+      return time.perf_counter() - start, dev.parse_seconds, dev.reply_bytes
+
+  with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(triage, range(hosts)))
+    wall = time.perf_counter() - start
+
+  latencies = [r[0] * 1000 for r in results]
+  parse = [r[1] for r in results]
+  return {
+    'devices_per_sec': round(hosts / wall, 3),
+    'wall_seconds': round(wall, 4),
+    'latency_ms': {
+      'mean': round(statistics.mean(latencies), 3),
+      'p50': round(_percentile(latencies, 50), 3),
+      'p90': round(_percentile(latencies, 90), 3),
+      'p99': round(_percentile(latencies, 99), 3),
+      'max': round(max(latencies), 3),
+    },
+    'xml_parse_seconds': round(sum(parse), 4),
+    'xml_parse_ms_per_device': round(statistics.mean(parse) * 1000, 3),
+    'reply_bytes_per_device': round(statistics.mean(r[2] for r in results)),
+    'rss_before_mb': round(rss_before, 1),
+    'peak_rss_mb': round(_peak_rss_mb(), 1),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark triage operations against synthetic replayed devices')
+  parser.add_argument('--profile', choices=sorted(PROFILES), default='leaf96',
+                      help='size of the synthetic device replies')
+  parser.add_argument('--hosts', type=int, default=100, help='number of synthetic hosts to triage')
+  parser.add_argument('-w', '--workers', type=int, default=8, help='number of hosts triaged concurrently')
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every replayed RPC')
+  parser.add_argument('--oper', dest='operations', nargs='+', choices=OPERATIONS, default=OPERATIONS,
+                      help='operations to benchmark')
+  parser.add_argument('-o', '--output', help='write the JSON results to this file instead of stdout')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(prefix="triage-bench-") as workdir:
+    replay_dir = str(Path(workdir) / "fixtures")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+      context = _context(workdir)
+      with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        write_fixtures(replay_dir, args.profile, args.operations,
+                       lambda dev, operation: _run_operation(dev, operation, context))
+    finally:
+      os.chdir(cwd)
+
+    latency = {'default': args.latency} if args.latency else {}
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    for operation in args.operations:
+      with ctx.Pool(1) as pool:
+        results[operation] = pool.apply(bench_operation, (replay_dir, workdir, operation, args.hosts,
+                                                          args.workers, latency))
+
+  report = {
+    'meta': {
+      'timestamp': datetime.now(timezone.utc).isoformat(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'profile': args.profile,
+      'profile_spec': PROFILES[args.profile],
+      'hosts': args.hosts,
+      'workers': args.workers,
+      'latency_seconds': args.latency,
+    },
+    'operations': results,
+  }
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+  main()
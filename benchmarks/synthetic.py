@@ -0,0 +1,241 @@
+import json
+import random
+from pathlib import Path
+from lxml import etree
+from replay import FACTS_FILE, ReplayDevice, _fixture_name
+
+
+# Reply sizes modelled on real boxes
+PROFILES = {
+  'leaf96': {'model': 'QFX5120-48Y', 'ports': 96, 'fpcs': 1, 'bgp_peers': 8, 'ospf_neighbors': 4,
+             'log_lines': 20000},
+  'mx480': {'model': 'MX960', 'ports': 480, 'fpcs': 12, 'bgp_peers': 64, 'ospf_neighbors': 16,
+            'log_lines': 100000},
+  'rr2k': {'model': 'MX204', 'ports': 8, 'fpcs': 1, 'bgp_peers': 2000, 'ospf_neighbors': 4,
+           'log_lines': 50000},
+}
+
+LOG_LINES = [
+  "{ts} {host} mib2d[1234]: SNMP_TRAP_LINK_UP: ifIndex 512, ifAdminStatus up(1), ifOperStatus up(1), ifName {port}",
+  "{ts} {host} rpd[2345]: bgp_io_mgmt_cb: BGP_IO_ERROR_CLOSE_SESSION: read from peer 10.0.{a}.{b} failed",
+  "{ts} {host} xntpd[3456]: NTP Server 10.255.0.1 is Unreachable",
+  "{ts} {host} sshd[4567]: Accepted publickey for netops from 10.1.1.1 port 50000 ssh2",
+  "{ts} {host} chassisd[5678]: CHASSISD_SNMP_TRAP10: SNMP trap generated: FRU power on",
+]
+
+
+def _ports(profile):
+  ports = []
+  per_pic = 48 if profile['ports'] >= 48 else profile['ports']
+  for idx in range(profile['ports']):
+    fpc, rest = divmod(idx, per_pic * 2)
+    pic, port = divmod(rest, per_pic)
+    prefix = 'et' if profile['ports'] >= 480 else 'xe'
+    ports.append(f"{prefix}-{fpc}/{pic}/{port}")
+  return ports
+
+
+def _counter(rng, errors):
+  return rng.randint(0, 5000) if rng.random() < errors else 0
+
+
+def _physical_interface(name, rng):
+  errs = ''.join(f"<{tag}>{_counter(rng, 0.05)}</{tag}>" for tag in (
+    'input-errors', 'input-drops', 'framing-errors', 'input-runts', 'input-discards', 'input-l3-incompletes',
+    'input-l2-channel-errors', 'input-l2-mismatch-timeouts', 'input-fifo-errors', 'input-resource-errors'))
+  out_errs = ''.join(f"<{tag}>{_counter(rng, 0.02)}</{tag}>" for tag in (
+    'carrier-transitions', 'output-errors', 'output-collisions', 'output-drops', 'aged-packets', 'mtu-errors',
+    'hs-link-crc-errors', 'output-fifo-errors', 'output-resource-errors'))
+  mac = ''.join(f"<{tag}>{_counter(rng, 0.02)}</{tag}>" for tag in (
+    'input-mac-control-frames', 'output-mac-control-frames', 'input-mac-pause-frames', 'output-mac-pause-frames',
+    'input-oversized-frames', 'input-jabber-frames', 'input-fragment-frames', 'input-vlan-tagged-frames',
+    'input-code-violations', 'input-broadcasts', 'output-broadcasts', 'input-multicasts', 'output-multicasts'))
+  queues = ''.join(f"<queue><queue-number>{q}</queue-number><queued-packets>{rng.randint(0, 10**9)}</queued-packets>"
+                   f"<transmitted-packets>{rng.randint(0, 10**9)}</transmitted-packets>"
+                   f"<dropped-packets>{_counter(rng, 0.01)}</dropped-packets></queue>" for q in range(8))
+  return (f"<physical-interface><name>{name}</name><admin-status>up</admin-status><oper-status>up</oper-status>"
+          f"<description>link to {name}</description><mtu>9192</mtu><speed>100Gbps</speed>"
+          f"<link-level-type>Ethernet</link-level-type><link-mode>Full-duplex</link-mode>"
+          f"<current-physical-address>00:00:5e:00:53:{rng.randint(0, 255):02x}</current-physical-address>"
+          f"<if-device-flags><ifdf-present/><ifdf-running/></if-device-flags>"
+          f"<traffic-statistics><input-bytes>{rng.randint(0, 10**15)}</input-bytes>"
+          f"<input-packets>{rng.randint(0, 10**12)}</input-packets><output-bytes>{rng.randint(0, 10**15)}"
+          f"</output-bytes><output-packets>{rng.randint(0, 10**12)}</output-packets></traffic-statistics>"
+          f"<input-error-list>{errs}</input-error-list><output-error-list>{out_errs}</output-error-list>"
+          f"<queue-counters>{queues}</queue-counters>"
+          f"<ethernet-mac-statistics>{mac}</ethernet-mac-statistics>"
+          f"<ethernet-pcs-statistics><bit-error-seconds>{_counter(rng, 0.02)}</bit-error-seconds>"
+          f"<errored-blocks-seconds>{_counter(rng, 0.02)}</errored-blocks-seconds></ethernet-pcs-statistics>"
+          f"<ethernet-fec-statistics><fec_ccw_count>{_counter(rng, 0.1)}</fec_ccw_count>"
+          f"<fec_nccw_count>{_counter(rng, 0.01)}</fec_nccw_count><fec_ccw_error_rate>0</fec_ccw_error_rate>"
+          f"<fec_nccw_error_rate>0</fec_nccw_error_rate></ethernet-fec-statistics>"
+          f"<logical-interface><name>{name}.0</name><address-family><address-family-name>"
+          f"{'aenet' if rng.random() < 0.5 else 'inet'}</address-family-name><ae-bundle-name>ae{rng.randint(0, 31)}.0"
+          f"</ae-bundle-name></address-family></logical-interface></physical-interface>")
+
+
+def _optics(name, rng):
+  lanes = ''.join(f"<optics-diagnostics-lane-values><lane-index>{lane}</lane-index>"
+                  f"<laser-output-power-dbm>{rng.uniform(-3, 2):.2f}</laser-output-power-dbm>"
+                  f"<laser-rx-optical-power-dbm>{rng.uniform(-12, 2):.2f}</laser-rx-optical-power-dbm>"
+                  f"<laser-rx-power-low-alarm>{'on' if rng.random() < 0.01 else 'off'}</laser-rx-power-low-alarm>"
+                  f"<laser-rx-power-low-warn>{'on' if rng.random() < 0.02 else 'off'}</laser-rx-power-low-warn>"
+                  f"</optics-diagnostics-lane-values>" for lane in range(4))
+  return (f"<physical-interface><name>{name}</name><optics-diagnostics>"
+          f"<module-temperature>35 degrees C</module-temperature><module-voltage>3.3</module-voltage>"
+          f"<laser-rx-power-low-alarm-threshold-dbm>-13.90</laser-rx-power-low-alarm-threshold-dbm>"
+          f"<laser-rx-power-low-warn-threshold-dbm>-9.90</laser-rx-power-low-warn-threshold-dbm>"
+          f"{lanes}</optics-diagnostics></physical-interface>")
+
+
+def _bgp_peer(idx, rng, detail):
+  address = f"10.{idx // 65536 % 256}.{idx // 256 % 256}.{idx % 256}"
+  state = 'Established' if rng.random() < 0.97 else rng.choice(['Active', 'Connect', 'Idle'])
+  if not detail:
+    return (f"<bgp-peer><peer-address>{address}</peer-address><peer-as>{64512 + idx}</peer-as>"
+            f"<peer-state>{state}</peer-state><elapsed-time seconds='{rng.randint(0, 10**7)}'>1w2d</elapsed-time>"
+            f"<flap-count>{rng.randint(0, 3)}</flap-count></bgp-peer>")
+  ribs = ''.join(f"<bgp-rib><name>{table}</name><received-prefix-count>{rng.randint(0, 5000)}"
+                 f"</received-prefix-count><accepted-prefix-count>{rng.randint(0, 5000)}</accepted-prefix-count>"
+                 f"<active-prefix-count>{rng.randint(0, 5000)}</active-prefix-count></bgp-rib>"
+                 for table in ('inet.0', 'inet6.0'))
+  return (f"<bgp-peer><peer-address>{address}+179</peer-address><peer-as>{64512 + idx}</peer-as>"
+          f"<local-address>10.255.0.1+{50000 + idx % 10000}</local-address><local-as>65000</local-as>"
+          f"<peer-id>{address}</peer-id><local-id>10.255.0.1</local-id><peer-state>{state}</peer-state>"
+          f"<local-interface-name>ae{idx % 32}.0</local-interface-name>"
+          f"<bgp-option-information><export-policy>EXPORT</export-policy><import-policy>IMPORT</import-policy>"
+          f"<bgp-options>Preference LocalAddress Refresh</bgp-options><holdtime>90</holdtime>"
+          f"</bgp-option-information><flap-count>{rng.randint(0, 3)}</flap-count>{ribs}</bgp-peer>")
+
+
+def _hmc_output(rng):
+  rows = '\n'.join(f" {chip:<8} HMC{chip:<8} {chip:<9} {rng.choice(['0x009a', '0x00a1', '0x00a2'])}  0x0001"
+                   for chip in range(4))
+  return f"\n chip ID  chip name   chip num  FW_Set  Product_Rev\n{rows}\n"
+
+
+class SyntheticDevice(ReplayDevice):
+  """
+  ReplayDevice that makes up replies sized from a PROFILES entry and writes them
+  out as fixtures, so running the operations once produces a replayable fixture
+  directory
+  """
+
+  def __init__(self, *vargs, profile, replay_dir, seed=0, **kvargs):
+    self._profile = PROFILES[profile]
+    self._rng = random.Random(seed)
+    super().__init__(*vargs, replay_dir=replay_dir, **kvargs)
+    # ReplayDevice falls back to the default fixtures when the host has none yet
+    self._fixture_dir = Path(replay_dir) / self._hostname
+    self._fixture_dir.mkdir(parents=True, exist_ok=True)
+    self.facts = {
+      'hostname': self._hostname, 'model': self._profile['model'], 'version': '21.4R3-S5',
+      'serialnumber': 'SYN0001', 'switch_style': 'VLAN_L2NG', '2RE': False, 'RE0': {'up_time': '42 days'},
+    }
+    with open(self._fixture_dir / FACTS_FILE, "w") as f:
+      json.dump(self.facts, f)
+
+  def _rpc_reply(self, rpc_cmd_e, ignore_warning=False, filter_xml=None):
+    reply = etree.fromstring(f"<rpc-reply>{self._make_reply(rpc_cmd_e)}</rpc-reply>",
+                             etree.XMLParser(huge_tree=True))
+    (self._fixture_dir / f"{_fixture_name(rpc_cmd_e)}.xml").write_bytes(etree.tostring(reply))
+    return reply
+
+  def _log_file(self, remote_path):
+    dest = self._fixture_dir / "files" / remote_path.lstrip("/")
+    if dest.exists():
+      return dest
+    lines = []
+    for idx in range(self._profile['log_lines']):
+      line = self._rng.choice(LOG_LINES)
+      lines.append(line.format(ts=f"Oct 17 {idx // 3600 % 24:02}:{idx // 60 % 60:02}:{idx % 60:02}",
+                               host=self._hostname, port=f"xe-0/0/{idx % 48}", a=idx % 256, b=idx % 200))
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    dest.write_text('\n'.join(lines) + '\n')
+    return dest
+
+  def get_file(self, remote_path, local_path):
+    self._log_file(remote_path)
+    super().get_file(remote_path, local_path)
+
+  def read_file(self, remote_path, offset=0, length=None):
+    self._log_file(remote_path)
+    return super().read_file(remote_path, offset, length)
+
+  def _make_reply(self, rpc_cmd_e):
+    rng = self._rng
+    profile = self._profile
+    tag = rpc_cmd_e.tag
+    ports = _ports(profile)
+    if tag == 'get-interface-information':
+      return f"<interface-information>{''.join(_physical_interface(p, rng) for p in ports)}</interface-information>"
+    if tag == 'get-interface-optics-diagnostics-information':
+      return f"<interface-information>{''.join(_optics(p, rng) for p in ports)}</interface-information>"
+    if tag == 'get-lldp-neighbors-information':
+      neighbors = ''.join(f"<lldp-neighbor-information><lldp-local-port-id>{p}</lldp-local-port-id>"
+                          f"<lldp-remote-system-name>peer{idx}</lldp-remote-system-name>"
+                          f"<lldp-remote-port-id-subtype>Interface name</lldp-remote-port-id-subtype>"
+                          f"<lldp-remote-port-id>et-0/0/{idx % 64}</lldp-remote-port-id>"
+                          f"<lldp-remote-port-description>uplink</lldp-remote-port-description>"
+                          f"</lldp-neighbor-information>" for idx, p in enumerate(ports))
+      return f"<lldp-neighbors-information>{neighbors}</lldp-neighbors-information>"
+    if tag == 'get-bgp-neighbor-information':
+      peers = ''.join(_bgp_peer(idx, rng, True) for idx in range(profile['bgp_peers']))
+      return f"<bgp-information>{peers}</bgp-information>"
+    if tag == 'get-bgp-summary-information':
+      peers = ''.join(_bgp_peer(idx, rng, False) for idx in range(profile['bgp_peers']))
+      return f"<bgp-information><peer-count>{profile['bgp_peers']}</peer-count>{peers}</bgp-information>"
+    if tag == 'get-ospf-neighbor-information':
+      neighbors = ''.join(f"<ospf-neighbor><neighbor-address>10.1.{idx}.1</neighbor-address>"
+                          f"<interface-name>{ports[idx % len(ports)]}.0</interface-name>"
+                          f"<ospf-neighbor-state>{'Full' if rng.random() < 0.95 else 'Init'}</ospf-neighbor-state>"
+                          f"<neighbor-id>10.255.{idx}.1</neighbor-id><neighbor-up-time>1w2d</neighbor-up-time>"
+                          f"</ospf-neighbor>" for idx in range(profile['ospf_neighbors']))
+      return f"<ospf-neighbor-information>{neighbors}</ospf-neighbor-information>"
+    if tag == 'get-ospf-interface-information':
+      interfaces = ''.join(f"<ospf-interface><interface-name>{ports[idx % len(ports)]}.0</interface-name>"
+                           f"<ospf-interface-state>PtToPt</ospf-interface-state><neighbor-count>1</neighbor-count>"
+                           f"</ospf-interface>" for idx in range(profile['ospf_neighbors']))
+      return f"<ospf-interface-information>{interfaces}</ospf-interface-information>"
+    if tag == 'get-route-summary-information':
+      return ("<route-summary-information><route-table><table-name>inet.0</table-name>"
+              "<destination-count>900</destination-count><total-route-count>1000</total-route-count>"
+              "<active-route-count>900</active-route-count><protocols><protocol-name>OSPF</protocol-name>"
+              f"<protocol-route-count>{profile['ospf_neighbors'] * 10}</protocol-route-count>"
+              f"<active-route-count>{profile['ospf_neighbors'] * 10}</active-route-count></protocols>"
+              "</route-table></route-summary-information>")
+    if tag == 'get-fpc-information':
+      fpcs = ''.join(f"<fpc><slot>{slot}</slot><state>Online</state><cpu-total>10</cpu-total>"
+                     f"<memory-heap-utilization>20</memory-heap-utilization></fpc>" for slot in range(profile['fpcs']))
+      return f"<fpc-information>{fpcs}</fpc-information>"
+    if tag == 'get-chassis-inventory':
+      fpcs = ''.join(f"<chassis-module><name>FPC {slot}</name><serial-number>FPCSN{slot:04}</serial-number>"
+                     f"<part-number>750-000{slot}</part-number><description>MPC</description></chassis-module>"
+                     for slot in range(profile['fpcs']))
+      return (f"<chassis-inventory><chassis><name>Chassis</name><serial-number>SYN0001</serial-number>"
+              f"{fpcs}</chassis></chassis-inventory>")
+    if tag == 'request-pfe-execute':
+      return f"<output>{_hmc_output(rng)}</output>"
+    if tag == 'file-list':
+      path = rpc_cmd_e.findtext('path').rstrip('*')
+      size = self._log_file(path).stat().st_size
+      return (f"<directory-list><directory><directory-name>{path.rsplit('/', 1)[0]}/</directory-name>"
+              f"<file-information><file-name>{path}</file-name><file-size>{size}</file-size>"
+              f"</file-information></directory></directory-list>")
+    if tag == 'get-environment-pem-information':
+      pems = ''.join(f"<environment-component-item><name>PEM {idx}</name><state>Online</state>"
+                     f"</environment-component-item>" for idx in range(4))
+      return f"<environment-component-information>{pems}</environment-component-information>"
+    if tag in ('get-system-alarm-information', 'get-alarm-information'):
+      return ("<alarm-information><alarm-detail><alarm-class>Minor</alarm-class>"
+              "<alarm-description>Rescue configuration is not set</alarm-description></alarm-detail>"
+              "</alarm-information>")
+    return "<output/>"
+
+
+def write_fixtures(replay_dir, profile, operations, run_operation, host='default'):
+  """Run each operation once against a SyntheticDevice to fill replay_dir/<host>"""
+  with SyntheticDevice(host=host, profile=profile, replay_dir=replay_dir) as dev:
+    for operation in operations:
+      run_operation(dev, operation)
+  return Path(replay_dir) / host
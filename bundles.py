@@ -0,0 +1,190 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+from exceptions import BundleError
+from records import CRITICAL, WARNING, RecordWriter
+
+
+BUNDLE_VERSION = 1
+
+# Records a bundle starts and ends with. A bundle without the footer comes from
+# a run that didn't finish
+HEADER = 'bundle'
+FOOTER = 'bundle_end'
+
+# Host statuses that count as a failure in the merged summary
+FAILED_STATUSES = ('failed', 'auth_failed', 'timed_out')
+
+
+def parse_shard(value):
+  """Turn --shard i/N into (i, N), i counting from 1"""
+  try:
+    index, count = (int(part) for part in value.split('/'))
+  except ValueError:
+    raise ValueError(f"'{value}' isn't i/N")
+  if not 1 <= index <= count:
+    raise ValueError(f"'{value}' needs 1 <= i <= N")
+  return index, count
+
+
+def shard_of(hostname, count):
+  """
+  Shard, counting from 1, that hostname belongs to out of count. Only depends on
+  the hostname, so a host stays in its shard whatever else is in the inventory
+  and wherever the run is
+  """
+  digest = hashlib.sha1(hostname.encode()).digest()
+  return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+class BundleWriter(object):
+  """
+  Takes the records of every host like a RecordWriter and keeps them in a
+  gzipped NDJSON result bundle at path. The bundle starts with a header naming
+  the shard, the operations and every host of the shard with its groups, and
+  ends with a footer written by finish(). Records are passed on to writer, if
+  any
+  """
+
+  def __init__(self, path, shard, operations, hosts, writer=None):
+    self.writer = writer
+    self._bundle = RecordWriter(path, compress=True)
+    self._lock = threading.Lock()
+    self._records = 0
+    self._bundle.write({'record': HEADER, 'version': BUNDLE_VERSION, 'shard': list(shard),
+                        'operations': list(operations), 'hosts': hosts, 'started': round(time.time(), 3)})
+
+  def write(self, record):
+    self._bundle.write(record)
+    with self._lock:
+      self._records += 1
+    if self.writer is not None:
+      self.writer.write(record)
+
+  def flush(self):
+    self._bundle.flush()
+    if self.writer is not None:
+      self.writer.flush()
+
+  def finish(self):
+    """Mark the bundle complete, once every host is done"""
+    self._bundle.write({'record': FOOTER, 'records': self._records, 'finished': round(time.time(), 3)})
+
+  def close(self):
+    self._bundle.close()
+    if self.writer is not None:
+      self.writer.close()
+
+
+def _lines(path):
+  with open(path, 'rb') as f:
+    gzipped = f.read(2) == b"\x1f\x8b"
+  with gzip.open(path, 'rb') if gzipped else open(path, 'rb') as f:
+    for line in f:
+      if line.strip():
+        yield json.loads(line)
+
+
+def read_bundle_header(path):
+  """The header of the bundle at path"""
+  try:
+    header = next(_lines(path), None)
+  except (OSError, EOFError, ValueError) as err:
+    raise BundleError(path, f"unreadable: {err.__class__.__name__}: {err}")
+  if not isinstance(header, dict) or header.get('record') != HEADER:
+    raise BundleError(path, "not a result bundle")
+  if header.get('version') != BUNDLE_VERSION:
+    raise BundleError(path, f"version {header.get('version')} isn't supported")
+  return header
+
+
+def read_bundle_records(path):
+  """Every record of the bundle at path, without its header and footer"""
+  footer = None
+  try:
+    for record in _lines(path):
+      if record.get('record') == HEADER and record.get('operation') is None:
+        continue
+      if footer is not None:
+        raise BundleError(path, "records after the end of the bundle")
+      if record.get('record') == FOOTER and record.get('operation') is None:
+        footer = record
+        continue
+      yield record
+  except (OSError, EOFError, ValueError) as err:
+    raise BundleError(path, f"unreadable: {err.__class__.__name__}: {err}")
+  if footer is None:
+    raise BundleError(path, "incomplete, the run writing it didn't finish")
+
+
+def merge_bundles(paths, writer):
+  """
+  Combine the bundles at paths, which must be shards of the same run, into a
+  summary of the fleet. Every record is passed on to writer, except the fleet
+  rankings of each shard, which only make sense for the whole fleet
+  """
+  headers = [(path, read_bundle_header(path)) for path in paths]
+  count = headers[0][1]['shard'][1]
+  operations = headers[0][1]['operations']
+  shards = {}
+  for path, header in headers:
+    index, shard_count = header['shard']
+    if shard_count != count:
+      raise BundleError(path, f"shard {index}/{shard_count} isn't one of {count} shards like {headers[0][0]}")
+    if header['operations'] != operations:
+      raise BundleError(path, f"ran {header['operations']} instead of {operations} like {headers[0][0]}")
+    if index in shards:
+      raise BundleError(path, f"shard {index}/{count} is also {shards[index]}")
+    shards[index] = path
+  # Whatever order they're given in, the result is the same
+  headers.sort(key=lambda item: item[1]['shard'][0])
+
+  hosts = {}
+  statuses = {}
+  findings = {}
+  for path, header in headers:
+    hosts.update(header['hosts'])
+    for record in read_bundle_records(path):
+      if record.get('operation') == 'fleet':
+        continue
+      if record.get('record') == 'host' and record.get('operation') is None:
+        statuses[record['host']] = record['status']
+      elif record.get('severity') in (CRITICAL, WARNING):
+        # Errors before any operation ran are the host's own
+        found = findings.setdefault(record.get('operation') or 'host', {CRITICAL: 0, WARNING: 0, 'hosts': set()})
+        found[record['severity']] += 1
+        found['hosts'].add(record['host'])
+      writer.write(record)
+  return {'shards': count, 'merged': sorted(shards), 'missing': [index for index in range(1, count + 1)
+                                                                 if index not in shards],
+          'operations': operations, 'hosts': hosts, 'statuses': statuses,
+          'findings': {operation: dict(found, hosts=sorted(found['hosts']))
+                       for operation, found in findings.items()}}
+
+
+def format_summary(summary):
+  """The summary of merge_bundles() as text"""
+  lines = [f"Merged {len(summary['merged'])} of {summary['shards']} shard(s), "
+           f"{len(summary['hosts'])} host(s) running {' '.join(summary['operations'])}"]
+  if summary['missing']:
+    missing = [f"{index}/{summary['shards']}" for index in summary['missing']]
+    lines.append(f"Missing shard(s): {', '.join(missing)}")
+  by_status = {}
+  for host, status in sorted(summary['statuses'].items()):
+    by_status.setdefault(status, []).append(host)
+  not_run = sorted(set(summary['hosts']) - set(summary['statuses']))
+  if not_run:
+    by_status['not run'] = not_run
+  for status, hosts in sorted(by_status.items()):
+    line = f"  {status:12} {len(hosts):6} host(s)"
+    if status in FAILED_STATUSES or status == 'not run':
+      line += f": {hosts}"
+    lines.append(line)
+  if summary['findings']:
+    lines.append("")
+    lines.append(f"{'operation':12} {'critical':>8} {'warning':>8} {'hosts':>6}")
+    for operation, found in sorted(summary['findings'].items()):
+      lines.append(f"{operation:12} {found[CRITICAL]:8} {found[WARNING]:8} {len(found['hosts']):6}")
+  return "\n".join(lines)
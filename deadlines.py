@@ -0,0 +1,218 @@
+import json
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from jnpr.junos.exception import ConnectTimeoutError, RpcTimeoutError
+from ncclient.operations.errors import TimeoutExpiredError
+from replay import scp_get, ssh_read
+
+
+# Kinds of deadline, from the narrowest
+RPC = 'rpc'
+OPERATION = 'operation'
+HOST = 'host'
+
+# Seconds left to RPCs on a session once one of its deadlines ran out, mostly so
+# closing the session of a box that stopped answering doesn't stall the run
+# all over again
+CLOSE_TIMEOUT = 5
+
+# Fewest seconds given to a call, so one started with next to nothing left
+# still gets a chance to answer instead of timing out at once
+MIN_TIMEOUT = 0.05
+
+
+def load_rpc_deadlines(value):
+  """
+  Turn --rpc-deadline into {rpc: seconds}. value is either a number of seconds
+  used for every RPC or a JSON file of per-RPC seconds with an optional 'default'
+  """
+  if value is None:
+    return {}
+  try:
+    deadlines = {'default': float(value)}
+  except ValueError:
+    with open(value, "r") as f:
+      deadlines = {rpc: float(seconds) for rpc, seconds in json.load(f).items()}
+  for rpc, seconds in deadlines.items():
+    if seconds <= 0:
+      raise ValueError(f"deadline of '{rpc}' must be more than 0 seconds")
+  return deadlines
+
+
+def _timeout(seconds):
+  # Set on the session directly rather than through PyEZ's timeout setter,
+  # which would round it down to whole seconds
+  return max(MIN_TIMEOUT, seconds)
+
+
+class Deadlines(object):
+  """
+  Time allowed for each RPC, each operation and each host. rpc maps RPC names
+  (or 'default') to seconds, operation and host are seconds or None. Devices
+  created through device() give every RPC, file transfer and connection what is
+  left of the nearest deadline and raise RpcTimeoutError once it's gone
+  """
+
+  def __init__(self, rpc=None, operation=None, host=None):
+    self.rpc = rpc or {}
+    self.operation_seconds = operation
+    self.host_seconds = host
+    self._local = threading.local()
+
+  def device(self, factory):
+    """Wrap a Device class or factory so every device it creates keeps to the deadlines"""
+    def create(*vargs, **kvargs):
+      dev = factory(*vargs, **kvargs)
+      self._instrument(dev)
+      return dev
+    return create
+
+  @contextmanager
+  def host(self):
+    """Start the host deadline of the current thread"""
+    self._local.host_end = time.monotonic() + self.host_seconds if self.host_seconds else None
+    self._local.expired = None
+    try:
+      yield
+    finally:
+      self._local.host_end = None
+
+  @contextmanager
+  def operation(self, name):
+    """Start the deadline of operation name on the current thread"""
+    self._local.operation_end = time.monotonic() + self.operation_seconds if self.operation_seconds else None
+    try:
+      yield
+    finally:
+      self._local.operation_end = None
+
+  def expired(self):
+    """(kind, seconds) of the deadline that ran out for the current host, None if none did"""
+    return getattr(self._local, 'expired', None)
+
+  def _budget(self, rpc=None, since=None):
+    """
+    (seconds left, kind, seconds allowed) of the nearest deadline, None without
+    any. The deadline of rpc counts from since, the monotonic time it was sent
+    """
+    now = time.monotonic()
+    budgets = []
+    seconds = self.rpc.get(rpc, self.rpc.get('default')) if rpc else None
+    if seconds:
+      budgets.append((seconds - (now - since if since is not None else 0), RPC, seconds))
+    end = getattr(self._local, 'operation_end', None)
+    if end is not None:
+      budgets.append((end - now, OPERATION, self.operation_seconds))
+    end = getattr(self._local, 'host_end', None)
+    if end is not None:
+      budgets.append((end - now, HOST, self.host_seconds))
+    return min(budgets) if budgets else None
+
+  def _expire(self, dev, budget):
+    self._local.expired = budget[1:]
+    if getattr(dev, '_conn', None) is not None:
+      dev._conn.timeout = CLOSE_TIMEOUT
+
+  def _instrument(self, dev):
+    rpc_reply = dev._rpc_reply
+    dev_open = dev.open
+    get_file = getattr(dev, 'get_file', None)
+    read_file = getattr(dev, 'read_file', None)
+
+    # Instance attributes shadow the Device methods, which is all PyEZ calls for
+    # RPCs, CLI commands and fact gathering
+    def deadline_rpc_reply(rpc_cmd_e, *vargs, **kvargs):
+      budget = self._budget(rpc_cmd_e.tag)
+      if budget is None:
+        return rpc_reply(rpc_cmd_e, *vargs, **kvargs)
+      if budget[0] <= 0:
+        self._expire(dev, budget)
+        # Raised like ncclient does so Device.execute turns it into RpcTimeoutError
+        raise TimeoutExpiredError(f"{budget[1]} deadline of {budget[2]}s ran out before {rpc_cmd_e.tag}")
+      timeout = dev._conn.timeout
+      start = time.monotonic()
+      dev._conn.timeout = _timeout(budget[0])
+      try:
+        reply = rpc_reply(rpc_cmd_e, *vargs, **kvargs)
+      except TimeoutExpiredError:
+        self._expire(dev, budget)
+        raise
+      except Exception:
+        dev._conn.timeout = timeout
+        raise
+      dev._conn.timeout = timeout
+      budget = self._budget(rpc_cmd_e.tag, since=start)
+      if budget[0] <= 0:
+        # Answered, but only after the deadline ran out
+        self._expire(dev, budget)
+        raise TimeoutExpiredError(f"{budget[1]} deadline of {budget[2]}s ran out during {rpc_cmd_e.tag}")
+      return reply
+
+    def deadline_open(*vargs, **kvargs):
+      budget = self._budget()
+      if budget is not None:
+        if budget[0] <= 0:
+          self._expire(dev, budget)
+          raise ConnectTimeoutError(dev)
+        if budget[0] < dev._conn_open_timeout:
+          dev._conn_open_timeout = _timeout(budget[0])
+        else:
+          budget = None
+      try:
+        return dev_open(*vargs, **kvargs)
+      except ConnectTimeoutError:
+        if budget is not None:
+          self._expire(dev, budget)
+        raise
+
+    def deadline_get_file(remote_path, local_path):
+      budget = self._budget()
+      if budget is not None and budget[0] <= 0:
+        self._expire(dev, budget)
+        raise RpcTimeoutError(dev, remote_path, budget[2])
+      try:
+        if get_file is not None:
+          get_file(remote_path, local_path)
+        else:
+          scp_get(dev, remote_path, local_path, timeout=budget and _timeout(budget[0]))
+      except socket.timeout:
+        budget = self._budget()
+        if budget is None:
+          raise
+        self._expire(dev, budget)
+        raise RpcTimeoutError(dev, remote_path, budget[2])
+
+    def deadline_read_file(remote_path, offset=0, length=None):
+      budget = self._budget()
+      if read_file is not None:
+        chunks = read_file(remote_path, offset, length)
+      else:
+        # A single read that hangs is bounded by the socket timeout, the rest by
+        # checking between chunks
+        chunks = ssh_read(dev, remote_path, offset, length, timeout=budget and _timeout(budget[0]))
+      try:
+        while True:
+          if budget is not None and budget[0] <= 0:
+            self._expire(dev, budget)
+            raise RpcTimeoutError(dev, remote_path, budget[2])
+          try:
+            chunk = next(chunks, None)
+          except socket.timeout:
+            budget = self._budget()
+            if budget is None:
+              raise
+            self._expire(dev, budget)
+            raise RpcTimeoutError(dev, remote_path, budget[2])
+          if chunk is None:
+            break
+          yield chunk
+          budget = self._budget()
+      finally:
+        chunks.close()
+
+    dev._rpc_reply = deadline_rpc_reply
+    dev.open = deadline_open
+    dev.get_file = deadline_get_file
+    dev.read_file = deadline_read_file
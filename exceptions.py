@@ -4,3 +4,23 @@ from colorama import Fore, Style
 class InvalidInput(Exception):
   def __init__(self):
     super().__init__("Invalid Input")
+
+
+class InvalidThreshold(Exception):
+  def __init__(self, name, reason):
+    super().__init__(f"Invalid threshold for '{name}': {reason}")
+
+
+class InvalidLogRule(Exception):
+  def __init__(self, name, reason):
+    super().__init__(f"Invalid log rule '{name}': {reason}")
+
+
+class AgentError(Exception):
+  def __init__(self, reason):
+    super().__init__(f"Session agent: {reason}")
+
+
+class BundleError(Exception):
+  def __init__(self, path, reason):
+    super().__init__(f"Result bundle '{path}': {reason}")
@@ -0,0 +1,139 @@
+import json
+import time
+from collections.abc import Mapping
+
+
+# Seconds facts and inventories are reused for
+CACHE_TTL = 3600
+
+# Facts that change while a device stays up. They're never taken from a cache
+# and are gathered again whenever a session is reused
+VOLATILE_FACTS = ('RE0', 'RE1')
+
+
+# Marks a version_info object in the cache, kept as the version string it's
+# built from
+VERSION_INFO = '__version_info__'
+
+_UNCACHEABLE = object()
+
+
+def _encode(key, value, facts):
+  """value as it's kept in the cache, or _UNCACHEABLE when it can't be"""
+  if key == 'version_info':
+    # Built from the version fact, which the same RPC gathers
+    value = {VERSION_INFO: facts['version']}
+  elif key == 'junos_info' and value:
+    value = {name: dict(info, object={VERSION_INFO: info['text']}) for name, info in value.items()}
+  try:
+    json.dumps(value)
+  except (TypeError, ValueError):
+    return _UNCACHEABLE
+  return value
+
+
+def _decode(value):
+  """A value from the cache as PyEZ gathers it"""
+  if isinstance(value, dict):
+    if list(value) == [VERSION_INFO]:
+      from jnpr.junos.facts.swver import version_info
+      return version_info(value[VERSION_INFO])
+    return {key: _decode(item) for key, item in value.items()}
+  if isinstance(value, list):
+    return [_decode(item) for item in value]
+  return value
+
+
+class CachedFacts(Mapping):
+  """
+  Stands in for Device.facts. Facts cached by an earlier run are answered
+  without asking the device, the rest are gathered by PyEZ as usual and kept in
+  gathered until they're saved. cached and gathered hold facts as they're kept
+  in the cache, version_info objects as their version string. Facts that still
+  aren't JSON are gathered from the device on every run
+  """
+
+  def __init__(self, facts, cached=None, cached_at=None):
+    self._facts = facts
+    self.cached = cached or {}
+    self.cached_at = cached_at
+    self.gathered = {}
+
+  def __getitem__(self, key):
+    if key in self.cached:
+      return _decode(self.cached[key])
+    value = self._facts[key]
+    if key not in VOLATILE_FACTS:
+      encoded = _encode(key, value, self._facts)
+      if encoded is not _UNCACHEABLE:
+        self.gathered[key] = encoded
+    return value
+
+  def __iter__(self):
+    return iter(self._facts)
+
+  def __len__(self):
+    return len(self._facts)
+
+  def _refresh(self, exception_on_failure=False, warnings_on_failure=False, keys=None):
+    # What Device.facts_refresh() calls on new style facts
+    refresh = getattr(self._facts, '_refresh', None)
+    if refresh is not None:
+      refresh(exception_on_failure=exception_on_failure, warnings_on_failure=warnings_on_failure, keys=keys)
+    if keys is None:
+      self.cached = {}
+      self.gathered = {}
+      return
+    for key in (keys,) if isinstance(keys, str) else keys:
+      self.cached.pop(key, None)
+      self.gathered.pop(key, None)
+
+  def save(self, cache, host):
+    facts = dict(self.cached, **self.gathered)
+    if self.cached_at is None:
+      self.cached_at = time.time()
+    cache.set(host, facts, self.cached_at)
+    self.cached = facts
+    self.gathered = {}
+
+
+def cached_facts_device(factory, cache, max_age=CACHE_TTL, refresh=False):
+  """
+  Wrap a Device class or factory so every device it creates answers facts from
+  cache when they were gathered less than max_age seconds ago, and saves the
+  facts it had to gather when closed. refresh ignores what was cached
+  """
+  def create(*vargs, **kvargs):
+    dev = factory(*vargs, **kvargs)
+    host = kvargs['host'] if 'host' in kvargs else vargs[0]
+    dev_open = dev.open
+    dev_close = dev.close
+
+    def cached_open(*vargs, **kvargs):
+      result = dev_open(*vargs, **kvargs)
+      if not isinstance(dev.facts, CachedFacts):
+        entry = None
+        if not refresh:
+          try:
+            entry = cache.get(host, time.time() - max_age)
+          except Exception:
+            # The cache only saves time, the device can still be asked
+            pass
+        dev.facts = CachedFacts(dev.facts, *(entry or ()))
+      return result
+
+    def cached_close(*vargs, **kvargs):
+      facts = dev.facts
+      if isinstance(facts, CachedFacts) and facts.gathered:
+        try:
+          facts.save(cache, host)
+        except Exception:
+          pass
+      return dev_close(*vargs, **kvargs)
+
+    # Instance attributes shadow the Device methods, which is what the context
+    # manager calls
+    dev.open = cached_open
+    dev.close = cached_close
+    return dev
+  return create
@@ -0,0 +1,256 @@
+import threading
+import time
+from array import array
+
+
+# Counters whose rate counts towards an interface's error rate. FEC, PCS and
+# MAC control/pause counters are ranked on their own or aren't errors at all
+MAC_ERRORS = {'input_oversized_frames', 'input_jabber_frames', 'input_fragment_frames', 'input_code_violations'}
+
+FEC_UNCORRECTABLE = 'fec_nccw_count'
+
+PCS_ERRORED_SECONDS = ('bit_error_seconds', 'errored_blocks_seconds')
+
+# (name, title, unit, worst first). Optic margin is worst when lowest
+RANKINGS = (
+  ('error_rate', 'error rate', '/s', True),
+  ('fec_uncorrectable', 'FEC uncorrectable growth', '', True),
+  ('optic_margin', 'optic margin', 'dB', False),
+  ('pcs_errored_seconds', 'PCS errored seconds growth', 's', True),
+)
+
+TOP = 20
+
+
+def _is_error(counter):
+  return counter.startswith(('rx_err_', 'tx_err_')) or counter in MAC_ERRORS
+
+
+def _port(name):
+  return name.split('.')[0] if name else name
+
+
+class _Columns(object):
+  """Append only columns of equal length, one typed array per field"""
+
+  def __init__(self, **typecodes):
+    for name, typecode in typecodes.items():
+      setattr(self, name, array(typecode))
+    self._names = tuple(typecodes)
+
+  def __len__(self):
+    return len(getattr(self, self._names[0]))
+
+  def append(self, **values):
+    for name in self._names:
+      getattr(self, name).append(values[name])
+
+  def rows(self):
+    return zip(*(getattr(self, name) for name in self._names))
+
+
+class FleetStats(object):
+  """
+  Takes the records of every host like a RecordWriter and keeps what ints()
+  measured in columns: counters that moved, thresholds reached and optic
+  levels. Strings are stored once and referred to by number. Records are passed
+  on to writer, if any
+  """
+
+  def __init__(self, writer=None):
+    self.writer = writer
+    self._lock = threading.Lock()
+    self._ids = {None: 0}
+    self._strings = [None]
+    self.hosts = {}
+    self.counters = _Columns(host='I', iface='I', counter='I', neighbor='I', neighbor_port='I', delta='q',
+                             rate='d')
+    self.breaches = _Columns(host='I', iface='I', counter='I')
+    self.optics = _Columns(host='I', iface='I', lane='I', neighbor='I', neighbor_port='I', margin='d')
+
+  def _id(self, value):
+    value = None if value is None else str(value)
+    found = self._ids.get(value)
+    if found is None:
+      found = self._ids[value] = len(self._strings)
+      self._strings.append(value)
+    return found
+
+  def write(self, record):
+    operation, kind = record.get('operation'), record.get('record')
+    with self._lock:
+      if kind == 'host':
+        self.hosts[record['host']] = record['status']
+      elif operation == 'ints' and kind == 'counter':
+        self.counters.append(host=self._id(record['host']), iface=self._id(record['interface']),
+                             counter=self._id(record['counter']), neighbor=self._id(record.get('neighbor')),
+                             neighbor_port=self._id(_port(record.get('neighbor_port'))),
+                             delta=record['delta'], rate=record['rate'])
+      elif operation == 'ints' and kind == 'threshold':
+        self.breaches.append(host=self._id(record['host']), iface=self._id(record['interface']),
+                             counter=self._id(record['counter']))
+      elif operation == 'ints' and kind == 'optic_level' and (record['margin'] is not None or record['no_light']):
+        self.optics.append(host=self._id(record['host']), iface=self._id(record['interface']),
+                           lane=self._id(record.get('lane')), neighbor=self._id(record.get('neighbor')),
+                           neighbor_port=self._id(_port(record.get('neighbor_port'))),
+                           margin=float('-inf') if record['no_light'] else record['margin'])
+    if self.writer is not None:
+      self.writer.write(record)
+
+  def flush(self):
+    if self.writer is not None:
+      self.writer.flush()
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+
+  def _interfaces(self):
+    """{(host, iface): {metric: value, ...}} with the neighbor and detail of each interface"""
+    s = self._strings
+    interfaces = {}
+
+    def entry(host, iface, neighbor, neighbor_port):
+      found = interfaces.get((s[host], s[iface]))
+      if found is None:
+        found = interfaces[(s[host], s[iface])] = {'neighbor': None, 'neighbor_port': None}
+      if neighbor and found['neighbor'] is None:
+        found['neighbor'], found['neighbor_port'] = s[neighbor], s[neighbor_port]
+      return found
+
+    for host, iface, counter, neighbor, neighbor_port, delta, rate in self.counters.rows():
+      found = entry(host, iface, neighbor, neighbor_port)
+      name = s[counter]
+      if _is_error(name):
+        found['error_rate'] = found.get('error_rate', 0) + rate
+        if rate > found.get('worst_rate', 0):
+          found['worst_rate'], found['error_rate_detail'] = rate, name
+      elif name == FEC_UNCORRECTABLE:
+        found['fec_uncorrectable'] = found.get('fec_uncorrectable', 0) + delta
+      elif name in PCS_ERRORED_SECONDS:
+        found['pcs_errored_seconds'] = found.get('pcs_errored_seconds', 0) + delta
+    for host, iface, lane, neighbor, neighbor_port, margin in self.optics.rows():
+      found = entry(host, iface, neighbor, neighbor_port)
+      if margin < found.get('optic_margin', float('inf')):
+        found['optic_margin'] = margin
+        found['optic_margin_detail'] = f"lane {s[lane]}" if lane else None
+    for host, iface, counter in self.breaches.rows():
+      found = entry(host, iface, 0, 0)
+      found['breaches'] = found.get('breaches', 0) + 1
+    return interfaces
+
+  def report(self, groups, top=TOP):
+    """
+    Rank the interfaces of the fleet. groups maps each host to its inventory
+    groups. Every ranked interface comes with the other end of its link, when
+    LLDP named a host of the inventory
+    """
+    interfaces = self._interfaces()
+    # LLDP gives the system name, which may be fully qualified
+    names = {}
+    for host in groups:
+      names.setdefault(host.split('.')[0], host)
+      names[host] = host
+
+    def far_end(found, metric):
+      far_host = names.get(found['neighbor']) or names.get((found['neighbor'] or '').split('.')[0])
+      if far_host is None or found['neighbor_port'] is None:
+        return None
+      far = {'host': far_host, 'interface': found['neighbor_port'], 'value': None}
+      far['triaged'] = far_host in self.hosts
+      far['value'] = interfaces.get((far_host, found['neighbor_port']), {}).get(metric)
+      if far['value'] is None and far['triaged'] and metric != 'optic_margin':
+        # Nothing moved on the far end
+        far['value'] = 0
+      return far
+
+    rankings = {}
+    for metric, title, unit, descending in RANKINGS:
+      ranked = [(key, found) for key, found in interfaces.items()
+                if found.get(metric) is not None and (found[metric] > 0 or not descending)]
+      ranked.sort(key=lambda item: item[1][metric], reverse=descending)
+      rankings[metric] = [{'host': host, 'interface': iface, 'value': found[metric],
+                           'detail': found.get(f"{metric}_detail"), 'neighbor': found['neighbor'],
+                           'neighbor_port': found['neighbor_port'], 'far_end': far_end(found, metric)}
+                          for (host, iface), found in ranked[:top]]
+
+    by_group = {}
+    for host, host_groups in groups.items():
+      for group in host_groups:
+        summary = by_group.setdefault(group, {'group': group, 'hosts': 0, 'interfaces': 0, 'breaches': 0,
+                                              'error_rate': 0, 'fec_uncorrectable': 0, 'pcs_errored_seconds': 0,
+                                              'optic_margin': None})
+        summary['hosts'] += 1
+    for (host, iface), found in interfaces.items():
+      problem = found.get('breaches') or found.get('error_rate') or found.get('fec_uncorrectable') or \
+          found.get('pcs_errored_seconds')
+      for group in groups.get(host, ()):
+        summary = by_group[group]
+        summary['interfaces'] += 1 if problem else 0
+        for metric in ('breaches', 'error_rate', 'fec_uncorrectable', 'pcs_errored_seconds'):
+          summary[metric] += found.get(metric, 0)
+        margin = found.get('optic_margin')
+        if margin is not None and (summary['optic_margin'] is None or margin < summary['optic_margin']):
+          summary['optic_margin'] = margin
+    return {'hosts': len(self.hosts), 'samples': len(self.counters), 'rankings': rankings,
+            'groups': sorted(by_group.values(), key=lambda summary: summary['group'])}
+
+  def write_report(self, report):
+    """Pass the rankings and group summaries on to writer as records"""
+    if self.writer is None:
+      return
+    ts = round(time.time(), 3)
+    for metric, rows in report['rankings'].items():
+      for rank, row in enumerate(rows, 1):
+        far = row['far_end'] and dict(row['far_end'], value=_finite(row['far_end']['value']))
+        row = dict(row, value=_finite(row['value']), far_end=far, no_light=row['value'] == float('-inf'))
+        self.writer.write(dict(ts=ts, host=row.pop('host'), operation='fleet', record='top', severity='info',
+                               metric=metric, rank=rank, **row))
+    for summary in report['groups']:
+      summary = dict(summary, optic_margin=_finite(summary['optic_margin']))
+      self.writer.write(dict(ts=ts, host=None, operation='fleet', record='group', severity='info', **summary))
+
+
+def _finite(value):
+  # No light is -inf, which JSON can't hold
+  return None if value == float('-inf') else value
+
+
+def _value(value, unit):
+  if value is None:
+    return "n/a"
+  if value == float('-inf'):
+    return "no light"
+  if isinstance(value, float):
+    return f"{value:0.2f}{unit}"
+  return f"{value}{unit}"
+
+
+def format_report(report):
+  """The report of FleetStats.report() as text"""
+  lines = [f"{report['hosts']} host(s), {report['samples']} counter change(s) since the previous run"]
+  units = {metric: unit for metric, title, unit, descending in RANKINGS}
+  for metric, title, unit, descending in RANKINGS:
+    rows = report['rankings'][metric]
+    lines.append("")
+    lines.append(f"Worst {len(rows)} interface(s) by {title}:" if rows else f"No interfaces to rank by {title}")
+    for rank, row in enumerate(rows, 1):
+      detail = f" ({row['detail']})" if row['detail'] else ""
+      line = f"  {rank:3}. {row['host']:20} {row['interface']:14} {_value(row['value'], unit):>12}{detail}"
+      far = row['far_end']
+      if far is not None:
+        far_value = _value(far['value'], unit) if far['triaged'] else "not triaged"
+        line += f"  <-> {far['host']} {far['interface']}: {far_value}"
+      elif row['neighbor']:
+        line += f"  <-> {row['neighbor']} {row['neighbor_port'] or ''}".rstrip()
+      lines.append(line)
+  if report['groups']:
+    lines.append("")
+    lines.append(f"{'group':20} {'hosts':>6} {'ifaces':>6} {'breaches':>8} {'err rate':>12} {'fec unc':>9} "
+                 f"{'pcs es':>8} {'min margin':>11}")
+    for summary in report['groups']:
+      lines.append(f"{summary['group']:20} {summary['hosts']:6} {summary['interfaces']:6} {summary['breaches']:8} "
+                   f"{_value(float(summary['error_rate']), units['error_rate']):>12} "
+                   f"{summary['fec_uncorrectable']:9} {summary['pcs_errored_seconds']:8} "
+                   f"{_value(summary['optic_margin'], units['optic_margin']):>11}")
+  return "\n".join(lines)
@@ -0,0 +1,325 @@
+import json
+import sqlite3
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+
+HISTORY_DB = "counters/history.db"
+
+# Anything in here can be thrown away, it is gathered again when missing
+CACHE_DB = "counters/cache.db"
+
+COUNTER32_MAX = 2 ** 32
+
+# Seconds counter samples are kept for
+COUNTER_RETENTION = 30 * 24 * 3600
+
+COUNTERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+  host TEXT NOT NULL,
+  interface TEXT NOT NULL,
+  counter TEXT NOT NULL,
+  ts REAL NOT NULL,
+  value INTEGER NOT NULL,
+  PRIMARY KEY (host, interface, counter, ts)
+) WITHOUT ROWID;
+"""
+
+# The newest sample of every counter, so a run finds what to compare against
+# without going through the whole history
+COUNTER_LATEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS counter_latest (
+  host TEXT NOT NULL,
+  interface TEXT NOT NULL,
+  counter TEXT NOT NULL,
+  ts REAL NOT NULL,
+  value INTEGER NOT NULL,
+  PRIMARY KEY (host, interface, counter)
+) WITHOUT ROWID;
+"""
+
+WATERMARKS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS log_watermarks (
+  host TEXT NOT NULL,
+  path TEXT NOT NULL,
+  offset INTEGER NOT NULL,
+  head BLOB NOT NULL,
+  ts REAL NOT NULL,
+  PRIMARY KEY (host, path)
+) WITHOUT ROWID;
+"""
+
+FACTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS facts (
+  host TEXT NOT NULL PRIMARY KEY,
+  facts TEXT NOT NULL,
+  ts REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+BGP_PEERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bgp_peers (
+  host TEXT NOT NULL,
+  peer TEXT NOT NULL,
+  state TEXT,
+  flap_count INTEGER,
+  ts REAL NOT NULL,
+  PRIMARY KEY (host, peer)
+) WITHOUT ROWID;
+"""
+
+HMC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hmc (
+  chassis TEXT NOT NULL,
+  slot TEXT NOT NULL,
+  fpc_serial TEXT NOT NULL,
+  asics TEXT NOT NULL,
+  ts REAL NOT NULL,
+  PRIMARY KEY (chassis, slot)
+) WITHOUT ROWID;
+"""
+
+INVENTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS inventory (
+  source TEXT NOT NULL PRIMARY KEY,
+  fingerprint TEXT NOT NULL,
+  hosts TEXT NOT NULL,
+  ts REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def counter_increase(prev, curr):
+  """
+  Return (increase, reset) between two samples of the same counter. A 32 bit
+  counter that rolled over is unwrapped. Any other drop means the counter was
+  cleared, and the increase is what it has counted since the clear
+  """
+  if curr >= prev:
+    return curr - prev, False
+  if prev < COUNTER32_MAX and curr + COUNTER32_MAX - prev < COUNTER32_MAX // 2:
+    return curr + COUNTER32_MAX - prev, False
+  return curr, True
+
+
+class _Store(object):
+  SCHEMA = None
+
+  def __init__(self, path=HISTORY_DB):
+    self.path = path
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with self._transaction() as conn:
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.executescript(self.SCHEMA)
+
+  @contextmanager
+  def _transaction(self):
+    # A connection per call keeps the store usable from several worker threads
+    with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+      with conn:
+        yield conn
+
+
+class CounterHistory(_Store):
+  """
+  Append-only store of interface counter samples keyed by
+  host/interface/counter/timestamp. Timestamps are UTC epoch seconds. Samples
+  older than retention seconds are dropped as new ones are recorded, unless
+  retention is None
+  """
+
+  SCHEMA = COUNTERS_SCHEMA + COUNTER_LATEST_SCHEMA
+
+  def __init__(self, path=HISTORY_DB, retention=COUNTER_RETENTION):
+    super().__init__(path)
+    self.retention = retention
+    with self._transaction() as conn:
+      # Histories written before counter_latest existed
+      if (conn.execute("SELECT 1 FROM counter_latest LIMIT 1").fetchone() is None and
+          conn.execute("SELECT 1 FROM counters LIMIT 1").fetchone() is not None):
+        conn.execute("INSERT INTO counter_latest SELECT host, interface, counter, MAX(ts), value FROM counters "
+                     "GROUP BY host, interface, counter")
+
+  def record(self, host, ts, samples):
+    """Write every (interface, counter, value) sample for host in one transaction"""
+    samples = [(host, interface, counter, ts, value) for interface, counter, value in samples]
+    with self._transaction() as conn:
+      conn.executemany("INSERT OR REPLACE INTO counters VALUES (?, ?, ?, ?, ?)", samples)
+      conn.executemany("INSERT INTO counter_latest VALUES (?, ?, ?, ?, ?) "
+                       "ON CONFLICT (host, interface, counter) DO UPDATE SET ts = excluded.ts, value = excluded.value "
+                       "WHERE excluded.ts >= counter_latest.ts", samples)
+      if self.retention is not None:
+        conn.execute("DELETE FROM counters WHERE host = ? AND ts < ?", (host, ts - self.retention))
+        conn.execute("DELETE FROM counter_latest WHERE host = ? AND ts < ?", (host, ts - self.retention))
+
+  def previous(self, host, before):
+    """Return {(interface, counter): (ts, value)} for the newest sample of each counter before ts"""
+    with self._transaction() as conn:
+      previous = {}
+      for interface, counter, ts, value in conn.execute(
+          "SELECT interface, counter, ts, value FROM counter_latest WHERE host = ?", (host,)).fetchall():
+        if ts >= before:
+          # Only when comparing against an earlier point than the last run
+          row = conn.execute("SELECT ts, value FROM counters WHERE host = ? AND interface = ? AND counter = ? "
+                             "AND ts < ? ORDER BY ts DESC LIMIT 1", (host, interface, counter, before)).fetchone()
+          if row is None:
+            continue
+          ts, value = row
+        previous[(interface, counter)] = (ts, value)
+      return previous
+
+  def samples(self, host, interface, counter, since=None, until=None):
+    """Return [(ts, value), ...] oldest first, optionally limited to since <= ts <= until"""
+    query = "SELECT ts, value FROM counters WHERE host = ? AND interface = ? AND counter = ?"
+    params = [host, interface, counter]
+    if since is not None:
+      query += " AND ts >= ?"
+      params.append(since)
+    if until is not None:
+      query += " AND ts <= ?"
+      params.append(until)
+    with self._transaction() as conn:
+      return conn.execute(query + " ORDER BY ts", params).fetchall()
+
+  def rate(self, host, interface, counter, window, until):
+    """
+    Average increase per second over the window seconds ending at until, None
+    without two samples. Clears and wraps between samples are accounted for
+    """
+    samples = self.samples(host, interface, counter, since=until - window, until=until)
+    if len(samples) < 2 or samples[-1][0] == samples[0][0]:
+      return None
+    increase = 0
+    for (_, prev), (_, curr) in zip(samples, samples[1:]):
+      increase += counter_increase(prev, curr)[0]
+    return increase / (samples[-1][0] - samples[0][0])
+
+
+class LogWatermarks(_Store):
+  """
+  How far each host's log files have been scanned. head is the start of the
+  file at that point, so a rotated or cleared file can be told apart from one
+  that only grew
+  """
+
+  SCHEMA = WATERMARKS_SCHEMA
+
+  def get(self, host, path):
+    """Return (offset, head) or None when path hasn't been scanned for host"""
+    with self._transaction() as conn:
+      return conn.execute("SELECT offset, head FROM log_watermarks WHERE host = ? AND path = ?",
+                          (host, path)).fetchone()
+
+  def set(self, host, path, offset, head, ts):
+    with self._transaction() as conn:
+      conn.execute("INSERT OR REPLACE INTO log_watermarks VALUES (?, ?, ?, ?, ?)", (host, path, offset, head, ts))
+
+
+class BgpPeerStates(_Store):
+  """The state and flap count of every BGP peer of each host as of its last run"""
+
+  SCHEMA = BGP_PEERS_SCHEMA
+
+  def previous(self, host):
+    """Return {peer: (state, flap_count, ts)} saved for host, empty when it was never saved"""
+    with self._transaction() as conn:
+      rows = conn.execute("SELECT peer, state, flap_count, ts FROM bgp_peers WHERE host = ?", (host,))
+      return {peer: (state, flap_count, ts) for peer, state, flap_count, ts in rows}
+
+  def record(self, host, ts, peers):
+    """Replace what is saved for host with every (peer, state, flap_count) in one transaction"""
+    with self._transaction() as conn:
+      conn.execute("DELETE FROM bgp_peers WHERE host = ?", (host,))
+      conn.executemany("INSERT INTO bgp_peers VALUES (?, ?, ?, ?, ?)",
+                       ((host, peer, state, flap_count, ts) for peer, state, flap_count in peers))
+
+
+class FactsCache(_Store):
+  """Device facts kept between runs as JSON. ts is when the oldest of them was gathered"""
+
+  SCHEMA = FACTS_SCHEMA
+
+  def __init__(self, path=CACHE_DB):
+    super().__init__(path)
+
+  def get(self, host, since):
+    """Return (facts, ts) or None when host has no facts gathered since ts since"""
+    with self._transaction() as conn:
+      row = conn.execute("SELECT facts, ts FROM facts WHERE host = ? AND ts >= ?", (host, since)).fetchone()
+    return None if row is None else (json.loads(row[0]), row[1])
+
+  def set(self, host, facts, ts):
+    with self._transaction() as conn:
+      conn.execute("INSERT OR REPLACE INTO facts VALUES (?, ?, ?)", (host, json.dumps(facts), ts))
+
+  def invalidate(self, host=None):
+    """Forget the facts of host, or of every host"""
+    with self._transaction() as conn:
+      if host is None:
+        conn.execute("DELETE FROM facts")
+      else:
+        conn.execute("DELETE FROM facts WHERE host = ?", (host,))
+
+
+class HmcCache(_Store):
+  """
+  The HMC ASICs of each FPC as JSON, keyed by chassis serial and slot. Only
+  valid while the same card, by its serial, is in the slot
+  """
+
+  SCHEMA = HMC_SCHEMA
+
+  def __init__(self, path=CACHE_DB):
+    super().__init__(path)
+
+  def get(self, chassis, slot, fpc_serial):
+    """Return the ASICs saved for the card, None when missing or another card is in the slot"""
+    with self._transaction() as conn:
+      row = conn.execute("SELECT asics FROM hmc WHERE chassis = ? AND slot = ? AND fpc_serial = ?",
+                         (chassis, slot, fpc_serial)).fetchone()
+    return None if row is None else json.loads(row[0])
+
+  def set(self, chassis, slot, fpc_serial, asics, ts):
+    with self._transaction() as conn:
+      conn.execute("INSERT OR REPLACE INTO hmc VALUES (?, ?, ?, ?, ?)",
+                   (chassis, slot, fpc_serial, json.dumps(asics), ts))
+
+  def invalidate(self, chassis=None):
+    """Forget the FPCs of chassis, or of every chassis"""
+    with self._transaction() as conn:
+      if chassis is None:
+        conn.execute("DELETE FROM hmc")
+      else:
+        conn.execute("DELETE FROM hmc WHERE chassis = ?", (chassis,))
+
+
+class InventoryCache(_Store):
+  """
+  Hosts of an inventory with their resolved variables, kept between runs. Only
+  valid while the inventory's fingerprint is unchanged
+  """
+
+  SCHEMA = INVENTORY_SCHEMA
+
+  def __init__(self, path=CACHE_DB):
+    super().__init__(path)
+
+  def get(self, source, fingerprint, since):
+    """Return the hosts saved for source since ts since, None when missing, stale or changed"""
+    with self._transaction() as conn:
+      row = conn.execute("SELECT hosts FROM inventory WHERE source = ? AND fingerprint = ? AND ts >= ?",
+                         (source, fingerprint, since)).fetchone()
+    return None if row is None else json.loads(row[0])
+
+  def set(self, source, fingerprint, hosts, ts):
+    with self._transaction() as conn:
+      conn.execute("INSERT OR REPLACE INTO inventory VALUES (?, ?, ?, ?)",
+                   (source, fingerprint, json.dumps(hosts), ts))
+
+  def invalidate(self, source=None):
+    """Forget the hosts of source, or of every inventory"""
+    with self._transaction() as conn:
+      if source is None:
+        conn.execute("DELETE FROM inventory")
+      else:
+        conn.execute("DELETE FROM inventory WHERE source = ?", (source,))
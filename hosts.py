@@ -0,0 +1,270 @@
+import ast
+import hashlib
+import json
+import os
+import re
+import shlex
+import time
+from pathlib import Path
+from factcache import CACHE_TTL
+
+
+# Variables Ansible adds to every host that triage has no use for. 'groups'
+# alone lists every host in the inventory
+MAGIC_VARS = {
+  'ansible_check_mode', 'ansible_config_file', 'ansible_diff_mode', 'ansible_facts', 'ansible_forks',
+  'ansible_inventory_sources', 'ansible_playbook_python', 'ansible_run_tags', 'ansible_skip_tags',
+  'ansible_verbosity', 'ansible_version', 'environment', 'groups', 'hostvars', 'omit', 'playbook_dir',
+  'role_names',
+}
+
+# Inventory directory entries Ansible skips, including its default
+# INVENTORY_IGNORE_EXTS
+IGNORED = re.compile(r"^\.|^host_vars$|^group_vars$|^vars_plugins$|"
+                     r"(\.pyc|\.pyo|\.swp|\.bak|~|\.rpm|\.md|\.txt|\.rst|\.orig|\.cfg|\.retry)$")
+
+# Inventory files that need one of Ansible's other inventory plugins
+PLUGIN_SUFFIXES = ('.yml', '.yaml', '.json', '.toml')
+
+# Extensions Ansible tries, in order, for host_vars/group_vars files
+VARS_SUFFIXES = ('', '.yml', '.yaml', '.json')
+
+SECTION = re.compile(r"^\[([^:\]\s]+)(?::(\w+))?\]\s*(?:[#;].*)?$")
+
+# Host ranges like leaf[01:20] and host:port
+HOST_PATTERN = re.compile(r"[\[\]:]")
+
+
+class InventoryHost(object):
+  """A host of the inventory with the names of its groups and its resolved variables"""
+
+  __slots__ = ('name', 'groups', 'vars')
+
+  def __init__(self, name, groups, vars):
+    self.name = name
+    self.groups = groups
+    self.vars = vars
+
+  def to_dict(self):
+    return {'name': self.name, 'groups': self.groups, 'vars': self.vars}
+
+
+def fingerprint(path):
+  """Digest of the files under path that changes whenever one is added, removed or modified"""
+  path = Path(path)
+  files = [path] if path.is_file() else sorted(f for f in path.rglob('*') if f.is_file())
+  digest = hashlib.sha1()
+  for f in files:
+    stat = f.stat()
+    digest.update(f"{f}\0{stat.st_mtime_ns}\0{stat.st_size}\n".encode())
+  return digest.hexdigest()
+
+
+def _plain_vars(variables):
+  plain = {}
+  for name, value in variables.items():
+    if name in MAGIC_VARS:
+      continue
+    try:
+      # Round trip so Ansible's own str/dict/list types don't leak out
+      plain[name] = json.loads(json.dumps(value))
+    except (TypeError, ValueError):
+      continue
+  return plain
+
+
+def _literal(value):
+  try:
+    return ast.literal_eval(value)
+  except (ValueError, SyntaxError):
+    return value
+
+
+def _parse_ini(path, groups, hosts):
+  """
+  Add the groups and hosts of an INI inventory file to groups and hosts.
+  Returns False when the file uses anything only Ansible can make sense of
+  """
+  group, state = 'all', 'hosts'
+  with open(path, 'r') as f:
+    lines = f.read().splitlines()
+  for line in lines:
+    line = line.strip()
+    if not line or line[0] in '#;':
+      continue
+    if line.startswith('['):
+      match = SECTION.match(line)
+      if match is None or match.group(2) not in (None, 'children', 'vars'):
+        return False
+      group, state = match.group(1), match.group(2) or 'hosts'
+      groups.setdefault(group, {'vars': {}, 'parents': set()})
+    elif state == 'vars':
+      if '=' not in line:
+        return False
+      key, value = (part.strip() for part in line.split('=', 1))
+      groups[group]['vars'][key] = _literal(value)
+    elif state == 'children':
+      child = line.split()[0]
+      groups.setdefault(child, {'vars': {}, 'parents': set()})['parents'].add(group)
+    else:
+      try:
+        name, *assignments = shlex.split(line, comments=True)
+      except ValueError:
+        return False
+      if HOST_PATTERN.search(name) or any('=' not in assignment for assignment in assignments):
+        return False
+      host = hosts.setdefault(name, {'vars': {}, 'groups': set()})
+      host['groups'].add(group)
+      host['vars'].update(inventory_file=str(path), inventory_dir=str(path.parent))
+      for assignment in assignments:
+        key, value = assignment.split('=', 1)
+        host['vars'][key] = _literal(value)
+  return True
+
+
+def _vars_files(base, name):
+  # Like Ansible, the first of name, name.yml, ... that exists is used, and a
+  # directory stands for every vars file under it
+  for suffix in VARS_SUFFIXES:
+    path = base / f"{name}{suffix}"
+    if path.is_dir():
+      return sorted(f for f in path.rglob('*') if f.is_file() and f.suffix in VARS_SUFFIXES and
+                    not any(part.startswith('.') or part.endswith('~') for part in f.relative_to(path).parts))
+    if path.is_file():
+      return [path]
+  return []
+
+
+def _load_vars(files):
+  import yaml
+
+  variables = {}
+  for path in files:
+    with open(path, 'r') as f:
+      text = f.read()
+    if text.lstrip().startswith('$ANSIBLE_VAULT'):
+      return None
+    try:
+      data = yaml.load(text, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    except yaml.YAMLError:
+      # Including Ansible's own tags such as !vault
+      return None
+    if data is None:
+      continue
+    if not isinstance(data, dict):
+      return None
+    variables.update(data)
+  return variables
+
+
+def _simple_hosts(path):
+  """
+  Read an inventory made of INI files with host_vars/group_vars the way Ansible
+  would. Returns None for anything else so Ansible can be used instead
+  """
+  path = Path(path)
+  if path.is_dir():
+    sources = []
+    for entry in sorted(os.listdir(path)):
+      if IGNORED.search(entry):
+        continue
+      if not (path / entry).is_file():
+        return None
+      sources.append(path / entry)
+    base = path
+  else:
+    sources = [path]
+    base = path.parent
+  groups = {'all': {'vars': {}, 'parents': set()}, 'ungrouped': {'vars': {}, 'parents': set()}}
+  hosts = {}
+  for source in sources:
+    if source.suffix in PLUGIN_SUFFIXES or os.access(source, os.X_OK) or not _parse_ini(source, groups, hosts):
+      return None
+
+  depths = {'all': 0}
+
+  def depth(name, seen=()):
+    if name not in depths:
+      if name in seen:
+        raise RecursionError(name)
+      parents = groups[name]['parents'] or {'all'}
+      depths[name] = 1 + max(depth(parent, seen + (name,)) for parent in parents)
+    return depths[name]
+
+  def ancestors(name):
+    found = {name}
+    for parent in groups[name]['parents']:
+      found |= ancestors(parent)
+    return found
+
+  try:
+    for name in groups:
+      depth(name)
+  except RecursionError:
+    return None
+
+  group_vars = {}
+  inventory_hosts = []
+  for name, host in hosts.items():
+    member_of = set().union(*(ancestors(group) for group in host['groups']))
+    if member_of <= {'all'}:
+      member_of.add('ungrouped')
+    member_of.add('all')
+    ordered = sorted(member_of - {'all'}, key=lambda group: (depths[group], group))
+    variables = dict(groups['all']['vars'])
+    for group in ordered:
+      variables.update(groups[group]['vars'])
+    for group in ['all'] + ordered:
+      if group not in group_vars:
+        group_vars[group] = _load_vars(_vars_files(base / 'group_vars', group))
+        if group_vars[group] is None:
+          return None
+      variables.update(group_vars[group])
+    variables.update(host['vars'])
+    host_vars = _load_vars(_vars_files(base / 'host_vars', name))
+    if host_vars is None:
+      return None
+    variables.update(host_vars)
+    variables.update(inventory_hostname=name, inventory_hostname_short=name.split('.')[0],
+                     group_names=sorted(member_of - {'all'}))
+    inventory_hosts.append(InventoryHost(name, sorted(member_of), _plain_vars(variables)))
+  return inventory_hosts
+
+
+def _ansible_hosts(path):
+  # Only imported when the inventory has to be parsed, which a warm cache avoids
+  from ansible.inventory.manager import InventoryManager
+  from ansible.parsing.dataloader import DataLoader
+  from ansible.vars.manager import VariableManager
+
+  loader = DataLoader()
+  inventory = InventoryManager(loader=loader, sources=path)
+  variables = VariableManager(loader=loader, inventory=inventory)
+  return [InventoryHost(host.get_name(), [str(group) for group in host.get_groups()],
+                        _plain_vars(variables.get_vars(host=host)))
+          for host in inventory.get_hosts()]
+
+
+def _parse_inventory(path):
+  hosts = _simple_hosts(path)
+  return _ansible_hosts(path) if hosts is None else hosts
+
+
+def load_inventory(path, cache=None, max_age=CACHE_TTL, refresh=False):
+  """
+  Return [InventoryHost, ...] for the Ansible inventory at path. Plain INI
+  inventories with host_vars/group_vars are read without Ansible. With an
+  InventoryCache the hosts are reused for up to max_age seconds as long as no
+  file of the inventory changed, unless refresh
+  """
+  if cache is None:
+    return _parse_inventory(path)
+  source = str(Path(path).resolve())
+  digest = fingerprint(path)
+  if not refresh:
+    hosts = cache.get(source, digest, time.time() - max_age)
+    if hosts is not None:
+      return [InventoryHost(**host) for host in hosts]
+  hosts = _parse_inventory(path)
+  cache.set(source, digest, [host.to_dict() for host in hosts], time.time())
+  return hosts
@@ -0,0 +1,246 @@
+import json
+import re
+from pathlib import Path
+from exceptions import InvalidLogRule
+try:
+  from re import _parser as sre_parse
+except ImportError:
+  # Python < 3.11
+  import sre_parse
+
+
+# Shipped next to this module, so it's found whatever the working directory
+LOG_RULES = Path(__file__).resolve().parent / "log_rules.json"
+
+# Sample lines kept per rule
+SAMPLES = 3
+
+# Classic syslog 'Oct 17 12:34:56' or structured syslog ISO 8601 timestamps
+TIMESTAMP = re.compile(rb"^(?:\w{3} [ \d]\d \d\d:\d\d:\d\d|\d{4}-\d\d-\d\dT[\d:.]+(?:Z|[+-]\d\d:?\d\d)?)")
+
+# Group numbers would shift if rules were joined into one pattern
+BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+# Shorter required literals hit too many lines to be worth prefiltering on
+MIN_LITERAL = 3
+
+
+def _strength(literals):
+  # Each extra alternative is another way for an unrelated line to get through
+  return min(len(literal) for literal, _ in literals) - 2 * (len(literals) - 1)
+
+
+def _required_literals(items, ignore_case=False):
+  """
+  Literals at least one of which appears in every match of a parsed regex, as
+  [(bytes, ignore_case), ...], or None when no such set could be found.
+  Literals that must match case insensitively are lowercased
+  """
+  best = None
+  run = bytearray()
+
+  def consider(literals):
+    nonlocal best
+    if literals and all(len(literal) >= MIN_LITERAL for literal, _ in literals) and (
+        best is None or _strength(literals) > _strength(best)):
+      best = literals
+
+  def run_literal():
+    # Spaces are too common to be worth searching for
+    literal = bytes(run).strip()
+    return [(literal.lower() if ignore_case else literal, ignore_case)] if literal else None
+
+  for op, av in items:
+    if op is sre_parse.LITERAL:
+      run.append(av)
+      continue
+    consider(run_literal())
+    run.clear()
+    if op is sre_parse.SUBPATTERN:
+      _, add_flags, del_flags, sub = av
+      sub_ignore_case = bool((ignore_case or add_flags & re.IGNORECASE) and not del_flags & re.IGNORECASE)
+      consider(_required_literals(sub, sub_ignore_case))
+    elif op is sre_parse.BRANCH:
+      branches = [_required_literals(branch, ignore_case) for branch in av[1]]
+      if all(branches):
+        consider([literal for branch in branches for literal in branch])
+    elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+      consider(_required_literals(av[2], ignore_case))
+  consider(run_literal())
+  return best
+
+
+class LogRule(object):
+  __slots__ = ('name', 'pattern', 'source', 'regex', 'literals')
+
+  def __init__(self, name, spec):
+    self.name = name
+    if not isinstance(spec, dict) or len(spec.keys() & {'regex', 'literal'}) != 1:
+      raise InvalidLogRule(name, "needs exactly one of 'regex' or 'literal'")
+    unknown = spec.keys() - {'regex', 'literal', 'ignore_case'}
+    if unknown:
+      raise InvalidLogRule(name, f"unknown key(s) {sorted(unknown)}")
+    self.pattern = spec.get('regex', spec.get('literal'))
+    if not isinstance(self.pattern, str) or not self.pattern:
+      raise InvalidLogRule(name, "pattern must be a non-empty string")
+    source = re.escape(self.pattern) if 'literal' in spec else self.pattern
+    if BACKREFERENCE.search(source):
+      raise InvalidLogRule(name, "backreferences aren't supported")
+    if spec.get('ignore_case'):
+      source = f"(?i:{source})"
+    self.source = source.encode()
+    try:
+      self.regex = re.compile(self.source, re.MULTILINE)
+    except re.error as err:
+      raise InvalidLogRule(name, f"'{self.pattern}' is not a valid regex: {err}")
+    parsed = sre_parse.parse(self.source)
+    self.literals = _required_literals(parsed.data, bool(parsed.state.flags & re.IGNORECASE))
+
+
+class RuleHits(object):
+  __slots__ = ('count', 'first', 'last', 'samples')
+
+  def __init__(self):
+    self.count = 0
+    self.first = None
+    self.last = None
+    self.samples = []
+
+  def add(self, line):
+    self.count += 1
+    match = TIMESTAMP.match(line)
+    if match:
+      timestamp = match.group().decode()
+      if self.first is None:
+        self.first = timestamp
+      self.last = timestamp
+    if len(self.samples) < SAMPLES:
+      self.samples.append(line.decode(errors='replace'))
+
+
+class LogHits(object):
+  """Per device results of scanning logs with a LogRules"""
+
+  def __init__(self, rules):
+    self._rules = rules
+    self.lines = 0
+    self.hits = {rule.name: RuleHits() for rule in rules}
+
+  def scan(self, block):
+    """Check a block of complete lines, as handed out by logscan.scan_lines"""
+    self.lines += block.count(b'\n') + 1
+    self._rules.scan(block, self.hits)
+
+  def matched(self):
+    """[(rule name, RuleHits), ...] for the rules that matched, in rules file order"""
+    return [(name, hits) for name, hits in self.hits.items() if hits.count]
+
+
+def _trie_pattern(node):
+  children = sorted((byte, child) for byte, child in node.items() if byte is not None)
+  branches = [re.escape(bytes([byte])) + _trie_pattern(child) for byte, child in children]
+  if not branches:
+    return b""
+  pattern = branches[0] if len(branches) == 1 else b"(?:" + b"|".join(branches) + b")"
+  # A literal ending here that others carry on from
+  return b"(?:" + pattern + b")?" if None in node else pattern
+
+
+def _alternation(literals):
+  """
+  One regex matching any of literals. The literals are arranged as a trie so
+  each position is tried against one branch per distinct byte instead of every
+  literal in turn, and the longest literal at a position wins
+  """
+  if not literals:
+    return None
+  trie = {}
+  for literal in literals:
+    node = trie
+    for byte in literal:
+      node = node.setdefault(byte, {})
+    node[None] = True
+  return re.compile(_trie_pattern(trie))
+
+
+class LogRules(object):
+  """
+  Named log patterns behind a single multi-literal prefilter. Every rule
+  contributes the literals one of which must be in any line it matches, and
+  those are joined into one regex, so each block of lines is searched once
+  however many rules there are. Case insensitive literals are searched for in a
+  lowercased copy of the block. Only lines the prefilter finds are checked with
+  the rules whose literals they contain. Rules without usable literals are
+  searched for on their own
+  """
+
+  def __init__(self, rules):
+    self.rules = rules
+    self._order = {rule: idx for idx, rule in enumerate(rules)}
+    self._by_literal = {}
+    self._unfiltered = []
+    for rule in rules:
+      if rule.literals is None:
+        self._unfiltered.append(rule)
+        continue
+      for literal in rule.literals:
+        self._by_literal.setdefault(literal, set()).add(rule)
+    # Only the longest literal at a position is reported, so it stands in for
+    # the literals it starts with
+    for literal, ignore_case in self._by_literal:
+      for other, other_ignore_case in self._by_literal:
+        if other_ignore_case == ignore_case and other != literal and literal.startswith(other):
+          self._by_literal[(literal, ignore_case)] |= self._by_literal[(other, other_ignore_case)]
+    self._exact = _alternation([literal for literal, ignore_case in self._by_literal if not ignore_case])
+    self._folded = _alternation([literal for literal, ignore_case in self._by_literal if ignore_case])
+
+  def __len__(self):
+    return len(self.rules)
+
+  def __iter__(self):
+    return iter(self.rules)
+
+  def hits(self):
+    return LogHits(self)
+
+  def scan(self, block, hits):
+    # {line start: (line end, rules whose literals are in the line)}
+    candidates = {}
+    searches = [(self._exact, block, False)]
+    if self._folded is not None:
+      searches.append((self._folded, block.lower(), True))
+    for regex, text, ignore_case in searches:
+      search = regex.search if regex is not None else None
+      pos = 0
+      while search is not None:
+        match = search(text, pos)
+        if match is None:
+          break
+        at = match.start()
+        start = text.rfind(b'\n', 0, at) + 1
+        candidate = candidates.get(start)
+        if candidate is None:
+          end = text.find(b'\n', at)
+          candidate = candidates[start] = (end if end >= 0 else len(text), set())
+        candidate[1].update(self._by_literal[(match.group(), ignore_case)])
+        # Step one byte past each hit so literals overlapping it are found too
+        pos = at + 1
+    for rule in self._unfiltered:
+      for match in rule.regex.finditer(block):
+        start = block.rfind(b'\n', 0, match.start()) + 1
+        end = block.find(b'\n', match.start())
+        candidates.setdefault(start, (end if end >= 0 else len(block), set()))[1].add(rule)
+
+    for start in sorted(candidates):
+      end, rules = candidates[start]
+      line = block[start:end]
+      for rule in sorted(rules, key=self._order.get):
+        if rule.regex.search(line):
+          hits[rule.name].add(line)
+
+
+def load_log_rules(path=LOG_RULES):
+  """Parse and compile log_rules.json once. Bad rules fail at startup rather than being ignored"""
+  with open(path, "r") as f:
+    json_rules = json.load(f)
+  return LogRules([LogRule(name, spec) for name, spec in json_rules.items()])
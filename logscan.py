@@ -0,0 +1,159 @@
+import re
+import time
+import zlib
+from itertools import chain
+from jnpr.junos.exception import RpcError
+from replay import local_copies, read_file
+
+
+MESSAGES = "/var/log/messages"
+
+# Bytes from the start of a log saved with its watermark to recognize the file
+HEAD_BYTES = 256
+
+# Junos rotates messages into messages.0.gz, messages.1.gz, ... newest first
+ROTATED_SUFFIX = re.compile(r"^\.(\d+)\.gz$")
+
+
+def log_files(dev, path=MESSAGES):
+  """Return {path: size} for path and its rotated copies, {} when the device can't list them"""
+  try:
+    reply = dev.rpc.file_list(path=f"{path}*", detail=True)
+  except RpcError:
+    return {}
+  files = {}
+  for directory in reply.iter('directory'):
+    base = (directory.get('name') or directory.findtext('directory-name') or path.rsplit('/', 1)[0]).strip()
+    for info in directory.iter('file-information'):
+      name = (info.findtext('file-name') or '').strip()
+      size = info.findtext('file-size')
+      if not name or size is None:
+        continue
+      files[name if name.startswith('/') else f"{base.rstrip('/')}/{name}"] = int(size)
+  return files
+
+
+def rotated_logs(files, path=MESSAGES):
+  """Rotated copies of path found in files, newest first"""
+  rotated = []
+  for name in files:
+    match = ROTATED_SUFFIX.match(name[len(path):]) if name.startswith(path) else None
+    if match:
+      rotated.append((int(match.group(1)), name))
+  return [name for _, name in sorted(rotated)]
+
+
+def gunzip(chunks):
+  """Decompress a stream of gzip chunks as they arrive"""
+  decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+  for chunk in chunks:
+    while chunk:
+      data = decompressor.decompress(chunk)
+      if data:
+        yield data
+      chunk = decompressor.unused_data
+      if chunk:
+        # Concatenated gzip members
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+  data = decompressor.flush()
+  if data:
+    yield data
+
+
+def _peek(chunks, nbytes):
+  """Return (first nbytes, chunks) without losing anything from the stream"""
+  seen = []
+  size = 0
+  for chunk in chunks:
+    seen.append(chunk)
+    size += len(chunk)
+    if size >= nbytes:
+      break
+  head = b''.join(seen)
+  return head[:nbytes], chain([head], chunks)
+
+
+def _skip(chunks, nbytes):
+  for chunk in chunks:
+    if nbytes >= len(chunk):
+      nbytes -= len(chunk)
+      continue
+    yield chunk[nbytes:]
+    nbytes = 0
+
+
+def _first_line(data):
+  end = data.find(b'\n')
+  return data if end < 0 else data[:end + 1]
+
+
+def scan_lines(chunks, on_lines, final=True):
+  """
+  Call on_lines with each run of complete lines, without the last newline, in a
+  stream of chunks. Handing over whole blocks lets the checks search many lines
+  at once. Returns the number of bytes up to and including the last newline. A
+  trailing line without a newline is only passed on when final, since the
+  device may still be writing it
+  """
+  consumed = 0
+  rest = b''
+  for chunk in chunks:
+    data = rest + chunk if rest else chunk
+    end = data.rfind(b'\n')
+    if end < 0:
+      rest = data
+      continue
+    on_lines(data[:end])
+    consumed += end + 1
+    rest = data[end + 1:]
+  if final and rest:
+    on_lines(rest)
+    consumed += len(rest)
+  return consumed
+
+
+def scan_log(dev, on_lines, host, watermarks=None, path=MESSAGES, rotated=0, full=False):
+  """
+  Stream the lines of path written since the last scan of host through on_lines.
+  When the file was rotated since then, the rest of the old file is picked up
+  from its newest rotated copy first. rotated also scans that many rotated
+  copies in full, oldest first, and full ignores the watermark.
+
+  Returns [(path, offset, bytes scanned), ...] in the order the files were scanned
+  """
+  # One SCP copy of each file for the head and the scan, where SFTP is off
+  with local_copies(dev):
+    files = log_files(dev, path)
+    size = files.get(path)
+    previous = rotated_logs(files, path)
+    head = _first_line(b''.join(read_file(dev, path, 0, HEAD_BYTES)))
+    mark = None if full or watermarks is None else watermarks.get(host, path)
+
+    # (rotated copy, offset to scan from, head it must start with)
+    scans = [(name, 0, None) for name in reversed(previous[:rotated])]
+    offset = 0
+    if mark and mark[0]:
+      mark_offset, mark_head = mark
+      if bytes(mark_head) == head and (size is None or mark_offset <= size):
+        offset = mark_offset
+      elif previous and previous[0] not in previous[:rotated]:
+        scans.append((previous[0], mark_offset, bytes(mark_head)))
+
+    scanned = []
+    for name, start, expected_head in scans:
+      chunks = gunzip(read_file(dev, name))
+      if expected_head is not None:
+        # Only carry on from the watermark when this is the file it was taken on
+        rotated_head, chunks = _peek(chunks, len(expected_head))
+        if rotated_head != expected_head:
+          continue
+      scanned.append((name, start, scan_lines(_skip(chunks, start), on_lines)))
+
+    if size is None or offset < size:
+      consumed = scan_lines(read_file(dev, path, offset), on_lines, final=False)
+    else:
+      consumed = 0
+    scanned.append((path, offset, consumed))
+    if watermarks is not None:
+      watermarks.set(host, path, offset + consumed, head, time.time())
+    return scanned
@@ -1,4 +1,37 @@
-from jnpr.junos.factory import loadyaml
+import json
+import os
 from os.path import splitext
+import yaml
+from jnpr.junos.factory.factory_loader import FactoryLoader
 _YAML_ = splitext(__file__)[0] + '.yml'
-globals().update(loadyaml(_YAML_))
+
+# Parsing the YAML is most of the cost of importing the tables, so the parsed
+# definitions are kept as JSON and reused until the YAML changes
+_CACHE_ = os.path.join(os.path.dirname(__file__), '__pycache__', 'OpTables.json')
+
+
+def _definitions(path, cache_path):
+  stat = os.stat(path)
+  source = [stat.st_mtime_ns, stat.st_size]
+  try:
+    with open(cache_path, 'r') as f:
+      cached = json.load(f)
+    if cached['source'] == source:
+      return cached['definitions']
+  except (OSError, ValueError, KeyError):
+    pass
+  with open(path, 'r') as f:
+    definitions = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+  try:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp = f"{cache_path}.{os.getpid()}"
+    with open(tmp, 'w') as f:
+      json.dump({'source': source, 'definitions': definitions}, f)
+    os.replace(tmp, cache_path)
+  except OSError:
+    # Read-only installs parse the YAML every time
+    pass
+  return definitions
+
+
+globals().update(FactoryLoader().load(_definitions(_YAML_, _CACHE_)))
@@ -0,0 +1,203 @@
+from jnpr.junos.exception import RpcError
+from jnpr.junos.jxml import remove_namespaces_and_spaces, rpc_error
+from lxml import etree
+from myTables.OpTables import EthPortExtTable, EthPortSnapshotTable
+from rpcplan import stream_rpc, table_request
+
+
+ALL_INTERFACES = '[fgxe][et]*'
+
+# Ports on the same PIC are fetched with one wildcard once this many are selected
+PIC_BATCH_MIN = 4
+
+# Past this many targeted RPCs the ports are fetched with one wildcard per FPC,
+# and past this many of those a single fetch of every port is cheaper
+MAX_TARGETED_RPCS = 16
+
+
+def _pic(name):
+  return name.rsplit('/', 1)[0] if '/' in name else name
+
+
+def _fpc(name):
+  return name.split('/', 1)[0]
+
+
+def interface_batches(ifaces):
+  """
+  Turn a list of interface names into interface_name RPC arguments, one per
+  interface or one wildcard per PIC when enough of its ports are selected.
+  When that's more than MAX_TARGETED_RPCS, the batches of an FPC with more than
+  one are replaced by one wildcard for the FPC
+  """
+  pics = {}
+  for name in ifaces:
+    pics.setdefault(_pic(name), []).append(name)
+  batches = []
+  for pic, names in pics.items():
+    if len(names) >= PIC_BATCH_MIN:
+      batches.append(f"{pic}/*")
+    else:
+      batches.extend(names)
+  if len(batches) <= MAX_TARGETED_RPCS:
+    return batches
+
+  fpcs = {}
+  for batch in batches:
+    fpcs.setdefault(_fpc(batch), []).append(batch)
+  return [f"{fpc}/*" if len(fpc_batches) > 1 else fpc_batches[0] for fpc, fpc_batches in fpcs.items()]
+
+
+def interface_requests(ifaces=None):
+  """interface_name of every RPC fetch_interfaces() makes for ifaces"""
+  batches = interface_batches(ifaces) if ifaces else []
+  if not batches or len(batches) > MAX_TARGETED_RPCS:
+    return [ALL_INTERFACES]
+  return batches
+
+
+def full_fetch(ifaces):
+  """Whether the interfaces selected by ifaces are fetched along with every other one"""
+  return bool(ifaces) and interface_requests(ifaces) == [ALL_INTERFACES]
+
+
+def fetch_interfaces(dev, table_cls, ifaces=None):
+  """
+  Return the RPC reply for table_cls limited to ifaces. Each batch is its own RPC
+  and the items are merged under one root so the table sees a single reply
+  """
+  batches = interface_requests(ifaces)
+  if batches == [ALL_INTERFACES]:
+    return table_cls(dev).get(interface_name=ALL_INTERFACES).xml
+
+  root = None
+  for batch in batches:
+    try:
+      xml = table_cls(dev).get(interface_name=batch).xml
+    except RpcError:
+      # Interface doesn't exist on this device or has nothing to report
+      continue
+    if not isinstance(xml, etree._Element):
+      continue
+    if root is None:
+      root = etree.Element(xml.tag)
+    root.extend(xml.xpath(table_cls.ITEM_XPATH))
+  if root is None:
+    root = etree.Element('interface-information')
+  return root
+
+
+def interface_table(dev, table_cls, ifaces=None):
+  return table_cls(dev, xml=fetch_interfaces(dev, table_cls, ifaces)).get()
+
+
+def stream_items(reply, tag, cmd=None):
+  """
+  Yield every tag element of a StreamedReply as soon as it's parsed, with
+  namespaces and spaces removed like Table.get() does. Each element is freed
+  once the next one is asked for, along with everything parsed before it.
+  Raises RpcError once the reply is read if it carried an error
+  """
+  parser = etree.XMLPullParser(events=('end',), tag=(f"{{*}}{tag}", '{*}rpc-error'), huge_tree=True)
+
+  def parsed():
+    for chunk in reply:
+      parser.feed(chunk)
+      yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+  errors = []
+  for _, elem in parsed():
+    remove_namespaces_and_spaces(elem)
+    if elem.tag == 'rpc-error':
+      # Kept, the rest of the reply is read for its warnings like ncclient would
+      if elem.findtext('error-severity') == 'error':
+        errors.append(elem)
+      continue
+    yield elem
+    elem.clear()
+    parent = elem.getparent()
+    while elem.getprevious() is not None:
+      del parent[0]
+  if errors:
+    raise RpcError(cmd=cmd, rsp=errors[0], errs=[rpc_error(error) for error in errors])
+
+
+class Interface(object):
+  """What ints() checks of one physical interface, without the XML it came from"""
+
+  __slots__ = ('name', 'admin', 'oper', 'description', 'ae', '_fields', '_values')
+
+  def __init__(self, name, admin, oper, description, ae, fields, values):
+    self.name = name
+    self.admin = admin
+    self.oper = oper
+    self.description = description
+    self.ae = ae
+    self._fields = fields
+    self._values = values
+
+  def counters(self, key):
+    """{counter: value} of the counters of group key the device reported"""
+    return {counter: value for (group, counter), value in zip(self._fields, self._values)
+            if group == key and value is not None}
+
+
+class InterfaceStream(object):
+  """
+  Reads `get-interface-information extensive` one physical-interface element at
+  a time as the reply is parsed, instead of building the whole reply and a table
+  per view over it. counters maps each thresholds.json group to (table class,
+  counter names), and only those counters are picked out of each element by the
+  table's view. Iterating yields an Interface per physical interface. Devices
+  that can't stream their replies are read from the whole reply
+  """
+
+  def __init__(self, dev, counters, ifaces=None):
+    self._dev = dev
+    self._ifaces = ifaces
+    self._eth = EthPortSnapshotTable(dev)
+    self._ext = EthPortExtTable(dev)
+    self._groups = []
+    fields = []
+    for key, (table_cls, names) in counters.items():
+      names = [name for name in names if name in table_cls.VIEW.FIELDS]
+      self._groups.append((table_cls(dev), names))
+      fields.extend((key, name) for name in names)
+    # Shared by every Interface, which only keeps the values
+    self.fields = tuple(fields)
+
+  def _elements(self, batch):
+    request = table_request(EthPortSnapshotTable, interface_name=batch)
+    reply = stream_rpc(self._dev, request)
+    if reply is not None:
+      yield from stream_items(reply, EthPortSnapshotTable.ITEM_XPATH, cmd=request)
+      return
+    xml = EthPortSnapshotTable(self._dev).get(interface_name=batch).xml
+    if isinstance(xml, etree._Element):
+      yield from xml.xpath(EthPortSnapshotTable.ITEM_XPATH)
+
+  def _interface(self, elem):
+    eth = self._eth.VIEW(self._eth, elem)
+    ae = None
+    for logical in self._ext.VIEW(self._ext, elem).logical:
+      if logical.address_family_name == "aenet":
+        ae = logical.ae_bundle_name
+    values = []
+    for table, names in self._groups:
+      view = table.VIEW(table, elem)
+      values.extend(view[name] for name in names)
+    return Interface(eth.name, eth['admin'], eth['oper'], eth.description, ae, self.fields, tuple(values))
+
+  def __iter__(self):
+    batches = interface_requests(self._ifaces)
+    for batch in batches:
+      try:
+        for elem in self._elements(batch):
+          yield self._interface(elem)
+      except RpcError:
+        if batches == [ALL_INTERFACES]:
+          raise
+        # Interface doesn't exist on this device or has nothing to report
+        continue
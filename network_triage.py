@@ -29,38 +29,49 @@
 
 import argparse
 import getpass
-import json
-import os
 import re
+import signal
 import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime, timezone
+from functools import partial
 from math import floor, ceil
 from pathlib import Path
+from agent import DEFAULT_SOCKET, IDLE_TIMEOUT, AgentClient, AgentServer, FileCache, SessionPool
+from bundles import BundleWriter, format_summary, merge_bundles, parse_shard, shard_of
+from exceptions import AgentError, BundleError
+from factcache import CACHE_TTL, cached_facts_device
+from history import (BgpPeerStates, CounterHistory, FactsCache, HmcCache, InventoryCache, LogWatermarks,
+    counter_increase)
+from hosts import load_inventory
+from logrules import LOG_RULES, load_log_rules
+from output import HostOutput
+from records import CRITICAL, INFO, NO_RECORDS, WARNING, HostRecords, RecordList, RecordWriter
+from rpcplan import RpcPlan, planned_device
+from thresholds import load_thresholds
 from validate import validate_bool, validate_choice, validate_int, validate_password, validate_str
-from ansible.parsing.dataloader import DataLoader
-from ansible.inventory.manager import InventoryManager
-from ansible.vars.manager import VariableManager
 from colorama import Fore, Style
-from jnpr.junos import Device
-from jnpr.junos.exception import ConnectError, ProbeError, ConnectAuthError
-from jnpr.junos.op.ospf import OspfNeighborTable
-from jnpr.junos.op.routes import RouteSummaryTable
-from jnpr.junos.op.fpc import FpcInfoTable, FpcHwTable
-from jnpr.junos.op.phyport import PhyPortErrorTable
-from jnpr.junos.utils.scp import SCP
-from myTables.OpTables import (PortFecTable, PhyPortDiagTable, EthMacStatTable, EthPcsStatTable,
-    EthPortExtTable, EthPortTable, bgpSummaryTable, bgpTable, OspfInterfaceTable,
-    HMCTable)
+# PyEZ (with ncclient, paramiko and lxml) and the table definitions take most of
+# the startup time, so they're imported by the operations that use them
 
 
 OLD_MEMORY_VALUES = [0x0090, 0x009a, 0x009b]
 
+# Per host outcome used to build the summary at the end of a run
+HOST_SUCCESS = 'success'
+HOST_SKIPPED = 'skipped'
+HOST_FAILED = 'failed'
+HOST_AUTH_FAILED = 'auth_failed'
+HOST_TIMED_OUT = 'timed_out'
 
-def _reached_threshold(actual, threshold):
-    oper, val = threshold.split()
-    if(eval(actual + oper + val)):
-        return True
-    return False
+# --instance value that runs ospf against every routing instance
+ALL_INSTANCES = 'all'
+
+# Instance types OSPF can run in. The master instance is a forwarding one
+OSPF_INSTANCE_TYPES = {'forwarding', 'non-forwarding', 'virtual-router', 'vrf'}
 
 
 def _create_header(name):
@@ -74,11 +85,111 @@ def _print_if_msg(msg):
         print(msg)
 
 
-def ints(dev, ifaces=None):
+def _counter_tables():
+    from jnpr.junos.op.phyport import PhyPortErrorTable
+    from myTables.OpTables import EthMacStatTable, EthPcsStatTable, PortFecTable
+
+    # The table whose view each thresholds.json group is checked against in ints()
+    return {
+        'phy_errs': PhyPortErrorTable,
+        'fec_errs': PortFecTable,
+        'pcs_stats': EthPcsStatTable,
+        'mac_stats': EthMacStatTable,
+    }
+
+
+def _load_thresholds(path="thresholds.json"):
+    # Counters each thresholds.json group may reference
+    counters = {key: table_cls.VIEW.FIELDS for key, table_cls in _counter_tables().items()}
+    return load_thresholds(path, counters=counters)
+
+
+def _interface_stream(dev, thresholds, ifaces=None):
+    from myTables.snapshot import InterfaceStream
+
+    # Only the counters with a threshold are read
+    counters = {key: (table_cls, [threshold.counter for threshold in thresholds.get(key, ())])
+                for key, table_cls in _counter_tables().items()}
+    return InterfaceStream(dev, counters, ifaces)
+
+
+def _print_full_fetch(ifaces):
+    from myTables.snapshot import full_fetch
+
+    if full_fetch(ifaces):
+        print(f"{Fore.YELLOW}The {len(ifaces)} selected interfaces span too many FPCs for targeted RPCs, "
+              f"fetching every interface{Style.RESET_ALL}\n")
+
+
+def _get_lldp_neighbors(dev):
+    from myTables.OpTables import LldpNeighborNonElsTable, LldpNeighborTable
+
+    # Gather LLDP info for every port in one RPC call and index it by local
+    # interface
+    # Support Non-ELS RPC call
+    if dev.facts['switch_style'] == 'VLAN':
+        neighbors = LldpNeighborNonElsTable(dev).get()
+    # Support ELS RPC call
+    else:
+        neighbors = LldpNeighborTable(dev).get()
+    lldp_neighbors = {}
+    for neighbor in neighbors:
+        # Entries without a local interface can't be matched to a port
+        if neighbor.name is None:
+            continue
+        # Non-ELS reports the logical unit i.e. xe-0/0/0.0
+        lldp_neighbors.setdefault(neighbor.name.split('.')[0], neighbor)
+    return lldp_neighbors
+
+
+def _check_counters(iface, counters, group_thresholds, prev_run, timestamp):
+    """
+    Check the counters of one interface against their thresholds. Yields
+    (threshold, value, prev, increase, reset, seconds, msg) for every counter
+    sampled. prev is the (ts, value) of the previous sample or None, and msg
+    describes the breach when the threshold is reached, else None
+    """
+    for threshold in group_thresholds:
+        subkey = threshold.counter
+        value = counters.get(subkey)
+        if value is None:
+            continue
+
+        prev = prev_run.get((iface, subkey))
+        increase = reset = seconds = None
+        if prev:
+            prevtimestamp, prevvalue = prev
+            seconds = timestamp - prevtimestamp
+            increase, reset = counter_increase(prevvalue, value)
+
+        msg = None
+        # Rate thresholds only apply once there is a previous sample to compare
+        # against
+        if threshold.is_rate:
+            if prev and seconds > 0:
+                rate = threshold.rate(increase, seconds)
+                if threshold.reached(rate):
+                    msg = f"rate of {rate:0.2f}/{threshold.unit} (value {str(value)})"
+        elif value and threshold.reached(value):
+            msg = f"value of {str(value)}"
+        yield threshold, value, prev, increase, reset, seconds, msg
+
+
+def _dbm(value):
+    """Optic power or threshold in dBm as a float, -inf without light and None when missing"""
+    try:
+        return float(str(value).replace(' ', '')) if value is not None else None
+    except ValueError:
+        return None
+
+
+def ints(dev, ifaces=None, thresholds=None, history=None, records=NO_RECORDS):
+    from myTables.OpTables import PhyPortDiagTable
+    from myTables.snapshot import interface_table
 
     def print_interface_header():
-        if ae:
-            print(f"INTERFACE: {eth.name} which is part of ae bundle {ae}")
+        if eth.ae:
+            print(f"INTERFACE: {eth.name} which is part of ae bundle {eth.ae}")
         else:
             print(f"INTERFACE: {eth.name}")
         if eth.description:
@@ -86,22 +197,44 @@ def ints(dev, ifaces=None):
         if lldp_print_string:
             print(lldp_print_string)
 
-    def _check_optic(optic, header, print_interface):
+    def _check_optic(optic, header, print_interface, lane=None):
         optic_rx_msg = optic_tx_msg = ""
+        problems = []
         if(optic.rx_power_low_alarm or optic.rx_power_high_alarm):
             optic_rx_msg = f"{Fore.RED}    **Receiver power is too high or low. Interface possibly off**{Style.RESET_ALL}"
+            problems.append((CRITICAL, 'rx_power_alarm'))
         elif(optic.rx_power_low_warn or optic.rx_power_high_warn):
             optic_rx_msg = f"{Fore.RED}    **Receiver power is marginal. Possible errors**{Style.RESET_ALL}"
+            problems.append((WARNING, 'rx_power_warning'))
         if(optic.bias_current_high_alarm or optic.bias_current_low_alarm or
-             optic.bias_current_high_warn or optic.bias_current_low_warn or
-             optic.tx_power_high_alarm or optic.tx_power_low_alarm or
+             optic.tx_power_high_alarm or optic.tx_power_low_alarm):
+            optic_tx_msg = f"{Fore.RED}    **Transmit Problems. Please check SFP.**{Style.RESET_ALL}"
+            problems.append((CRITICAL, 'tx_alarm'))
+        elif(optic.bias_current_high_warn or optic.bias_current_low_warn or
              optic.tx_power_high_warn or optic.tx_power_low_warn):
             optic_tx_msg = f"{Fore.RED}    **Transmit Problems. Please check SFP.**{Style.RESET_ALL}"
+            problems.append((WARNING, 'tx_warning'))
+        for severity, problem in problems:
+            records.emit('ints', 'optic', severity, interface=eth.name, lane=lane, problem=problem,
+                         rx_power=optic.rx_optic_power, tx_power=optic.tx_optic_power,
+                         module_temp=phy_optic.module_temperature, module_voltage=phy_optic.module_voltage, **link)
+        rx_power = _dbm(optic.rx_optic_power) if records else None
+        if rx_power is not None:
+            # Margin is how far the receive power is above the low warning
+            # threshold of the module
+            low_warn = _dbm(phy_optic.rx_power_low_warn_threshold)
+            if low_warn is None:
+                low_warn = _dbm(phy_optic.rx_power_low_alarm_threshold)
+            no_light = rx_power == float('-inf')
+            records.emit('ints', 'optic_level', INFO, interface=eth.name, lane=lane,
+                         rx_power=None if no_light else rx_power, low_warn_threshold=low_warn,
+                         margin=None if no_light or low_warn is None else round(rx_power - low_warn, 2),
+                         no_light=no_light, **link)
         if optic_rx_msg or optic_tx_msg:
             if print_interface:
                 print_interface_header()
                 print_interface = False
-                print(f"Admin State: {eth['admin']}    Oper State: {eth['oper']}")
+                print(f"Admin State: {eth.admin}    Oper State: {eth.oper}")
             print(header)
             print(f"        RX Optic Power: {optic.rx_optic_power}    TX Optic Power: {optic.tx_optic_power}")
             print(f"        Module Temp: {phy_optic.module_temperature}    Module Voltage: {phy_optic.module_voltage}")
@@ -109,110 +242,68 @@ def ints(dev, ifaces=None):
             _print_if_msg(optic_tx_msg)
         return print_interface
 
-    def _save_curr_run(hostname, json_dict):
-        fname = f"counters/{hostname}_prev_run.json"
+    if thresholds is None:
         try:
-            prevfile = Path(fname)
-            if prevfile.exists():
-                if prevfile.is_file():
-                    os.remove(fname)
-                elif prevfile.is_dir():
-                    os.rmdir(fname)
-            with open(fname, "w") as f:
-                json.dump(json_dict, f)
-            os.chmod(fname, 0o664)
+            thresholds = _load_thresholds()
         except Exception as err:
-            print("Unable to save counters")
-            print(err.__class__.__name__, err)
+            print(f"Unable to load thresholds: {err}")
+            print("Skipping interface troubleshooting...")
+            return
 
-    def _get_prev_run(hostname):
-        try:
-            with open(f"counters/{hostname}_prev_run.json", "r") as f:
-                return json.load(f)
-        except Exception as err:
-            print(f"No existing counters for device {hostname}")
-            return None
+    hostname = dev.facts['hostname']
 
+    timestamp = datetime.now(timezone.utc).timestamp()
+    prev_run = {}
     try:
-        with open("thresholds.json", "r") as f:
-            json_thresholds = json.load(f)
+        if history is None:
+            history = CounterHistory()
+        prev_run = history.previous(hostname, timestamp)
     except Exception as err:
-        print("JSON load error")
-        print("Skipping interface troubleshooting...")
-        return
-
-    hostname = dev.facts['hostname']
-
-    json_prev_run = _get_prev_run(hostname)
-    json_curr_run = {}
-
-    timestamp = datetime.now(timezone.utc)
-    json_curr_run['timestamp'] = str(timestamp)
-
-    optics = PhyPortDiagTable(dev).get()
-    phy_errs = PhyPortErrorTable(dev).get()
-    fec_errs = PortFecTable(dev).get()
-    pcs_stats = EthPcsStatTable(dev).get()
-    mac_stats = EthMacStatTable(dev).get()
-    eths = EthPortTable(dev).get()
-    eth_exts = EthPortExtTable(dev).get()
+        print("Unable to open counter history")
+        print(err.__class__.__name__, err)
+        history = None
+    if not prev_run:
+        print(f"No existing counters for device {hostname}")
+    # Every monitored counter is saved, not only the ones that reached a
+    # threshold, so rates can be worked out over any window later
+    curr_run = []
+
+    # When an interface group is given only those interfaces are requested from
+    # the device
+    optics = interface_table(dev, PhyPortDiagTable, ifaces)
+    lldp_neighbors = _get_lldp_neighbors(dev)
 
     print(f"{Fore.YELLOW}{_create_header('begin troubleshoot interfaces')}{Style.RESET_ALL}\n")
+    _print_full_fetch(ifaces)
 
-    for eth in eths:
+    # Every check below comes from the one extensive RPC reply, read an interface
+    # at a time
+    for eth in _interface_stream(dev, thresholds, ifaces):
         # if user provides an interface group, then we only analyze ifaces in that
         # group
         if ifaces and not eth.name in ifaces:
             continue
 
-        if eth['admin'] == 'down':
+        if eth.admin == 'down':
             print(f"{Fore.GREEN}{eth.name} is admin down, skipping remaining checks{Style.RESET_ALL}")
+            records.emit('ints', 'admin_down', INFO, interface=eth.name)
             continue
 
-        # Retreive AE info if exists to later print out for user along with Interface
-        # name
-        logicals = eth_exts[eth.name].logical
-        ae = None
-        for logical in logicals:
-            if logical.address_family_name == "aenet":
-                ae = logical.ae_bundle_name
-
-        # Gather LLDP info via RPC calls
-        # Support Non-ELS RPC call
-        if dev.facts['switch_style'] == 'VLAN':
-            lldp = dev.rpc.get_lldp_interface_neighbors_information(interface_name=eth.name)
-        # Support ELS RPC call
-        else:
-            lldp = dev.rpc.get_lldp_interface_neighbors(interface_device=eth.name)
-
         lldp_print_string = ""
-        # Future Warning said to use __len__ method instead of the boolean value
-        if len(lldp) > 0:
-
-            lldp_neigh_sys = lldp.xpath('//lldp-remote-system-name')
-            if lldp_neigh_sys:
-                lldp_neigh_sys = lldp_neigh_sys[0].text
-                lldp_print_string = f"    LLDP Neighbor Name: {lldp_neigh_sys}"
-
-            lldp_if_type = lldp.xpath('//lldp-remote-port-id-subtype')
-            if lldp_if_type:
-                lldp_if_type = lldp_if_type[0].text
-
-            lldp_neigh_if = lldp.xpath('//lldp-remote-port-id')
-            if lldp_neigh_if:
-                lldp_neigh_if = lldp_neigh_if[0].text
-                if lldp_if_type in ('Interface name', 'Locally assigned'):
-                    lldp_print_string = lldp_print_string + f"    Remote Iface: {lldp_neigh_if}"
-
-            lldp_neigh_if_desc = lldp.xpath('//lldp-remote-port-description')
-            if lldp_neigh_if_desc:
-                lldp_neigh_if_desc = lldp_neigh_if_desc[0].text
-                if lldp_neigh_if != lldp_neigh_if_desc:
-                    lldp_print_string = lldp_print_string + f"    Remote Iface Descr: {lldp_neigh_if_desc}"
-
-        # Initialze empty dict for json structure to be written later. Must
-        # initialize each element/sub-element
-        json_curr_run[eth.name] = {}
+        neighbor = lldp_neighbors.get(eth.name)
+        if neighbor:
+            if neighbor.remote_sysname:
+                lldp_print_string = f"    LLDP Neighbor Name: {neighbor.remote_sysname}"
+            if neighbor.remote_port_id and neighbor.remote_port_type in ('Interface name', 'Locally assigned'):
+                lldp_print_string = lldp_print_string + f"    Remote Iface: {neighbor.remote_port_id}"
+            if neighbor.remote_port_desc and neighbor.remote_port_id != neighbor.remote_port_desc:
+                lldp_print_string = lldp_print_string + f"    Remote Iface Descr: {neighbor.remote_port_desc}"
+        # Records carry the other end of the link so both ends can be matched up
+        link = {'neighbor': None, 'neighbor_port': None}
+        if neighbor:
+            link['neighbor'] = neighbor.remote_sysname
+            if neighbor.remote_port_type in ('Interface name', 'Locally assigned'):
+                link['neighbor_port'] = neighbor.remote_port_id
 
         # Controls when we print the interface header
         print_interface = True
@@ -229,154 +320,299 @@ def ints(dev, ifaces=None):
                             continue
                     # Handles QSFPs as well
                     header = f"    Optic Diag Lane# {lane.name}:"
-                    print_interface = _check_optic(lane, header, print_interface)
+                    print_interface = _check_optic(lane, header, print_interface, lane=lane.name)
             elif optic.rx_optic_power:
                 header = "    Optic Diag:"
                 print_interface = _check_optic(optic, header, print_interface)
 
-        # Using the main list of interfaces we use the interface name as the key for
-        # each of the tables below This way we can resuse the same thresholds lookup
-        # code mechanism in place
-        tables = [phy_errs, fec_errs, pcs_stats, mac_stats]
-        for table in tables:
-            if eth.name in table:
-                row = table[eth.name]
-                if row.__class__.__name__ == "PortFecView":
-                    key = 'fec_errs'
-                elif row.__class__.__name__ == "PhyPortErrorView":
-                    key = 'phy_errs'
-                elif row.__class__.__name__ == "EthPcsStatView":
-                    key = 'pcs_stats'
-                elif row.__class__.__name__ == "EthMacStatView":
-                    key = 'mac_stats'
-
-                # Always make sure key exists and contains a truthy value
-                for subkey in json_thresholds[key].keys():
-                    if subkey in row.keys() and row[subkey]:
-                        if _reached_threshold(str(row[subkey]), str(json_thresholds[key][subkey])):
-                            json_curr_run[eth.name][subkey] = row[subkey]
-                            if print_interface:
-                                print_interface_header()
-                                print_interface = False
-                            print(f"    {Fore.RED}'{subkey}' threshold is {str(json_thresholds[key][subkey])}"
-                                        f" with value of {str(row[subkey])}{Style.RESET_ALL}")
-
-                            # Load values from previous run if available and print
-                            # difference to user if any
-                            try:
-                                diff = row[subkey] - json_prev_run[eth.name][subkey]
-                                prevtimestamp = datetime.strptime(json_prev_run['timestamp'], '%Y-%m-%d %H:%M:%S.%f')
-                                timediff = timestamp - prevtimestamp
-                                seconds = timediff.total_seconds()
-                                if diff != 0:
-                                    print(f"         {Fore.MAGENTA}previous value was {str(json_prev_run[eth.name][subkey])}"
-                                                f" which is a difference of {str(diff)} from the last run {round(seconds,2):0.2f}s ago"
-                                                f" or about {round(diff/seconds,2):0.2f}/second"
-                                                f"{Style.RESET_ALL}")
-                            except Exception:
-                                pass
-
-        # Delete Interface from json struct if no thresholds were violated (Remove
-        # empty dict)
-        if not json_curr_run[eth.name]:
-            del json_curr_run[eth.name]
-    _save_curr_run(hostname, json_curr_run)
+        # Each thresholds.json group is checked against the counters of its view
+        for key in ('phy_errs', 'fec_errs', 'pcs_stats', 'mac_stats'):
+            counters = eth.counters(key)
+            if counters:
+                checks = _check_counters(eth.name, counters, thresholds.get(key, ()), prev_run, timestamp)
+                for threshold, value, prev, increase, reset, seconds, msg in checks:
+                    subkey = threshold.counter
+                    curr_run.append((eth.name, subkey, value))
+                    if prev and increase and seconds > 0:
+                        records.emit('ints', 'counter', INFO, interface=eth.name, counter=subkey, value=value,
+                                     delta=increase, rate=increase / seconds, seconds=seconds, reset=reset, **link)
+                    if msg is None:
+                        continue
+                    if prev:
+                        prevvalue = prev[1]
+                    records.emit('ints', 'threshold', WARNING, interface=eth.name, counter=subkey, value=value,
+                                 threshold=threshold.text, delta=increase,
+                                 rate=increase / seconds if prev and seconds > 0 else None,
+                                 seconds=seconds, reset=reset, **link)
+
+                    if print_interface:
+                        print_interface_header()
+                        print_interface = False
+                    print(f"    {Fore.RED}'{subkey}' threshold is {threshold.text}"
+                                f" with {msg}{Style.RESET_ALL}")
+
+                    # Print difference from the previous run to user if any
+                    if prev and reset:
+                        print(f"         {Fore.MAGENTA}counter was cleared since the last run {round(seconds,2):0.2f}s ago"
+                                    f" (previous value was {str(prevvalue)}){Style.RESET_ALL}")
+                    elif prev and increase != 0:
+                        print(f"         {Fore.MAGENTA}previous value was {str(prevvalue)}"
+                                    f" which is a difference of {str(increase)} from the last run {round(seconds,2):0.2f}s ago"
+                                    f" or about {round(increase/seconds,2):0.2f}/second"
+                                    f"{Style.RESET_ALL}")
+
+    if history is not None:
+        try:
+            history.record(hostname, timestamp, curr_run)
+        except Exception as err:
+            print("Unable to save counters")
+            print(err.__class__.__name__, err)
     print(f"{Fore.YELLOW}{_create_header('end of troubleshoot interfaces')}{Style.RESET_ALL}\n")
 
 
-def bgp(dev):
+def _report_bgp_neighbor(neighbor, elapsed, records, **extra):
+    """Print and emit one neighbor of bgpTable. elapsed is its elapsed time from the summary"""
+    peer_address = neighbor.peer_address.split("+")[0]
+    peer_state = neighbor.peer_state
+    if peer_state == "Established":
+        records.emit('bgp', 'neighbor', INFO, peer=peer_address, peer_as=neighbor.peer_as, state=peer_state,
+                     local_address=neighbor.local_address, local_interface=neighbor.local_interface,
+                     routes_received=neighbor.route_received, elapsed_secs=elapsed, **extra)
+    else:
+        severity = CRITICAL if peer_state in ("Active", "Connect", "Idle") else WARNING
+        records.emit('bgp', 'neighbor', severity, peer=peer_address, peer_as=neighbor.peer_as, state=peer_state,
+                     local_address=neighbor.local_address, local_interface=neighbor.local_interface, **extra)
+    if peer_state == "Established":
+        print(f"Local ID: {neighbor.local_id:15} Local AS: {neighbor.local_as:7} "
+                    f"Local Address: {neighbor.local_address}\nPeer    ID: {neighbor.peer_id:15} "
+                    f"Peer    AS: {neighbor.peer_as:7} Peer Address: {neighbor.peer_address:17}\n"
+                    f"Num Routes Received: {neighbor.route_received} Local Interface: {neighbor.local_interface}\n"
+                    f"Elapsed Time(secs): {elapsed}\n")
+    elif peer_state == "Active":
+        print(f"{Fore.RED}Neighbor {neighbor.peer_address} in active state, check configuration{Style.RESET_ALL}")
+    elif peer_state == "Connect":
+        print(f"{Fore.RED}Neighbor {neighbor.peer_address} in connect state, check protocol configuration"
+                    f"{Style.RESET_ALL}")
+    elif peer_state == "Idle":
+        print(f"{Fore.RED}Neighbor {neighbor.peer_address} in idle state, check reachability{Style.RESET_ALL}")
+    else:
+        print(f"{Fore.RED}Unxpected state of {peer_state}. Neighbor {neighbor.peer_address} may be in transition,"
+            f"rerun command in a few seconds{Style.RESET_ALL}")
+
+
+def _bgp_summary(dev, peer_states=None, records=NO_RECORDS):
+    """
+    bgp() for --bgp-summary. Every peer is classified from the summary, and only
+    the ones that aren't Established or flapped since the last run are looked at
+    in detail. What each run saw is kept in peer_states for the next one
+    """
+    from myTables.OpTables import bgpSummaryTable, bgpTable
+
+    hostname = dev.facts['hostname']
+    timestamp = datetime.now(timezone.utc).timestamp()
+    previous = {}
+    try:
+        if peer_states is None:
+            peer_states = BgpPeerStates()
+        previous = peer_states.previous(hostname)
+    except Exception as err:
+        print("Unable to open BGP peer states")
+        print(err.__class__.__name__, err)
+        peer_states = None
+
+    peers = {}
+    for peer in bgpSummaryTable(dev).get():
+        peers[peer.peer_address] = (peer.peer_state, peer.flap_count, peer.elapsed_seconds, peer.elapsed_time_secs)
+
+    counts = Counter(state for state, flap_count, elapsed_seconds, elapsed in peers.values())
+    prev_counts = Counter(state for state, flap_count, ts in previous.values())
+    states = sorted(counts.keys() | prev_counts.keys(), key=lambda state: (state != "Established", state))
+    change = {state: f" ({counts[state] - prev_counts[state]:+})" if previous and counts[state] != prev_counts[state]
+              else "" for state in states}
+    print(f"{len(peers)} neighbor(s): " + ", ".join(f"{state} {counts[state]}{change[state]}" for state in states))
+    records.emit('bgp', 'peer_states', INFO if counts.keys() <= {"Established"} else CRITICAL, peers=len(peers),
+                 states=dict(counts), previous_states=dict(prev_counts) if previous else None)
+
+    since = None
+    if previous:
+        since = timestamp - max(ts for state, flap_count, ts in previous.values())
+    else:
+        print(f"No previous BGP peer states for device {hostname}")
+    for peer in previous.keys() - peers.keys():
+        records.emit('bgp', 'neighbor', WARNING, peer=peer, state=None, previous_state=previous[peer][0])
+        print(f"Neighbor {peer} is gone since the last run")
+
+    checked = 0
+    for peer, (state, flap_count, elapsed_seconds, elapsed) in peers.items():
+        prev = previous.get(peer)
+        # A session that came up after the last run went down in between, even if
+        # its flap count was cleared
+        flapped = prev is not None and ((flap_count or 0) > (prev[1] or 0) or (
+            state == "Established" and elapsed_seconds is not None and elapsed_seconds < since))
+        if state == "Established" and not flapped:
+            continue
+        checked += 1
+        if flapped:
+            detail = f"flap count {prev[1]} -> {flap_count}" if (flap_count or 0) > (prev[1] or 0) else \
+                f"up for {elapsed_seconds}s"
+            print(f"{Fore.MAGENTA}Neighbor {peer} flapped since the last run {round(since, 2):0.2f}s ago "
+                  f"({detail}){Style.RESET_ALL}")
+        for neighbor in bgpTable(dev).get(neighbor_address=peer):
+            _report_bgp_neighbor(neighbor, elapsed, records, flapped=flapped, flap_count=flap_count)
+    if not checked:
+        print(f"{Fore.GREEN}Every neighbor is Established"
+              f"{' and none flapped since the last run' if previous else ''}{Style.RESET_ALL}")
+
+    if peer_states is not None:
+        try:
+            peer_states.record(hostname, timestamp, [(peer, state, flap_count)
+                                                     for peer, (state, flap_count, _, _) in peers.items()])
+        except Exception as err:
+            print("Unable to save BGP peer states")
+            print(err.__class__.__name__, err)
+
+
+def bgp(dev, summary=False, peer_states=None, records=NO_RECORDS):
+    from myTables.OpTables import bgpSummaryTable, bgpTable
+
     print(f"{Fore.YELLOW}{_create_header('begin troubleshoot bgp')}{Style.RESET_ALL}\n")
-    neighbors = bgpTable(dev).get()
-    neighsumm = bgpSummaryTable(dev).get()
-    for neighbor in neighbors:
-        peer_address = neighbor.peer_address.split("+")[0]
-        peer_state = neighbor.peer_state
-        if peer_state == "Established":
-            print(f"Local ID: {neighbor.local_id:15} Local AS: {neighbor.local_as:7} "
-                        f"Local Address: {neighbor.local_address}\nPeer    ID: {neighbor.peer_id:15} "
-                        f"Peer    AS: {neighbor.peer_as:7} Peer Address: {neighbor.peer_address:17}\n"
-                        f"Num Routes Received: {neighbor.route_received} Local Interface: {neighbor.local_interface}\n"
-                        f"Elapsed Time(secs): {neighsumm[peer_address].elapsed_time_secs}\n")
-        elif peer_state == "Active":
-            print(f"{Fore.RED}Neighbor {neighbor.peer_address} in active state, check configuration{Style.RESET_ALL}")
-        elif peer_state == "Connect":
-            print(f"{Fore.RED}Neighbor {neighbor.peer_address} in connect state, check protocol configuration"
-                        f"{Style.RESET_ALL}")
-        elif peer_state == "Idle":
-            print(f"{Fore.RED}Neighbor {neighbor.peer_address} in idle state, check reachability{Style.RESET_ALL}")
-        else:
-            print(f"{Fore.RED}Unxpected state of {peer_state}. Neighbor {neighbor.peer_address} may be in transition,"
-                f"rerun command in a few seconds{Style.RESET_ALL}")
+    if summary:
+        _bgp_summary(dev, peer_states=peer_states, records=records)
+    else:
+        neighbors = bgpTable(dev).get()
+        # Indexed once, looking each peer up in the table searches the whole reply
+        elapsed = {peer.peer_address: peer.elapsed_time_secs for peer in bgpSummaryTable(dev).get()}
+        for neighbor in neighbors:
+            _report_bgp_neighbor(neighbor, elapsed.get(neighbor.peer_address.split("+")[0]), records)
 
     print(f"{Fore.YELLOW}{_create_header('end of troubleshoot bgp')}{Style.RESET_ALL}\n")
 
 
-def ospf(dev, instance=None):
-    print(f"{Fore.YELLOW}{_create_header('begin troubleshoot ospf')}{Style.RESET_ALL}\n")
-    if instance:
-        neighbors = OspfNeighborTable(dev).get(instance=instance)
-        interfaces = OspfInterfaceTable(dev).get(instance=instance)
-    else:
-        neighbors = OspfNeighborTable(dev).get()
-        interfaces = OspfInterfaceTable(dev).get()
+def _ospf_instances(instances):
+    # Every routing instance OSPF can run in, from get-instance-information.
+    # Junos' own instances start with '__'
+    names = []
+    for instance in instances.iter('instance-core'):
+        name = (instance.findtext('instance-name') or '').strip()
+        if (name and not name.startswith('__') and
+                (instance.findtext('instance-type') or '').strip() in OSPF_INSTANCE_TYPES):
+            names.append(name)
+    return names
+
+
+def _report_ospf_interfaces(interfaces, neighbors, records, **extra):
+    by_interface = {}
+    for neighbor in neighbors:
+        by_interface.setdefault(neighbor.interface_name, []).append(neighbor)
     for interface in interfaces:
         if interface.passive:
             passive = 'yes'
         else:
             passive = 'no'
+        records.emit('ospf', 'interface', INFO, interface=interface.interface_name,
+                     neighbor_count=interface.neighbor_count, passive=bool(interface.passive), **extra)
         print(f"Interface: {interface.interface_name:21} Neighbor Count: {interface.neighbor_count}\n"
             f"    Passive: {passive}"
                  )
         print("    Neighbors:")
-        for neighbor in neighbors:
-            if interface.interface_name == neighbor.interface_name:
-                if neighbor.ospf_neighbor_state != "Full":
-                    print(f"        {Fore.RED}{neighbor.neighbor_address:15} Uptime: {str(neighbor.neighbor_up_time):15}"
-                        f"Neighbor state: {neighbor.ospf_neighbor_state}{Style.RESET_ALL}")
-                else:
-                    print(f"        {neighbor.neighbor_address:15} Uptime: {neighbor.neighbor_up_time}")
+        for neighbor in by_interface.get(interface.interface_name, ()):
+            records.emit('ospf', 'neighbor', INFO if neighbor.ospf_neighbor_state == "Full" else CRITICAL,
+                         interface=interface.interface_name, neighbor=neighbor.neighbor_address,
+                         state=neighbor.ospf_neighbor_state, uptime=neighbor.neighbor_up_time, **extra)
+            if neighbor.ospf_neighbor_state != "Full":
+                print(f"        {Fore.RED}{neighbor.neighbor_address:15} Uptime: {str(neighbor.neighbor_up_time):15}"
+                    f"Neighbor state: {neighbor.ospf_neighbor_state}{Style.RESET_ALL}")
+            else:
+                print(f"        {neighbor.neighbor_address:15} Uptime: {neighbor.neighbor_up_time}")
+
+
+def ospf(dev, instance=None, records=NO_RECORDS):
+    from jnpr.junos.exception import RpcError
+    from jnpr.junos.op.ospf import OspfNeighborTable
+    from jnpr.junos.op.routes import RouteSummaryTable
+    from myTables.OpTables import OspfInterfaceTable
+
+    print(f"{Fore.YELLOW}{_create_header('begin troubleshoot ospf')}{Style.RESET_ALL}\n")
+    if instance == ALL_INSTANCES:
+        for name in _ospf_instances(dev.rpc.get_instance_information()):
+            try:
+                neighbors = OspfNeighborTable(dev).get(instance=name)
+                interfaces = OspfInterfaceTable(dev).get(instance=name)
+            except RpcError:
+                # OSPF isn't running in this one
+                continue
+            if not len(interfaces):
+                continue
+            print(f"{Fore.CYAN}Routing instance: {name}{Style.RESET_ALL}")
+            _report_ospf_interfaces(interfaces, neighbors, records, instance=name)
+    elif instance:
+        neighbors = OspfNeighborTable(dev).get(instance=instance)
+        interfaces = OspfInterfaceTable(dev).get(instance=instance)
+        _report_ospf_interfaces(interfaces, neighbors, records)
+    else:
+        neighbors = OspfNeighborTable(dev).get()
+        interfaces = OspfInterfaceTable(dev).get()
+        _report_ospf_interfaces(interfaces, neighbors, records)
     routes = RouteSummaryTable(dev).get()
     total_routes = 0
     for route in routes:
         if route.proto['OSPF']:
             print(f"Table: {route.name} routes:{route.proto['OSPF'].count} active:{route.proto['OSPF'].active}")
+            records.emit('ospf', 'routes', INFO, table=route.name, routes=route.proto['OSPF'].count,
+                         active=route.proto['OSPF'].active)
             total_routes = total_routes + route.proto['OSPF'].count
     print(f"Total OSPF Routes: {total_routes}")
     print(f"{Fore.YELLOW}{_create_header('end of troubleshoot ospf')}{Style.RESET_ALL}\n")
 
 
-def logs(dev):
+def logs(dev, rules=None, watermarks=None, rotated=0, full=False, records=NO_RECORDS):
+    from logscan import MESSAGES, scan_log
+
     print(f"{Fore.YELLOW}{_create_header('begin parse syslog')}{Style.RESET_ALL}\n")
 
-    ntp_issue = False
-    license_issue = False
-    fname = f"{dev.hostname}-messages"
-
-    print("Transferring /var/log/messages from device")
-    with SCP(dev, progress=True) as scp1:
-        scp1.get("/var/log/messages", local_path=fname)
-    with open(fname) as messages:
-        lines = messages.readlines()
-        ntp_color = license_color = "Fore.RESET"
-        for line in lines:
-            if "NTP" in line and "Unreachable" in line:
-                ntp_issue = True
-                ntp_color = "Fore.RED"
-            elif "License" in line:
-                license_issue = True
-                license_color = "Fore.RED"
-    try:
-        os.remove(fname)
-    except Exception as err:
-        print(f"Unable to delete old log file for {fname}")
-        print(err.__class__.__name__, err)
+    if rules is None:
+        try:
+            rules = load_log_rules()
+        except Exception as err:
+            print(f"Unable to load log rules: {err}")
+            print("Skipping syslog parsing...")
+            return
+    hits = rules.hits()
 
-    print(f"{eval(ntp_color)}ntp_issue: {ntp_issue}{Style.RESET_ALL}, {eval(license_color)}license_issue: "
-                f"{license_issue}{Style.RESET_ALL}\n")
+    if watermarks is None and not full:
+        try:
+            watermarks = LogWatermarks()
+        except Exception as err:
+            print("Unable to open log watermarks, scanning the whole log")
+            print(err.__class__.__name__, err)
+
+    # Lines are checked as they stream in and only lines written since the last
+    # run are read
+    print(f"Scanning {MESSAGES} on device")
+    for path, offset, nbytes in scan_log(dev, hits.scan, dev.hostname, watermarks=watermarks,
+                                         rotated=rotated, full=full):
+        since = f" since byte {offset}" if offset else ""
+        print(f"    Scanned {nbytes} bytes of {path}{since}")
+        records.emit('logs', 'scan', INFO, path=path, offset=offset, bytes=nbytes)
+
+    matched = hits.matched()
+    if not matched:
+        print(f"{Fore.GREEN}No log rules matched ({len(rules)} rules checked){Style.RESET_ALL}")
+    for name, rule_hits in matched:
+        records.emit('logs', 'rule', WARNING, rule=name, count=rule_hits.count, first=rule_hits.first,
+                     last=rule_hits.last, samples=list(rule_hits.samples))
+        print(f"{Fore.RED}{name}: {rule_hits.count} line(s), first: {rule_hits.first}, last: {rule_hits.last}"
+              f"{Style.RESET_ALL}")
+        for sample in rule_hits.samples:
+            print(f"        {sample}")
+    print()
     print(f"{Fore.YELLOW}{_create_header('end of parse syslog')}{Style.RESET_ALL}\n")
 
 
-def info(dev):
+def info(dev, hmc_cache=None, records=NO_RECORDS):
+    from jnpr.junos.op.fpc import FpcHwTable, FpcInfoTable
+    from myTables.OpTables import HMCTable
+
     print(f"{Fore.YELLOW}{_create_header('begin get info (device facts)')}{Style.RESET_ALL}\n")
     print(f"Hostname: {dev.facts['hostname']:21} Version:        {dev.facts['version']}\n"
                 f"Model:        {dev.facts['model']:21} Chassis SN: {dev.facts['serialnumber']}")
@@ -386,6 +622,11 @@ def info(dev):
             print(f"    RE1 Uptime: {dev.facts['RE1']['up_time']}")
     except:
         print(f"RE1 Uptime: {dev.facts['RE1']['up_time']}")
+    if records:
+        uptimes = {re_name: (dev.facts.get(re_name) or {}).get('up_time') for re_name in ('RE0', 'RE1')}
+        records.emit('info', 'facts', INFO, hostname=dev.facts['hostname'], model=dev.facts['model'],
+                     version=dev.facts['version'], serialnumber=dev.facts['serialnumber'],
+                     re0_uptime=uptimes['RE0'], re1_uptime=uptimes['RE1'])
 
     # Process FPC states
     fpcs = FpcInfoTable(dev).get()
@@ -399,35 +640,211 @@ def info(dev):
         if fpc['state'] != "Online" and fpc['state'] != "Empty":
             offline_fpcs.append(fpc.name)
     print(f"FPC status: {dict(sorted(states.items(), reverse=True))}")
+    records.emit('info', 'fpc_states', CRITICAL if offline_fpcs else INFO, states=states, offline=offline_fpcs)
     if offline_fpcs:
         print(f"{Fore.RED}FPCs not online: {offline_fpcs}{Style.RESET_ALL}")
 
-    # Check for old fpc memory
+    # Check for old fpc memory. The HMC ASICs only change with the card, so with
+    # a cache they're asked for once per FPC serial
     found_old_memory_chassis = False
     fpc_hw_info = FpcHwTable(dev).get()
+    chassis = dev.facts['serialnumber']
+    fresh = {}
     for fpc in fpcs:
         found_old_memory_fpc = False
         if fpc['state'] == "Empty":
             continue
         slot = fpc.name
         fpc_hw = fpc_hw_info[f"FPC {slot}"]
-        target = f"fpc{slot}"
-        hmc_data = HMCTable(dev).get(target=target)
-        for k,v in hmc_data:
+        asics = None
+        if hmc_cache is not None:
+            try:
+                asics = hmc_cache.get(chassis, slot, fpc_hw['sn'])
+            except Exception as err:
+                print("Unable to read HMC cache")
+                print(err.__class__.__name__, err)
+                hmc_cache = None
+        if asics is None:
+            asics = fresh[(slot, fpc_hw['sn'])] = [asic for _, asic in HMCTable(dev).get(target=f"fpc{slot}")]
+        for v in asics:
             if int(v['fw_set'],16) in OLD_MEMORY_VALUES:
                 if not found_old_memory_fpc:
                     found_old_memory_fpc = True
                     found_old_memory_chassis = True
                     print(f"{Fore.RED}fpc {slot}, sn: {fpc_hw['sn']} has old memory{Style.RESET_ALL}")
+                records.emit('info', 'old_memory', WARNING, slot=slot, fpc_serial=fpc_hw['sn'], id=v['id'],
+                             name=v['name'], fw_set=v['fw_set'], rev=v['rev'], num=v['num'])
                 print(f"{Fore.RED}        id: {v['id']:3} name: {v['name']} fw_set: {v['fw_set']} "
                             f"prod_rev: {v['rev']} num: {v['num']}{Style.RESET_ALL}")
+    if hmc_cache is not None:
+        timestamp = datetime.now(timezone.utc).timestamp()
+        try:
+            for (slot, fpc_serial), asics in fresh.items():
+                hmc_cache.set(chassis, slot, fpc_serial, asics, timestamp)
+        except Exception as err:
+            print("Unable to save HMC cache")
+            print(err.__class__.__name__, err)
     if not found_old_memory_chassis:
         print("No old memory found for this chassis")
 
     print(f"{Fore.YELLOW}{_create_header('end of get info (device facts)')}{Style.RESET_ALL}\n")
 
 
-def pem(dev):
+def _watch_ints(dev, state, ifaces=None, thresholds=None, history=None, records=NO_RECORDS):
+    """
+    ints() for --watch. Only prints thresholds reached since the previous poll,
+    the ones no longer reached and the counters that moved in between, with
+    their rate. state carries the previous poll over to the next one
+    """
+    print(f"{Fore.YELLOW}{_create_header('begin watch interfaces')}{Style.RESET_ALL}\n")
+    hostname = dev.facts['hostname']
+    timestamp = datetime.now(timezone.utc).timestamp()
+    prev_run = state.get('counters')
+    if prev_run is None:
+        _print_full_fetch(ifaces)
+        # The first poll compares against the last run saved in the history
+        try:
+            prev_run = history.previous(hostname, timestamp) if history is not None else {}
+        except Exception as err:
+            print("Unable to read counter history")
+            print(err.__class__.__name__, err)
+            prev_run = {}
+    prev_breaches = state.get('breaches', {})
+
+    curr_run = []
+    breaches = {}
+    moved = []
+    for eth in _interface_stream(dev, thresholds, ifaces):
+        if (ifaces and eth.name not in ifaces) or eth.admin == 'down':
+            continue
+        for key in ('phy_errs', 'fec_errs', 'pcs_stats', 'mac_stats'):
+            counters = eth.counters(key)
+            if not counters:
+                continue
+            checks = _check_counters(eth.name, counters, thresholds.get(key, ()), prev_run, timestamp)
+            for threshold, value, prev, increase, reset, seconds, msg in checks:
+                curr_run.append((eth.name, threshold.counter, value))
+                if msg is not None:
+                    breaches[(eth.name, threshold.counter)] = (f"threshold is {threshold.text} with {msg}",
+                                                               threshold.text, value)
+                if prev and increase and seconds > 0:
+                    moved.append((eth.name, threshold.counter, increase, reset, seconds))
+
+    for (iface, counter), (text, threshold, value) in breaches.items():
+        if (iface, counter) not in prev_breaches:
+            print(f"{Fore.RED}{iface} '{counter}' {text}{Style.RESET_ALL}")
+            records.emit('ints', 'threshold', WARNING, interface=iface, counter=counter, value=value,
+                         threshold=threshold, change='reached')
+    for iface, counter in prev_breaches.keys() - breaches.keys():
+        print(f"{Fore.GREEN}{iface} '{counter}' threshold no longer reached{Style.RESET_ALL}")
+        records.emit('ints', 'threshold', INFO, interface=iface, counter=counter,
+                     threshold=prev_breaches[(iface, counter)][1], change='cleared')
+    if moved:
+        print(f"Counters that moved since the last poll {round(moved[0][4], 2):0.2f}s ago:")
+        for iface, counter, increase, reset, seconds in moved:
+            records.emit('ints', 'counter', INFO, interface=iface, counter=counter, delta=increase,
+                         rate=increase / seconds, seconds=seconds, reset=reset)
+            cleared = " (counter was cleared)" if reset else ""
+            print(f"    {Fore.MAGENTA}{iface} '{counter}' +{increase} or about {increase/seconds:0.2f}/second"
+                  f"{cleared}{Style.RESET_ALL}")
+    elif breaches.keys() == prev_breaches.keys():
+        print("No counter changes since the last poll")
+
+    state['counters'] = {(iface, counter): (timestamp, value) for iface, counter, value in curr_run}
+    state['breaches'] = breaches
+    if history is not None:
+        try:
+            history.record(hostname, timestamp, curr_run)
+        except Exception as err:
+            print("Unable to save counters")
+            print(err.__class__.__name__, err)
+    print(f"{Fore.YELLOW}{_create_header('end of watch interfaces')}{Style.RESET_ALL}\n")
+
+
+def _watch_bgp(dev, state, records=NO_RECORDS):
+    """bgp() for --watch. Only prints peers that left or came back to Established since the previous poll"""
+    from myTables.OpTables import bgpSummaryTable
+
+    print(f"{Fore.YELLOW}{_create_header('begin watch bgp')}{Style.RESET_ALL}\n")
+    # The summary has the state of every peer without the detail of each
+    peers = {peer.peer_address: peer.peer_state for peer in bgpSummaryTable(dev).get()}
+    previous = state.get('peers')
+    state['peers'] = peers
+    if previous is None:
+        established = sum(1 for peer_state in peers.values() if peer_state == "Established")
+        print(f"{established} of {len(peers)} neighbor(s) Established")
+        for peer, peer_state in peers.items():
+            records.emit('bgp', 'neighbor', INFO if peer_state == "Established" else CRITICAL, peer=peer,
+                         state=peer_state)
+            if peer_state != "Established":
+                print(f"{Fore.RED}Neighbor {peer} in {peer_state} state{Style.RESET_ALL}")
+    else:
+        changed = False
+        for peer, peer_state in peers.items():
+            prev_state = previous.get(peer)
+            if prev_state == peer_state:
+                continue
+            changed = True
+            records.emit('bgp', 'neighbor', INFO if peer_state == "Established" else CRITICAL, peer=peer,
+                         state=peer_state, previous_state=prev_state)
+            if prev_state is None:
+                print(f"New neighbor {peer} in {peer_state} state")
+            elif prev_state == "Established":
+                print(f"{Fore.RED}Neighbor {peer} left Established, now {peer_state}{Style.RESET_ALL}")
+            elif peer_state == "Established":
+                print(f"{Fore.GREEN}Neighbor {peer} is Established again{Style.RESET_ALL}")
+            else:
+                print(f"{Fore.RED}Neighbor {peer} went from {prev_state} to {peer_state}{Style.RESET_ALL}")
+        for peer in previous.keys() - peers.keys():
+            changed = True
+            records.emit('bgp', 'neighbor', WARNING, peer=peer, state=None, previous_state=previous[peer])
+            print(f"Neighbor {peer} is gone")
+        if not changed:
+            print("No neighbor changes since the last poll")
+    print(f"{Fore.YELLOW}{_create_header('end of watch bgp')}{Style.RESET_ALL}\n")
+
+
+def _watch_alarms(dev, state, records=NO_RECORDS):
+    """alarms() for --watch. Only prints alarms raised or cleared since the previous poll"""
+    print(f"{Fore.YELLOW}{_create_header('begin watch alarms')}{Style.RESET_ALL}\n")
+    alarms = {}
+    for kind, reply in (('SYSTEM', dev.rpc.get_system_alarm_information()),
+                        ('CHASSIS', dev.rpc.get_alarm_information())):
+        for alarm in reply.xpath('//alarm-description'):
+            alarms[(kind, alarm.text)] = alarm.getparent().findtext('alarm-class')
+    previous = state.get('alarms')
+    state['alarms'] = alarms
+    if previous is None:
+        print(f"{len(alarms)} alarm(s) active")
+        for kind, text in alarms:
+            print(f"{kind}: {text}")
+            records.emit('alarms', 'alarm', _alarm_severity(alarms[(kind, text)]), kind=kind.lower(), text=text,
+                         alarm_class=alarms[(kind, text)])
+    else:
+        for kind, text in alarms.keys() - previous.keys():
+            print(f"{Fore.RED}New {kind.lower()} alarm: {text}{Style.RESET_ALL}")
+            records.emit('alarms', 'alarm', _alarm_severity(alarms[(kind, text)]), kind=kind.lower(), text=text,
+                         alarm_class=alarms[(kind, text)], change='raised')
+        for kind, text in previous.keys() - alarms.keys():
+            print(f"{Fore.GREEN}Cleared {kind.lower()} alarm: {text}{Style.RESET_ALL}")
+            records.emit('alarms', 'alarm', INFO, kind=kind.lower(), text=text,
+                         alarm_class=previous[(kind, text)], change='cleared')
+        if alarms.keys() == previous.keys():
+            print("No alarm changes since the last poll")
+    print(f"{Fore.YELLOW}{_create_header('end of watch alarms')}{Style.RESET_ALL}\n")
+
+
+def _prime_text_tables():
+    from myTables.OpTables import HMCTable
+
+    # pyparsing works out the arity of its parse actions on their first call,
+    # which isn't thread safe. Parse a small table up front so concurrent info()
+    # calls don't race on it
+    HMCTable(raw=" chip ID  chip name   chip num  FW_Set  Product_Rev\n"
+                 " 0        HMC0        0         0x0090  0x0001\n").get(target='fpc0')
+
+
+def pem(dev, records=NO_RECORDS):
     print(f"{Fore.YELLOW}{_create_header('begin check pem health')}{Style.RESET_ALL}\n")
     pem_info = dev.rpc.get_environment_pem_information()
     pem_names = pem_info.xpath('//name')
@@ -436,30 +853,452 @@ def pem(dev):
         pem_status = pem_statuses[idx].text
         pem_name = pem_name.text
         if pem_status != 'Online':
+            records.emit('pem', 'pem', CRITICAL, name=pem_name, state=pem_status)
             print(f"{Fore.RED}Device {dev.hostname} has a problem with {pem_name}. Status is {pem_status}.{Style.RESET_ALL}")
     print(f"{Fore.YELLOW}{_create_header('end of check pem health')}{Style.RESET_ALL}\n")
 
 
-def alarms(dev):
+def _alarm_severity(alarm_class):
+    return CRITICAL if alarm_class == 'Major' else WARNING
+
+
+def _emit_alarm(records, kind, alarm):
+    alarm_class = alarm.getparent().findtext('alarm-class')
+    records.emit('alarms', 'alarm', _alarm_severity(alarm_class), kind=kind, text=alarm.text, alarm_class=alarm_class)
+
+
+def alarms(dev, records=NO_RECORDS):
     print(f"{Fore.YELLOW}{_create_header('begin alarm check')}{Style.RESET_ALL}\n")
     system_alarms = dev.rpc.get_system_alarm_information()
     chassis_alarms = dev.rpc.get_alarm_information()
     print("SYSTEM ALARMS:")
     for alarm in system_alarms.xpath('//alarm-description'):
         print(alarm.text)
+        _emit_alarm(records, 'system', alarm)
     print("\nCHASSIS ALARMS:")
     for alarm in chassis_alarms.xpath('//alarm-description'):
         print(alarm.text)
+        _emit_alarm(records, 'chassis', alarm)
     print(f"{Fore.YELLOW}{_create_header('end of alarm check')}{Style.RESET_ALL}\n")
 
 
-def junos_cmd(dev, cmd):
+def junos_cmd(dev, cmd, records=NO_RECORDS):
     print(f"{Fore.YELLOW}{_create_header('begin execute junos command')}{Style.RESET_ALL}\n")
-    print(dev.cli(cmd, warning=False))
+    output = dev.cli(cmd, warning=False)
+    print(output)
+    records.emit('junos_cmd', 'command', INFO, command=cmd, output=output)
     print(f"{Fore.YELLOW}{_create_header('end of execute junos command')}{Style.RESET_ALL}\n")
 
 
+def _hmc_requests(hmc_cache, inventory):
+    from myTables.OpTables import HMCTable
+    from rpcplan import rpc_request
+
+    # What HMCTable(dev).get(target=...) sends for every FPC in the chassis that
+    # info() has nothing cached for. Empty slots aren't in the inventory
+    chassis = (inventory.findtext('.//chassis/serial-number') or '').strip()
+    requests = []
+    for module in inventory.iter('chassis-module'):
+        name, serial = (module.findtext('name') or '').strip(), (module.findtext('serial-number') or '').strip()
+        if not name.startswith('FPC '):
+            continue
+        slot = name[len('FPC '):]
+        if hmc_cache is not None:
+            try:
+                if hmc_cache.get(chassis, slot, serial) is not None:
+                    continue
+            except Exception:
+                # info() reports it
+                pass
+        requests.append(rpc_request('request-pfe-execute', target=f"fpc{slot}", command=HMCTable.GET_CMD,
+                                    timeout='0'))
+    return requests
+
+
+def _bgp_detail_requests(summary):
+    from myTables.OpTables import bgpTable
+    from rpcplan import table_request
+
+    # What _bgp_summary() asks about every peer that isn't Established. The ones
+    # that flapped depend on the last run, so they're asked about as they come
+    return [table_request(bgpTable, neighbor_address=peer.findtext('peer-address').strip())
+            for peer in summary.iter('bgp-peer')
+            if (peer.findtext('peer-state') or '').strip() != "Established" and peer.findtext('peer-address')]
+
+
+def _ospf_instance_requests(instances):
+    from jnpr.junos.op.ospf import OspfNeighborTable
+    from myTables.OpTables import OspfInterfaceTable
+    from rpcplan import table_request
+
+    # What ospf() asks every instance, all sent as soon as the instances are known
+    requests = []
+    for name in _ospf_instances(instances):
+        requests += [table_request(OspfNeighborTable, instance=name), table_request(OspfInterfaceTable, instance=name)]
+    return requests
+
+
+def _planned_rpcs(operations, ifaces=None, instance=None, watch=None, bgp_summary=False, hmc_cache=None):
+    """The RPCs operations are going to make, in the order they make them, for RpcPlan to send ahead"""
+    from jnpr.junos.op.fpc import FpcHwTable, FpcInfoTable
+    from jnpr.junos.op.ospf import OspfNeighborTable
+    from jnpr.junos.op.routes import RouteSummaryTable
+    from myTables.OpTables import (EthPortSnapshotTable, LldpNeighborTable, OspfInterfaceTable, PhyPortDiagTable,
+        bgpSummaryTable, bgpTable)
+    from myTables.snapshot import interface_requests
+    from rpcplan import rpc_request, table_request
+
+    requests = []
+    for operation in operations:
+        if operation == 'ints':
+            batches = interface_requests(ifaces)
+            if watch is None:
+                requests += [table_request(PhyPortDiagTable, interface_name=batch) for batch in batches]
+            requests += [table_request(EthPortSnapshotTable, interface_name=batch) for batch in batches]
+            if watch is None:
+                # The ELS and non-ELS tables send the same RPC
+                requests.append(table_request(LldpNeighborTable))
+        elif operation == 'bgp' and watch is not None:
+            requests.append(table_request(bgpSummaryTable))
+        elif operation == 'bgp' and bgp_summary:
+            requests.append((table_request(bgpSummaryTable), _bgp_detail_requests))
+        elif operation == 'bgp':
+            requests += [table_request(bgpTable), table_request(bgpSummaryTable)]
+        elif operation == 'ospf' and instance == ALL_INSTANCES:
+            requests += [(rpc_request('get-instance-information'), _ospf_instance_requests),
+                         table_request(RouteSummaryTable)]
+        elif operation == 'ospf':
+            args = {'instance': instance} if instance else {}
+            requests += [table_request(OspfNeighborTable, **args), table_request(OspfInterfaceTable, **args),
+                         table_request(RouteSummaryTable)]
+        elif operation == 'info':
+            requests += [table_request(FpcInfoTable), (table_request(FpcHwTable), partial(_hmc_requests, hmc_cache))]
+        elif operation == 'pem':
+            requests.append(rpc_request('get-environment-pem-information'))
+        elif operation == 'alarms':
+            requests += [rpc_request('get-system-alarm-information'), rpc_request('get-alarm-information')]
+    return requests
+
+
+def _run_operations(hostname, netconf_port, ifaces, operations, user, passwd, ssh_config, instance=None,
+                    cmd=None, thresholds=None, history=None, log_rules=None, watermarks=None, rotated_logs=0,
+                    full_logs=False, device=None, profiler=None, watch=None, records=None, deadlines=None,
+                    bgp_summary=False, peer_states=None, hmc_cache=None):
+    from jnpr.junos.exception import ConnectAuthError, ConnectError, ConnectTimeoutError, ProbeError, RpcTimeoutError
+
+    if device is None:
+        from jnpr.junos import Device as device
+    records = HostRecords(records, hostname)
+    operation = None
+    # Begin Netconf comms with Device and execute list of operations
+    try:
+        with deadlines.host() if deadlines else nullcontext(), \
+                device(host=hostname, port=netconf_port, user=user,
+                       passwd=passwd, ssh_config=ssh_config,
+                       auto_probe=5) as dev, \
+                RpcPlan(dev, _planned_rpcs(operations, ifaces=ifaces, instance=instance, watch=watch,
+                                           bgp_summary=bgp_summary, hmc_cache=hmc_cache)):
+            for operation in operations:
+                with profiler.operation(operation) if profiler else nullcontext(), \
+                        deadlines.operation(operation) if deadlines else nullcontext():
+                    if operation == 'ints' and watch is not None:
+                        _watch_ints(dev, watch, ifaces=ifaces, thresholds=thresholds, history=history,
+                                    records=records)
+                    elif operation in ('bgp', 'alarms') and watch is not None:
+                        globals()[f"_watch_{operation}"](dev, watch, records=records)
+                    elif operation == 'ints':
+                        globals()[operation](dev, ifaces=ifaces, thresholds=thresholds, history=history,
+                                             records=records)
+                    elif operation == 'logs':
+                        globals()[operation](dev, rules=log_rules, watermarks=watermarks, rotated=rotated_logs,
+                                             full=full_logs, records=records)
+                    elif operation == 'bgp':
+                        globals()[operation](dev, summary=bgp_summary, peer_states=peer_states, records=records)
+                    elif operation == 'ospf' and instance:
+                        globals()[operation](dev, instance=instance, records=records)
+                    elif operation == 'info':
+                        globals()[operation](dev, hmc_cache=hmc_cache, records=records)
+                    elif operation == 'junos_cmd':
+                        globals()[operation](dev, cmd=cmd, records=records)
+                    else:
+                        globals()[operation](dev, records=records)
+        return HOST_SUCCESS
+    except ConnectAuthError as err:
+        print(f"{Fore.RED}Unable to login. Check username/password: {err}{Style.RESET_ALL}")
+        records.emit(operation, 'error', CRITICAL, error=f"Unable to login: {err}")
+        return HOST_AUTH_FAILED
+    except RpcTimeoutError as err:
+        # Without deadlines it's PyEZ's own RPC timeout
+        deadline, seconds = (deadlines and deadlines.expired()) or ('rpc', err.timeout)
+        return _timed_out(records, operation, err.cmd, deadline, seconds)
+    except (ProbeError, ConnectError) as err:
+        if isinstance(err, ConnectTimeoutError) and deadlines and deadlines.expired():
+            return _timed_out(records, operation, None, *deadlines.expired())
+        print(f"{Fore.RED}Cannot connect to device: {err}\nMake sure device is reachable and {Style.BRIGHT}"
+            f"'set system services netconf ssh'{Style.NORMAL} is set{Style.RESET_ALL}")
+        records.emit(operation, 'error', CRITICAL, error=f"Cannot connect to device: {err}")
+        return HOST_FAILED
+    except Exception as err:
+        print(f"{Fore.RED}Abnormal termination: {err.__class__.__name__, err}{Style.RESET_ALL}")
+        records.emit(operation, 'error', CRITICAL, error=f"{err.__class__.__name__}: {err}")
+        return HOST_FAILED
+
+
+def _timed_out(records, operation, rpc, deadline, seconds):
+    running = f"{operation} ({rpc})" if rpc else (operation or "connect")
+    print(f"{Fore.RED}Timed out: the {deadline} deadline of {seconds:g}s ran out during {running}, "
+          f"moving on{Style.RESET_ALL}")
+    records.emit(operation, 'timeout', CRITICAL, deadline=deadline, seconds=seconds, rpc=rpc)
+    return HOST_TIMED_OUT
+
+
+def _triage_host(host, operations, user, passwd, ssh_config, iface_group=None, instance=None,
+                 cmd=None, thresholds=None, history=None, log_rules=None, watermarks=None, rotated_logs=0,
+                 full_logs=False, device=None, profiler=None, agent=None, watch_states=None, records=None,
+                 deadlines=None, bgp_summary=False, peer_states=None, hmc_cache=None):
+    hostname = host.name
+    netconf_port = host.vars['netconf_port']
+
+    # Begin Device Output to User
+    print(f"{Fore.BLUE}{Style.BRIGHT}Conducting triage of device {hostname}{Style.RESET_ALL}")
+    ifaces = []
+    if iface_group:
+        try:
+            # create list of interfaces from list of dicts for given interface
+            # group
+            for iface in host.vars[iface_group]:
+                for k, v in iface.items():
+                    ifaces.append(v)
+        except KeyError as err:
+            print(f"No Interfaces found in group '{iface_group}' for host '{hostname}'")
+            return hostname, HOST_SKIPPED
+        except Exception as err:
+            print(f"{Fore.RED}Abnormal termination: {err.__class__.__name__, err}{Style.RESET_ALL}")
+            return hostname, HOST_FAILED
+
+    if agent is not None:
+        # The agent runs the operations on a session it already has open
+        try:
+            status, output, host_records = agent(hostname=hostname, port=netconf_port, ifaces=ifaces,
+                                                 records=records is not None)
+        except AgentError as err:
+            print(f"{Fore.RED}{err}{Style.RESET_ALL}")
+            HostRecords(records, hostname).emit(None, 'error', CRITICAL, error=str(err))
+            return hostname, HOST_FAILED
+        print(output, end='')
+        for record in host_records if records is not None else ():
+            records.write(record)
+        return hostname, status
+
+    return hostname, _run_operations(hostname, netconf_port, ifaces, operations, user, passwd, ssh_config,
+                                     instance=instance, cmd=cmd, thresholds=thresholds, history=history,
+                                     log_rules=log_rules, watermarks=watermarks, rotated_logs=rotated_logs,
+                                     full_logs=full_logs, device=device, profiler=profiler,
+                                     watch=watch_states.setdefault(hostname, {}) if watch_states is not None else None,
+                                     records=records, deadlines=deadlines, bgp_summary=bgp_summary,
+                                     peer_states=peer_states, hmc_cache=hmc_cache)
+
+
+def _agent_triage(request, pool, files, output, deadlines=None):
+    """Run a triage request from a --agent client on the pool's sessions"""
+    # Records go back to the client with the output
+    records = RecordList() if request.get('records') else None
+    with output.buffer() as buf:
+        try:
+            thresholds = files.load(_load_thresholds, request['thresholds']) if request.get('thresholds') else None
+            log_rules = files.load(load_log_rules, request['log_rules']) if request.get('log_rules') else None
+            history = CounterHistory(request['history']) if request.get('history') else None
+            watermarks = LogWatermarks(request['watermarks']) if request.get('watermarks') else None
+            peer_states = BgpPeerStates(request['peer_states']) if request.get('peer_states') else None
+            hmc_cache = HmcCache(request['hmc_cache']) if request.get('hmc_cache') else None
+        except Exception as err:
+            print(f"{Fore.RED}Agent unable to load configuration: {err.__class__.__name__, err}{Style.RESET_ALL}")
+            status = HOST_FAILED
+        else:
+            status = _run_operations(request['hostname'], request['port'], request['ifaces'], request['operations'],
+                                     request['user'], request['passwd'], request['ssh_config'],
+                                     instance=request.get('instance'), cmd=request.get('cmd'),
+                                     thresholds=thresholds, history=history, log_rules=log_rules,
+                                     watermarks=watermarks, rotated_logs=request.get('rotated_logs', 0),
+                                     full_logs=request.get('full_logs', False), device=pool.lease,
+                                     records=records, deadlines=deadlines,
+                                     bgp_summary=request.get('bgp_summary', False), peer_states=peer_states,
+                                     hmc_cache=hmc_cache)
+    return {'status': status, 'output': buf.getvalue(), 'records': records or []}
+
+
+def _serve_agent(socket_path, device, idle_timeout, deadlines=None):
+    device = planned_device(device)
+    if deadlines is not None:
+        device = deadlines.device(device)
+    pool = SessionPool(device, idle_timeout=idle_timeout)
+    output = HostOutput(sys.stdout)
+    handlers = {
+        'ping': lambda request: {'sessions': len(pool)},
+        'triage': partial(_agent_triage, pool=pool, files=FileCache(), output=output, deadlines=deadlines),
+    }
+    try:
+        server = AgentServer(socket_path, handlers)
+    except (AgentError, OSError) as err:
+        print(f"{Fore.RED}Unable to start session agent: {err}{Style.RESET_ALL}")
+        sys.exit(1)
+    _prime_text_tables()
+    # Close the sessions and remove the socket when killed as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    pool.start()
+    print(f"Session agent listening on {socket_path}, press Ctrl-C to stop")
+    sys.stdout = output
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        sys.stdout = output._stream
+        server.server_close()
+        pool.close()
+
+
+def _run_hosts(hosts, triage, workers):
+    """Triage every host, workers at a time. Returns [(hostname, status), ...]"""
+    if workers > 1 and len(hosts) > 1:
+        # Each worker buffers its host's output so sections from different devices
+        # don't interleave on the terminal
+        host_output = HostOutput(sys.stdout)
+
+        def buffered_triage(host):
+            with host_output.capture():
+                return triage(host)
+
+        sys.stdout = host_output
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(buffered_triage, host) for host in hosts]
+                results = []
+                for future in futures:
+                    if future.cancelled():
+                        continue
+                    results.append(future.result())
+                    # Stop handing out hosts once a login fails so the account
+                    # doesn't get locked out
+                    if results[-1][1] == HOST_AUTH_FAILED:
+                        for pending in futures:
+                            pending.cancel()
+        finally:
+            sys.stdout = host_output._stream
+    else:
+        results = []
+        for host in hosts:
+            results.append(triage(host))
+            if results[-1][1] == HOST_AUTH_FAILED:
+                break
+    return results
+
+
+def _watch_hosts(hosts, triage, workers, interval, pool):
+    """
+    Triage every host again each interval seconds until interrupted, on sessions
+    kept open in pool. Returns the results of the last complete poll
+    """
+    results = []
+    pool.start()
+    try:
+        poll = 0
+        while True:
+            poll += 1
+            start = time.monotonic()
+            print(f"{Fore.CYAN}{Style.BRIGHT}Poll {poll} at {datetime.now():%Y-%m-%d %H:%M:%S}{Style.RESET_ALL}")
+            results = _run_hosts(hosts, triage, workers)
+            if any(status == HOST_AUTH_FAILED for _, status in results):
+                break
+            time.sleep(max(0, interval - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        print(f"\n{Fore.YELLOW}Stopped watching after {poll} poll(s){Style.RESET_ALL}")
+    finally:
+        pool.close()
+    return results
+
+
+def _device_factory(args):
+    if args.record_dir or args.replay_dir:
+        from replay import RecordingDevice, ReplayDevice, load_latency
+    if args.record_dir:
+        return partial(RecordingDevice, record_dir=args.record_dir)
+    if args.replay_dir:
+        try:
+            latency = load_latency(args.replay_latency)
+        except Exception as err:
+            print(f"{Fore.RED}Invalid replay latency: {err.__class__.__name__, err}{Style.RESET_ALL}")
+            sys.exit(1)
+        return partial(ReplayDevice, replay_dir=args.replay_dir, latency=latency)
+    from jnpr.junos import Device
+    return Device
+
+
+def _deadlines(args):
+    if args.rpc_deadline is None and args.operation_deadline is None and args.host_deadline is None:
+        return None
+    from deadlines import Deadlines, load_rpc_deadlines
+    try:
+        rpc = load_rpc_deadlines(args.rpc_deadline)
+    except Exception as err:
+        print(f"{Fore.RED}Invalid rpc deadline: {err.__class__.__name__, err}{Style.RESET_ALL}")
+        sys.exit(1)
+    return Deadlines(rpc=rpc, operation=args.operation_deadline, host=args.host_deadline)
+
+
+def merge(argv):
+    """network_triage.py merge: combine the result bundles of --shard runs into one fleet summary"""
+    from fleet import TOP, FleetStats, format_report as format_fleet
+
+    parser = argparse.ArgumentParser(prog='network_triage.py merge',
+                                     description='Combine the result bundles of sharded runs into one fleet summary')
+    parser.add_argument('bundles', metavar='<bundle>', nargs='+',
+                        help='result bundles written with --bundle, one per shard')
+    parser.add_argument('--top', dest='top', metavar='<count>', type=int, default=TOP,
+                        help=f'rank the worst interfaces of the fleet when the shards ran ints, this many per '
+                             f'ranking (default {TOP})')
+    parser.add_argument('--output', dest='output', metavar='<file>',
+                        help='also write the records of every shard and the fleet rankings to this ndjson file, '
+                             'gzipped if it ends in .gz')
+    args = parser.parse_args(argv)
+    if args.top < 1:
+        parser.error("argument --top: must be at least 1")
+
+    records = None
+    if args.output:
+        try:
+            records = RecordWriter(args.output)
+        except OSError as err:
+            print(f"{Fore.RED}Unable to open '{args.output}': {err.__class__.__name__, err}{Style.RESET_ALL}")
+            sys.exit(1)
+    # Takes the records of every shard, so interfaces are ranked against the
+    # far end of their link whichever shard it was in
+    fleet = FleetStats(records)
+    try:
+        try:
+            summary = merge_bundles(args.bundles, fleet)
+        except BundleError as err:
+            print(f"{Fore.RED}{err}{Style.RESET_ALL}")
+            sys.exit(1)
+        print(f"{Fore.YELLOW}{_create_header('merged shards')}{Style.RESET_ALL}\n")
+        print(format_summary(summary) + "\n")
+        if 'ints' in summary['operations']:
+            report = fleet.report({host: [group for group in groups if group != 'all']
+                                   for host, groups in summary['hosts'].items()}, top=args.top)
+            print(f"{Fore.YELLOW}{_create_header('fleet')}{Style.RESET_ALL}\n")
+            print(format_fleet(report) + "\n")
+            fleet.write_report(report)
+    finally:
+        fleet.close()
+    if summary['missing']:
+        sys.exit(1)
+
+
 def main():
+    if sys.argv[1:2] == ['merge']:
+        merge(sys.argv[2:])
+        return
     oper_choices = ["all", "ints", "bgp", "ospf", "logs", "info", "pem", "alarms", "junos_cmd"]
     parser = argparse.ArgumentParser(description='Execute troubleshooting operation(s)')
     parser.add_argument('-o', '--oper', dest='operations', metavar='<oper>',
@@ -484,8 +1323,102 @@ def main():
     parser.add_argument('-j', '--junos_cmd', dest='cmd', metavar='<junos cmd>',
                         help='junos cli cmd to run')
     parser.add_argument('-r', '--instance', dest='instance', metavar='<routing-instance>',
-                        help='specify routing instance for ospf')
+                        help="specify routing instance for ospf, or 'all' for every instance")
+    parser.add_argument('-w', '--workers', dest='workers', metavar='<workers>', type=int, default=1,
+                        help='number of devices to triage concurrently')
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument('--record', dest='record_dir', metavar='<dir>',
+                         help='save every device reply under this directory for later replay')
+    backend.add_argument('--replay', dest='replay_dir', metavar='<dir>',
+                         help='answer device calls from a directory saved with --record instead of connecting')
+    parser.add_argument('--replay-latency', dest='replay_latency', metavar='<seconds|json>',
+                        help='delay added to each replayed RPC, in seconds or a json file of per rpc seconds')
+    parser.add_argument('--rotated-logs', dest='rotated_logs', metavar='<count>', type=int, default=0,
+                        help='also scan this many rotated syslog files (messages.0.gz, ...)')
+    parser.add_argument('--full-logs', dest='full_logs', action='store_true',
+                        help='scan the whole syslog instead of only what was written since the last run')
+    parser.add_argument('--bgp-summary', dest='bgp_summary', action='store_true',
+                        help='classify bgp peers from the summary and only detail the ones down or flapped since '
+                             'the last run')
+    parser.add_argument('--profile', action='store_true',
+                        help='time every host, operation, rpc and file transfer and print a report at the end')
+    parser.add_argument('--profile-json', dest='profile_json', metavar='<file>',
+                        help='also write the profiling report to this json file (implies --profile)')
+    agent_mode = parser.add_mutually_exclusive_group()
+    agent_mode.add_argument('--agent', action='store_true',
+                            help='run operations on the sessions kept open by a session agent')
+    agent_mode.add_argument('--serve-agent', dest='serve_agent', action='store_true',
+                            help='run a session agent that keeps device sessions open between runs')
+    parser.add_argument('--agent-socket', dest='agent_socket', metavar='<path>', default=DEFAULT_SOCKET,
+                        help=f'unix socket of the session agent (default {DEFAULT_SOCKET})')
+    parser.add_argument('--agent-idle', dest='agent_idle', metavar='<seconds>', type=int, default=IDLE_TIMEOUT,
+                        help='close agent sessions that have been unused for this long')
+    parser.add_argument('--watch', dest='watch', metavar='<interval>', type=float,
+                        help='keep sessions open and rerun the operations every interval seconds, '
+                             'showing only what changed for ints, bgp and alarms')
+    parser.add_argument('--cache-ttl', dest='cache_ttl', metavar='<seconds>', type=int, default=CACHE_TTL,
+                        help='reuse device facts and the parsed inventory for this long, 0 to disable the cache '
+                        '(HMC results are reused until the FPC changes)')
+    parser.add_argument('--refresh-cache', dest='refresh_cache', action='store_true',
+                        help='ignore cached facts, inventory and HMC results and gather them again')
+    parser.add_argument('--format', dest='output_format', choices=['text', 'ndjson'], default='text',
+                        help='print results as text, or write them as ndjson records (one json object per line)')
+    parser.add_argument('--output', dest='output', metavar='<file>',
+                        help='write the ndjson records to this file instead of stdout, gzipped if it ends in .gz')
+    parser.add_argument('--gzip', action='store_true',
+                        help='gzip the ndjson records')
+    parser.add_argument('--top', dest='top', metavar='<count>', type=int,
+                        help='after ints, rank the worst interfaces of all devices, this many per ranking')
+    parser.add_argument('--shard', dest='shard', metavar='<i/N>',
+                        help='only triage the hosts of shard i out of N, split on a hash of the hostname')
+    parser.add_argument('--bundle', dest='bundle', metavar='<file>',
+                        help="also write every record of the run to this gzipped result bundle, for 'merge'")
+    parser.add_argument('--rpc-deadline', dest='rpc_deadline', metavar='<seconds|json>',
+                        help='give up on an rpc after this long (PyEZ waits 30s), in seconds or a json file of '
+                             'per rpc seconds')
+    parser.add_argument('--operation-deadline', dest='operation_deadline', metavar='<seconds>', type=float,
+                        help='give up on a device once one operation has taken this long')
+    parser.add_argument('--host-deadline', dest='host_deadline', metavar='<seconds>', type=float,
+                        help='give up on a device once it has taken this long, connecting included')
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("argument -w/--workers: must be at least 1")
+    if args.rotated_logs < 0:
+        parser.error("argument --rotated-logs: must not be negative")
+    if args.agent and (args.record_dir or args.replay_dir or args.profile or args.profile_json or
+                       args.rpc_deadline or args.operation_deadline or args.host_deadline):
+        parser.error("argument --agent: the agent talks to the devices, start it with --record/--replay "
+                     "or the deadlines instead, and it can't be profiled from here")
+    if args.cache_ttl < 0:
+        parser.error("argument --cache-ttl: must not be negative")
+    if args.watch is not None and args.watch <= 0:
+        parser.error("argument --watch: must be more than 0 seconds")
+    if args.watch and (args.agent or args.serve_agent):
+        parser.error("argument --watch: keeps its own sessions open and can't be combined with the agent")
+    if args.top is not None and args.top < 1:
+        parser.error("argument --top: must be at least 1")
+    if args.top and args.watch:
+        parser.error("argument --top: only ranks single runs, not --watch polls")
+    for name in ('operation_deadline', 'host_deadline'):
+        if getattr(args, name) is not None and getattr(args, name) <= 0:
+            parser.error(f"argument --{name.replace('_', '-')}: must be more than 0 seconds")
+    shard = None
+    if args.shard is not None:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as err:
+            parser.error(f"argument --shard: {err}")
+    if args.bundle and (args.watch or args.serve_agent):
+        parser.error("argument --bundle: only bundles single runs, not --watch polls or the agent")
+    if (args.output or args.gzip) and args.output_format != 'ndjson':
+        parser.error("arguments --output/--gzip: only apply to --format ndjson")
+    if args.serve_agent:
+        _serve_agent(args.agent_socket, _device_factory(args), args.agent_idle, _deadlines(args))
+        return
+    if args.output_format == 'ndjson' and args.output in (None, '-'):
+        # stdout only carries the records, everything meant for people goes to
+        # stderr
+        sys.stdout = sys.stderr
 
     print(f"{Fore.YELLOW}Welcome to the Python troubleshooting script for Junos boxes using PyEZ{Style.RESET_ALL}")
     if (not args.user and not args.inventory_path and not args.operations and not args.quiet and
@@ -494,12 +1427,15 @@ def main():
         parser.print_help()
         sys.exit(0)
 
-    if not args.user:
+    if not args.user and not args.replay_dir:
         user = validate_str("Enter your username: ")
     else:
         user = args.user
 
-    if args.passwd:
+    if args.replay_dir:
+        # Nothing to log in to when replaying
+        passwd = None
+    elif args.passwd:
         passwd = args.passwd
     elif not args.nopass:
         tries = 0
@@ -583,6 +1519,7 @@ def main():
     else:
         operations = args.operations
 
+    cmd = None
     if 'junos_cmd' in operations:
         if not args.cmd:
             cmd = validate_str("Enter Junos CLI command to be executed: ")
@@ -591,20 +1528,106 @@ def main():
 
     if (not args.instance and not args.quiet and 'ospf' in operations and
                     validate_bool("Do you want to specify a routing instance? (y/n) ")):
-        instance = validate_str("Enter name of routing instance: ")
+        instance = validate_str("Enter name of routing instance (or 'all'): ")
     elif args.instance:
         instance = args.instance
     else:
         instance = None
 
-    loader = DataLoader()
-    inventory = InventoryManager(loader=loader, sources=datacenter)
-    variables = VariableManager(loader=loader, inventory=inventory)
+    # Make sure every operation maps to a public function before touching any
+    # device
+    for operation in operations:
+        if operation.startswith('_') or not callable(globals().get(operation)):
+            print(f"{Fore.RED}Invalid operation: '{operation}'\nProblem with code. Make sure oper_choices "
+                f"matches the public(no leading underscore) function names{Style.RESET_ALL}")
+            sys.exit(2)
+
+    thresholds = history = None
+    if 'ints' in operations:
+        try:
+            thresholds = _load_thresholds()
+        except Exception as err:
+            print(f"{Fore.RED}Unable to load thresholds.json: {err.__class__.__name__, err}{Style.RESET_ALL}")
+            sys.exit(1)
+        try:
+            history = CounterHistory()
+        except Exception as err:
+            print(f"{Fore.RED}Unable to open counter history: {err.__class__.__name__, err}{Style.RESET_ALL}")
+            sys.exit(1)
+
+    log_rules = watermarks = None
+    if 'logs' in operations:
+        try:
+            log_rules = load_log_rules()
+        except Exception as err:
+            print(f"{Fore.RED}Unable to load log_rules.json: {err.__class__.__name__, err}{Style.RESET_ALL}")
+            sys.exit(1)
+        try:
+            watermarks = LogWatermarks()
+        except Exception as err:
+            print(f"{Fore.RED}Unable to open log watermarks: {err.__class__.__name__, err}{Style.RESET_ALL}")
+            sys.exit(1)
+
+    peer_states = None
+    if 'bgp' in operations and args.bgp_summary:
+        try:
+            peer_states = BgpPeerStates()
+        except Exception as err:
+            print(f"{Fore.RED}Unable to open BGP peer states: {err.__class__.__name__, err}{Style.RESET_ALL}")
+            sys.exit(1)
+
+    hmc_cache = None
+    if 'info' in operations and args.cache_ttl > 0:
+        try:
+            hmc_cache = HmcCache()
+            if args.refresh_cache:
+                hmc_cache.invalidate()
+        except Exception as err:
+            print(f"{Fore.RED}Unable to open HMC cache, continuing without it: {err.__class__.__name__, err}"
+                  f"{Style.RESET_ALL}")
+            hmc_cache = None
+
+    agent = None
+    if args.agent:
+        client = AgentClient(args.agent_socket)
+        try:
+            client.call('ping')
+        except AgentError as err:
+            print(f"{Fore.RED}{err}\nStart one with network_triage.py --serve-agent{Style.RESET_ALL}")
+            sys.exit(1)
+        # The agent loads the same files this run would
+        agent = partial(client.triage, operations=operations, user=user, passwd=passwd, ssh_config=args.ssh_config,
+                        instance=instance, cmd=cmd, rotated_logs=args.rotated_logs, full_logs=args.full_logs,
+                        thresholds=str(Path("thresholds.json").resolve()) if thresholds is not None else None,
+                        history=str(Path(history.path).resolve()) if history is not None else None,
+                        log_rules=str(LOG_RULES) if log_rules is not None else None,
+                        watermarks=str(Path(watermarks.path).resolve()) if watermarks is not None else None,
+                        bgp_summary=args.bgp_summary,
+                        peer_states=str(Path(peer_states.path).resolve()) if peer_states is not None else None,
+                        hmc_cache=str(Path(hmc_cache.path).resolve()) if hmc_cache is not None else None)
+
+    facts_cache = inventory_cache = None
+    if args.cache_ttl > 0:
+        try:
+            facts_cache = FactsCache()
+            inventory_cache = InventoryCache()
+        except Exception as err:
+            print(f"{Fore.RED}Unable to open cache, continuing without it: {err.__class__.__name__, err}"
+                  f"{Style.RESET_ALL}")
+            facts_cache = inventory_cache = None
+
+    try:
+        inventory = load_inventory(datacenter, inventory_cache, max_age=args.cache_ttl, refresh=args.refresh_cache)
+    except Exception as err:
+        print(f"{Fore.RED}Unable to load inventory '{datacenter}': {err.__class__.__name__, err}{Style.RESET_ALL}")
+        sys.exit(1)
     success = 0
     skipped = 0
     failure = 0
+    timed_out = 0
     skipped_hosts = []
     failed_hosts = []
+    timed_out_hosts = []
     if limit:
         if "*" in limit:
             limit = limit.replace("*", ".*")
@@ -612,72 +1635,133 @@ def main():
             limit = limit.replace("?", ".")
         if ":" in limit:
             limit = limit.replace(":", "-")
-    for host in inventory.get_hosts():
-        hostname = host.get_name()
+    hosts = []
+    for host in inventory:
         match = False
         if limit:
-            if re.match(limit, hostname):
+            if re.match(limit, host.name):
                 match = True
             else:
-                for group in (str(g) for g in host.get_groups()):
+                for group in host.groups:
                     if re.match(limit, group):
                         match = True
             if not match:
                 continue
-
-        netconf_port = variables.get_vars(host=host)['netconf_port']
-
-        # Begin Device Output to User
-        print(f"{Fore.BLUE}{Style.BRIGHT}Conducting triage of device {hostname}{Style.RESET_ALL}")
-        ifaces = []
-        if iface_group:
+        hosts.append(host)
+    if shard is not None:
+        hosts = [host for host in hosts if shard_of(host.name, shard[1]) == shard[0]]
+        print(f"Shard {shard[0]}/{shard[1]}: {len(hosts)} host(s)")
+
+    # The operations' RPCs are sent ahead on each session
+    device = planned_device(_device_factory(args))
+    deadlines = _deadlines(args)
+    if deadlines is not None:
+        # Before anything that reads files, so file transfers get their socket
+        # timeout
+        device = deadlines.device(device)
+    if facts_cache is not None:
+        device = cached_facts_device(device, facts_cache, max_age=args.cache_ttl, refresh=args.refresh_cache)
+
+    profiler = None
+    if args.profile or args.profile_json:
+        from profiler import Profiler
+        profiler = Profiler()
+        device = profiler.device(device)
+    if args.watch:
+        # Sessions stay open from one poll to the next
+        device = SessionPool(device, idle_timeout=max(IDLE_TIMEOUT, 2 * args.watch))
+
+    records = None
+    if args.output_format == 'ndjson':
+        try:
+            records = RecordWriter(args.output, compress=args.gzip or None)
+        except OSError as err:
+            print(f"{Fore.RED}Unable to open '{args.output}': {err.__class__.__name__, err}{Style.RESET_ALL}")
+            sys.exit(1)
+    bundle = None
+    if args.bundle:
+        try:
+            records = bundle = BundleWriter(args.bundle, shard or (1, 1), operations,
+                                            {host.name: host.groups for host in hosts}, writer=records)
+        except OSError as err:
+            print(f"{Fore.RED}Unable to open '{args.bundle}': {err.__class__.__name__, err}{Style.RESET_ALL}")
+            sys.exit(1)
+    fleet = None
+    if args.top and 'ints' in operations:
+        from fleet import FleetStats
+        # Takes the records of every host and passes them on
+        records = fleet = FleetStats(records)
+
+    triage = partial(_triage_host, operations=operations, user=user, passwd=passwd,
+                     ssh_config=args.ssh_config, iface_group=iface_group, instance=instance, cmd=cmd,
+                     thresholds=thresholds, history=history, log_rules=log_rules, watermarks=watermarks,
+                     rotated_logs=args.rotated_logs, full_logs=args.full_logs,
+                     device=device.lease if args.watch else device, profiler=profiler, agent=agent,
+                     watch_states={} if args.watch else None, records=records, deadlines=deadlines,
+                     bgp_summary=args.bgp_summary, peer_states=peer_states, hmc_cache=hmc_cache)
+    if records is not None:
+        triage_records = triage
+
+        def triage(host):
+            hostname, status = triage_records(host)
+            HostRecords(records, hostname).emit(None, 'host', CRITICAL if status in (HOST_FAILED, HOST_AUTH_FAILED,
+                                                                                     HOST_TIMED_OUT)
+                                                else INFO, status=status)
+            # A host's records are written out as soon as it's done
+            records.flush()
+            return hostname, status
+    if profiler:
+        triage_host = triage
+
+        def triage(host):
+            with profiler.host(host.name):
+                return triage_host(host)
+
+    if args.workers > 1 and len(hosts) > 1 and 'info' in operations:
+        _prime_text_tables()
+    try:
+        if args.watch:
+            results = _watch_hosts(hosts, triage, args.workers, args.watch, device)
+        else:
+            results = _run_hosts(hosts, triage, args.workers)
+        if fleet is not None:
+            from fleet import format_report as format_fleet
+            report = fleet.report({host.name: [group for group in host.groups if group != 'all'] for host in hosts},
+                                  top=args.top)
+            print(f"{Fore.YELLOW}{_create_header('fleet')}{Style.RESET_ALL}\n")
+            print(format_fleet(report) + "\n")
+            fleet.write_report(report)
+        if bundle is not None:
+            bundle.finish()
+    finally:
+        if records is not None:
+            records.close()
+
+    if profiler:
+        report = profiler.report()
+        print(f"{Fore.YELLOW}{_create_header('profile')}{Style.RESET_ALL}\n")
+        from profiler import format_report
+        print(format_report(report) + "\n")
+        if args.profile_json:
             try:
-                # create list of interfaces from list of dicts for given interface
-                # group
-                for iface in variables.get_vars(host=host)[iface_group]:
-                    for k, v in iface.items():
-                        ifaces.append(v)
-            except KeyError as err:
-                print(f"No Interfaces found in group '{iface_group}' for host '{hostname}'")
-                skipped = skipped + 1
-                skipped_hosts.append(hostname)
-                continue
+                profiler.save(args.profile_json, report)
             except Exception as err:
-                print(f"{Fore.RED}Abnormal termination: {err.__class__.__name__, err}{Style.RESET_ALL}")
-                sys.exit(1)
-                ifaces = None
+                print(f"{Fore.RED}Unable to save profile: {err.__class__.__name__, err}{Style.RESET_ALL}")
 
-        # Begin Netconf comms with Device and execute list of operations
-        try:
-            with Device(host=hostname, port=netconf_port, user=user,
-                        passwd=passwd, ssh_config=args.ssh_config,
-                        auto_probe=5) as dev:
-                for operation in operations:
-                    if callable(globals()[operation]) and not operation.startswith('_'):
-                        if operation == 'ints' and ifaces:
-                            globals()[operation](dev, ifaces=ifaces)
-                        elif operation == 'ospf' and instance:
-                            globals()[operation](dev, instance=instance)
-                        elif operation == 'junos_cmd':
-                            globals()[operation](dev, cmd=cmd)
-                        else:
-                            globals()[operation](dev)
-                    else:
-                        print(f"{Fore.RED}Invalid operation: '{operation}'\nProblem with code. Make sure oper_choices "
-                            f"matches the public(no leading underscore) function names{Style.RESET_ALL}")
-                        sys.exit(2)
+    for hostname, status in results:
+        if status == HOST_SUCCESS:
             success = success + 1
-        except ConnectAuthError as err:
-            print(f"{Fore.RED}Unable to login. Check username/password: {err}")
-            print(f"Exiting so you don't lock yourself out :){Style.RESET_ALL}")
-            sys.exit(1)
-        except (ProbeError, ConnectError) as err:
-            print(f"{Fore.RED}Cannot connect to device: {err}\nMake sure device is reachable and {Style.BRIGHT}"
-                f"'set system services netconf ssh'{Style.NORMAL} is set{Style.RESET_ALL}")
+        elif status == HOST_SKIPPED:
+            skipped = skipped + 1
+            skipped_hosts.append(hostname)
+        elif status == HOST_FAILED:
             failure = failure + 1
             failed_hosts.append(hostname)
-        except Exception as err:
-            print(f"{Fore.RED}Abnormal termination: {err.__class__.__name__, err}{Style.RESET_ALL}")
+        elif status == HOST_TIMED_OUT:
+            timed_out = timed_out + 1
+            timed_out_hosts.append(hostname)
+        elif status == HOST_AUTH_FAILED:
+            print(f"{Fore.RED}Exiting so you don't lock yourself out :){Style.RESET_ALL}")
             sys.exit(1)
 
     # print out summary messages at the end
@@ -687,8 +1771,10 @@ def main():
         print(f"{Fore.YELLOW}Skipped {skipped} device(s)\nSkipped Hosts: "
                     f"{skipped_hosts}{Style.RESET_ALL}")
     if failure > 0:
-        print(f"{Fore.RED}Failed to connect to {failure} device(s)\nFailed Hosts: {failed_hosts}{Style.RESET_ALL}")
-    if not success and not skipped and not failure:
+        print(f"{Fore.RED}Failed to triage {failure} device(s)\nFailed Hosts: {failed_hosts}{Style.RESET_ALL}")
+    if timed_out > 0:
+        print(f"{Fore.RED}Timed out on {timed_out} device(s)\nTimed Out Hosts: {timed_out_hosts}{Style.RESET_ALL}")
+    if not success and not skipped and not failure and not timed_out:
         if limit:
             print(f"{Fore.RED}No Hosts/Groups matched limit '{limit}' in Inventory Path '{datacenter}'"
                         f"{Style.RESET_ALL}")
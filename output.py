@@ -0,0 +1,52 @@
+import io
+import threading
+from contextlib import contextmanager
+
+
+class HostOutput(object):
+  """
+  Stand-in for sys.stdout that can hold a thread's output in a buffer. Lets
+  concurrent hosts keep using print() and flush each host's output as one block
+  """
+
+  def __init__(self, stream):
+    self._stream = stream
+    self._local = threading.local()
+    self._lock = threading.Lock()
+
+  def _buffer(self):
+    return getattr(self._local, 'buffer', None)
+
+  def write(self, data):
+    buf = self._buffer()
+    if buf is None:
+      with self._lock:
+        return self._stream.write(data)
+    return buf.write(data)
+
+  def flush(self):
+    if self._buffer() is None:
+      self._stream.flush()
+
+  @contextmanager
+  def buffer(self):
+    """Hold this thread's output in the StringIO yielded instead of writing it out"""
+    self._local.buffer = io.StringIO()
+    try:
+      yield self._local.buffer
+    finally:
+      self._local.buffer = None
+
+  @contextmanager
+  def capture(self):
+    with self.buffer() as buf:
+      try:
+        yield
+      finally:
+        data = buf.getvalue()
+        with self._lock:
+          self._stream.write(data)
+          self._stream.flush()
+
+  def __getattr__(self, name):
+    return getattr(self._stream, name)
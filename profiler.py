@@ -0,0 +1,244 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from lxml import etree
+from replay import scp_get, ssh_read
+from rpcplan import StreamedReply
+
+
+# Number of hosts and calls listed in the slowest sections of the report
+SLOWEST = 10
+
+# Operation name used for the time spent opening the session, including any
+# facts gathered while connecting
+CONNECT = 'connect'
+
+
+class Profiler(object):
+  """
+  Times hosts, operations, RPCs and file transfers during a run. Only devices
+  created through device() are instrumented, so a run without a Profiler pays
+  nothing for it
+  """
+
+  def __init__(self):
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._hosts = {}
+    self._calls = []
+
+  def device(self, factory):
+    """Wrap a Device class or factory so every device it creates reports its calls"""
+    def create(*vargs, **kvargs):
+      dev = factory(*vargs, **kvargs)
+      self._instrument(dev)
+      return dev
+    return create
+
+  def _instrument(self, dev):
+    rpc_reply = dev._rpc_reply
+    dev_open = dev.open
+    get_file = getattr(dev, 'get_file', None) or partial(scp_get, dev)
+    read_file = getattr(dev, 'read_file', None) or partial(ssh_read, dev)
+
+    # Instance attributes shadow the Device methods, which is all PyEZ calls for
+    # RPCs, CLI commands and fact gathering
+    def timed_rpc_reply(rpc_cmd_e, *vargs, **kvargs):
+      with self._call('rpc', rpc_cmd_e.tag) as call:
+        reply = rpc_reply(rpc_cmd_e, *vargs, **kvargs)
+      # Sized once the call is timed, as serializing a large reply takes a while
+      if isinstance(reply, etree._Element):
+        call['bytes'] = len(etree.tostring(reply))
+      elif isinstance(reply, StreamedReply):
+        call['bytes'] = reply.size
+      return reply
+
+    def timed_open(*vargs, **kvargs):
+      with self.operation(CONNECT):
+        return dev_open(*vargs, **kvargs)
+
+    def timed_get_file(remote_path, local_path):
+      with self._call('file', remote_path) as call:
+        get_file(remote_path, local_path)
+        call['bytes'] = Path(local_path).stat().st_size
+
+    def timed_read_file(remote_path, offset=0, length=None):
+      # Only the time spent waiting on the next chunk counts, not the time the
+      # caller spends on each one
+      chunks = read_file(remote_path, offset, length)
+      call = self._new_call('file', remote_path)
+      try:
+        while True:
+          start = time.perf_counter()
+          try:
+            chunk = next(chunks, None)
+          finally:
+            call['seconds'] += time.perf_counter() - start
+          if chunk is None:
+            break
+          call['bytes'] += len(chunk)
+          yield chunk
+      except Exception:
+        call['error'] = True
+        raise
+      finally:
+        self._add_call(call)
+
+    dev._rpc_reply = timed_rpc_reply
+    dev.open = timed_open
+    dev.get_file = timed_get_file
+    dev.read_file = timed_read_file
+
+  @contextmanager
+  def host(self, hostname):
+    with self._lock:
+      record = self._hosts.setdefault(hostname, {'seconds': 0.0, 'operations': {}})
+    self._local.host = hostname
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      record['seconds'] += time.perf_counter() - start
+      self._local.host = None
+
+  @contextmanager
+  def operation(self, name):
+    host = getattr(self._local, 'host', None)
+    self._local.operation = name
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds = time.perf_counter() - start
+      self._local.operation = None
+      if host is not None:
+        operations = self._hosts[host]['operations']
+        operations[name] = operations.get(name, 0.0) + seconds
+
+  def _new_call(self, kind, name):
+    return {
+      'host': getattr(self._local, 'host', None),
+      'operation': getattr(self._local, 'operation', None),
+      'kind': kind,
+      'name': name,
+      'seconds': 0.0,
+      'bytes': 0,
+      'error': False,
+    }
+
+  def _add_call(self, call):
+    with self._lock:
+      self._calls.append(call)
+
+  @contextmanager
+  def _call(self, kind, name):
+    call = self._new_call(kind, name)
+    start = time.perf_counter()
+    try:
+      yield call
+    except Exception:
+      call['error'] = True
+      raise
+    finally:
+      call['seconds'] = time.perf_counter() - start
+      self._add_call(call)
+
+  def report(self):
+    """
+    Summarize the run per host, per operation and per RPC. local_seconds is the
+    time an operation spent outside of device calls, i.e. parsing and checks
+    """
+    with self._lock:
+      hosts = {name: dict(record, operations=dict(record['operations']))
+               for name, record in self._hosts.items()}
+      calls = list(self._calls)
+
+    for record in hosts.values():
+      record.update(calls=0, call_seconds=0.0, bytes=0, errors=0)
+    operations = {}
+    for record in hosts.values():
+      for name, seconds in record['operations'].items():
+        stats = operations.setdefault(name, {'hosts': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                             'call_seconds': 0.0})
+        stats['hosts'] += 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    rpcs = {}
+    for call in calls:
+      stats = rpcs.setdefault(call['name'], {'kind': call['kind'], 'calls': 0, 'errors': 0, 'seconds': 0.0,
+                                             'max_seconds': 0.0, 'bytes': 0})
+      stats['calls'] += 1
+      stats['errors'] += call['error']
+      stats['seconds'] += call['seconds']
+      stats['max_seconds'] = max(stats['max_seconds'], call['seconds'])
+      stats['bytes'] += call['bytes']
+      record = hosts.get(call['host'])
+      if record is not None:
+        record['calls'] += 1
+        record['call_seconds'] += call['seconds']
+        record['bytes'] += call['bytes']
+        record['errors'] += call['error']
+      if call['operation'] in operations:
+        operations[call['operation']]['call_seconds'] += call['seconds']
+
+    for stats in operations.values():
+      stats['mean_seconds'] = stats['seconds'] / stats['hosts']
+      stats['local_seconds'] = max(0.0, stats['seconds'] - stats['call_seconds'])
+    for stats in rpcs.values():
+      stats['mean_seconds'] = stats['seconds'] / stats['calls']
+
+    return {
+      'hosts': hosts,
+      'operations': operations,
+      'rpcs': dict(sorted(rpcs.items(), key=lambda item: item[1]['seconds'], reverse=True)),
+      'slowest_hosts': [{'host': name, 'seconds': record['seconds']} for name, record in
+                        sorted(hosts.items(), key=lambda item: item[1]['seconds'], reverse=True)[:SLOWEST]],
+      'slowest_calls': sorted(calls, key=lambda call: call['seconds'], reverse=True)[:SLOWEST],
+    }
+
+  def save(self, path, report=None):
+    with open(path, "w") as f:
+      json.dump(report or self.report(), f, indent=2)
+
+
+def _size(nbytes):
+  for unit in ('B', 'KB', 'MB'):
+    if nbytes < 1024:
+      return f"{nbytes:.0f}{unit}" if unit == 'B' else f"{nbytes:.1f}{unit}"
+    nbytes /= 1024
+  return f"{nbytes:.1f}GB"
+
+
+def format_report(report):
+  """Render a report() as plain text tables"""
+  lines = ["Operations:",
+           f"    {'operation':<12} {'hosts':>6} {'total s':>10} {'mean s':>9} {'max s':>9} {'device s':>10} "
+           f"{'local s':>9}"]
+  for name, stats in sorted(report['operations'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+    lines.append(f"    {name:<12} {stats['hosts']:>6} {stats['seconds']:>10.3f} {stats['mean_seconds']:>9.3f} "
+                 f"{stats['max_seconds']:>9.3f} {stats['call_seconds']:>10.3f} {stats['local_seconds']:>9.3f}")
+
+  lines += ["", "RPCs and file transfers:",
+            f"    {'name':<46} {'calls':>6} {'errors':>6} {'total s':>10} {'mean s':>9} {'max s':>9} "
+            f"{'received':>10}"]
+  for name, stats in report['rpcs'].items():
+    lines.append(f"    {name:<46} {stats['calls']:>6} {stats['errors']:>6} {stats['seconds']:>10.3f} "
+                 f"{stats['mean_seconds']:>9.3f} {stats['max_seconds']:>9.3f} {_size(stats['bytes']):>10}")
+
+  lines += ["", "Slowest hosts:"]
+  for entry in report['slowest_hosts']:
+    record = report['hosts'][entry['host']]
+    operations = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in record['operations'].items())
+    lines.append(f"    {entry['host']:<30} {entry['seconds']:>9.3f}s  {record['calls']} calls, "
+                 f"{_size(record['bytes'])} received ({operations})")
+
+  lines += ["", "Slowest calls:"]
+  for call in report['slowest_calls']:
+    error = " (error)" if call['error'] else ""
+    lines.append(f"    {call['seconds']:>9.3f}s  {call['host']}  {call['operation']}  {call['name']}  "
+                 f"{_size(call['bytes'])}{error}")
+  return "\n".join(lines)
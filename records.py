@@ -0,0 +1,108 @@
+import gzip
+import json
+import sys
+import threading
+import time
+
+
+# Severity of a record. Critical needs attention now (down, alarm, failure),
+# warning is worth a look (threshold reached, marginal optic) and info is context
+CRITICAL = 'critical'
+WARNING = 'warning'
+INFO = 'info'
+
+# Bytes of records held before they're written out
+BUFFER_SIZE = 1 << 16
+
+
+class RecordWriter(object):
+  """
+  Writes records as NDJSON, one JSON object per line, to a file or stdout. Lines
+  are buffered and written in BUFFER_SIZE chunks, optionally gzipped, so memory
+  stays the same however many records a run produces. Shared by every worker
+  thread
+  """
+
+  def __init__(self, path=None, compress=None, buffer_size=BUFFER_SIZE):
+    self.path = path
+    if path is None or path == '-':
+      # Not sys.stdout, which is stderr when the records have stdout to themselves
+      self._file = sys.__stdout__.buffer
+      self._owns_file = False
+    else:
+      self._file = open(path, 'wb')
+      self._owns_file = True
+    if compress is None:
+      compress = path is not None and path.endswith('.gz')
+    self._stream = gzip.GzipFile(fileobj=self._file, mode='wb') if compress else self._file
+    self._compress = compress
+    self._buffer_size = buffer_size
+    self._pending = []
+    self._pending_size = 0
+    self._lock = threading.Lock()
+
+  def write(self, record):
+    line = json.dumps(record, separators=(',', ':'), default=str).encode() + b"\n"
+    with self._lock:
+      self._pending.append(line)
+      self._pending_size += len(line)
+      if self._pending_size >= self._buffer_size:
+        self._write_pending()
+
+  def _write_pending(self):
+    if self._pending:
+      self._stream.write(b"".join(self._pending))
+      self._pending = []
+      self._pending_size = 0
+
+  def flush(self):
+    """Write out what is buffered so a reader sees every record so far"""
+    with self._lock:
+      self._write_pending()
+      # Flushing gzip ends a deflate block, which costs compression, so it is
+      # left to close()
+      if not self._compress:
+        self._stream.flush()
+
+  def close(self):
+    with self._lock:
+      self._write_pending()
+      if self._compress:
+        self._stream.close()
+      if self._owns_file:
+        self._file.close()
+      else:
+        self._file.flush()
+
+
+class RecordList(list):
+  """Collects records in memory instead of writing them, i.e. to send them back from the session agent"""
+
+  def write(self, record):
+    self.append(record)
+
+
+class HostRecords(object):
+  """
+  Records of one host handed to the operations. Every record gets a timestamp,
+  the host, the operation, what kind of record it is and its severity
+  """
+
+  __slots__ = ('writer', 'host')
+
+  def __init__(self, writer, host):
+    self.writer = writer
+    self.host = host
+
+  def __bool__(self):
+    return self.writer is not None
+
+  def emit(self, operation, record, severity, **fields):
+    if self.writer is None:
+      return
+    self.writer.write(dict(ts=round(time.time(), 3), host=self.host, operation=operation, record=record,
+                           severity=severity, **fields))
+
+
+# What the operations get when no records are wanted
+NO_RECORDS = HostRecords(None, None)
@@ -0,0 +1,294 @@
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+import paramiko
+from jnpr.junos import Device
+from jnpr.junos.utils.scp import SCP
+from lxml import etree
+from ncclient.operations.rpc import RPCError
+from rpcplan import FutureReply, StreamedReply
+
+
+# Hosts without their own fixture directory replay from this one, which lets a
+# single recording stand in for a whole synthetic fleet
+DEFAULT_FIXTURE = "default"
+
+LATENCY_FILE = "latency.json"
+
+# Optional static facts for fixtures that don't carry the fact gathering RPCs,
+# such as synthetic ones
+FACTS_FILE = "facts.json"
+
+NETCONF_NS = "urn:ietf:params:xml:ns:netconf:base:1.0"
+
+CHUNK_SIZE = 64 * 1024
+
+# Chunks of a file requested at once over SFTP. The next ones are only requested
+# once the reader has taken these, so at most this many chunks are buffered
+SFTP_READ_AHEAD = 16
+
+
+def _fixture_name(rpc_cmd_e):
+  digest = hashlib.sha1(etree.tostring(rpc_cmd_e)).hexdigest()[:16]
+  return f"{rpc_cmd_e.tag}-{digest}"
+
+
+def _read_chunks(f, offset=0, length=None):
+  f.seek(offset)
+  while length is None or length > 0:
+    chunk = f.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length))
+    if not chunk:
+      return
+    if length is not None:
+      length -= len(chunk)
+    yield chunk
+
+
+def load_latency(value):
+  """
+  Turn --replay-latency into {rpc: seconds}. value is either a number of seconds
+  used for every RPC or a JSON file of per-RPC seconds with an optional 'default'
+  """
+  if value is None:
+    return {}
+  try:
+    return {'default': float(value)}
+  except ValueError:
+    with open(value, "r") as f:
+      return {rpc: float(seconds) for rpc, seconds in json.load(f).items()}
+
+
+class RecordingDevice(Device):
+  """
+  Device that saves every RPC/CLI reply it receives under record_dir/<host>
+  along with the time each RPC took
+  """
+
+  def __init__(self, *vargs, record_dir, **kvargs):
+    super().__init__(*vargs, **kvargs)
+    self._fixture_dir = Path(record_dir) / self._hostname
+    self._fixture_dir.mkdir(parents=True, exist_ok=True)
+    self._latency = {}
+    self._lock = threading.Lock()
+
+  def _rpc_reply(self, rpc_cmd_e, ignore_warning=False, filter_xml=None):
+    name = _fixture_name(rpc_cmd_e)
+    start = time.perf_counter()
+    try:
+      reply = super()._rpc_reply(rpc_cmd_e, ignore_warning=ignore_warning, filter_xml=filter_xml)
+    except RPCError as err:
+      if err._raw is not None:
+        (self._fixture_dir / f"{name}.err").write_bytes(etree.tostring(err._raw))
+      raise
+    finally:
+      self._record_latency(rpc_cmd_e.tag, time.perf_counter() - start)
+    (self._fixture_dir / f"{name}.xml").write_bytes(etree.tostring(reply))
+    return reply
+
+  def _record_latency(self, rpc, seconds):
+    with self._lock:
+      self._latency[rpc] = max(seconds, self._latency.get(rpc, 0))
+      with open(self._fixture_dir / LATENCY_FILE, "w") as f:
+        json.dump(self._latency, f, indent=2)
+
+  def get_file(self, remote_path, local_path):
+    scp_get(self, remote_path, local_path)
+    dest = self._fixture_dir / "files" / remote_path.lstrip("/")
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(local_path, dest)
+
+  def read_file(self, remote_path, offset=0, length=None):
+    # The whole file is saved so it can be replayed from any offset
+    dest = self._fixture_dir / "files" / remote_path.lstrip("/")
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    pos = 0
+    with open(dest, "wb") as f:
+      for chunk in ssh_read(self, remote_path):
+        f.write(chunk)
+        start = max(offset - pos, 0)
+        end = len(chunk) if length is None else min(len(chunk), offset + length - pos)
+        pos += len(chunk)
+        if start < end:
+          yield chunk[start:end]
+
+
+class ReplayDevice(Device):
+  """
+  Device that answers RPC/CLI calls from a directory written by RecordingDevice
+  without opening a connection. latency maps RPC names (or 'default') to seconds
+  slept before each reply. RPCs are answered one at a time in the order they were
+  sent, like on a real session, and one slower than the session timeout times
+  out
+  """
+
+  def __init__(self, *vargs, replay_dir, latency=None, **kvargs):
+    super().__init__(*vargs, **kvargs)
+    self._fixture_dir = Path(replay_dir) / self._hostname
+    if not self._fixture_dir.is_dir():
+      self._fixture_dir = Path(replay_dir) / DEFAULT_FIXTURE
+    self._latency = latency or {}
+    self._answers = None
+    facts = self._fixture_dir / FACTS_FILE
+    if facts.exists():
+      with open(facts, "r") as f:
+        self.facts = json.load(f)
+
+  def open(self, *vargs, **kvargs):
+    if not self._fixture_dir.is_dir():
+      raise FileNotFoundError(f"No replay fixtures for {self._hostname} in {self._fixture_dir.parent}")
+    # Just enough of an ncclient session for Device and the tables to work with
+    self._conn = SimpleNamespace(connected=True, timeout=30, close_session=lambda: None,
+                                 _device_handler=SimpleNamespace(transform_reply=None))
+    self.connected = True
+    self._answers = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"replay-{self._hostname}")
+    if not isinstance(self.facts, dict) and kvargs.get("gather_facts", self._gather_facts):
+      self.facts_refresh()
+    return self
+
+  def close(self):
+    super().close()
+    if self._answers is not None:
+      self._answers.shutdown(wait=False)
+
+  def _rpc_reply(self, rpc_cmd_e, ignore_warning=False, filter_xml=None):
+    return self._send_rpc(rpc_cmd_e).result(self._conn.timeout)
+
+  def _send_rpc(self, rpc_cmd_e):
+    return FutureReply(self._answers.submit(self._answer, rpc_cmd_e), self._load_reply, self._stream_reply)
+
+  def _answer(self, rpc_cmd_e):
+    """Path of the reply to rpc_cmd_e once its latency has passed"""
+    delay = self._latency.get(rpc_cmd_e.tag, self._latency.get('default', 0))
+    if delay:
+      time.sleep(delay)
+    name = _fixture_name(rpc_cmd_e)
+    error = self._fixture_dir / f"{name}.err"
+    if error.exists():
+      raise RPCError(etree.fromstring(error.read_bytes()))
+    reply = self._fixture_dir / f"{name}.xml"
+    if not reply.exists():
+      raise RPCError(etree.fromstring(
+        f"<rpc-error xmlns='{NETCONF_NS}'><error-severity>error</error-severity>"
+        f"<error-message>no replay fixture for {rpc_cmd_e.tag}</error-message></rpc-error>"))
+    return reply
+
+  def _load_reply(self, path):
+    return etree.fromstring(path.read_bytes(), etree.XMLParser(huge_tree=True))
+
+  def _stream_reply(self, path):
+    def chunks():
+      with open(path, "rb") as f:
+        yield from _read_chunks(f)
+    return StreamedReply(path.stat().st_size, chunks())
+
+  def get_file(self, remote_path, local_path):
+    shutil.copyfile(self._fixture_dir / "files" / remote_path.lstrip("/"), local_path)
+
+  def read_file(self, remote_path, offset=0, length=None):
+    with open(self._fixture_dir / "files" / remote_path.lstrip("/"), "rb") as f:
+      yield from _read_chunks(f, offset, length)
+
+
+def scp_get(dev, remote_path, local_path, timeout=None):
+  scpargs = {'socket_timeout': timeout} if timeout else {}
+  with SCP(dev, progress=True, **scpargs) as scp:
+    scp.get(remote_path, local_path=local_path)
+
+
+def ssh_read(dev, remote_path, offset=0, length=None, timeout=None):
+  """
+  Yield the bytes of remote_path from offset in chunks as they arrive over SFTP
+  on the device's own SSH session. Junos releases that ship with the SFTP server
+  disabled fall back to an SCP copy into a temporary file, which transfers the
+  whole file on every read however little of it is asked for, unless the read
+  is in a local_copies() block. With a timeout, a read that waits longer than
+  timeout seconds raises socket.timeout
+  """
+  try:
+    sftp = paramiko.SFTPClient.from_transport(dev._conn._session._transport)
+  except (paramiko.SSHException, EOFError):
+    sftp = None
+  if sftp is None:
+    copies = getattr(dev, '_scp_copies', None)
+    if copies is not None:
+      tmp, copied = copies
+      local_path = copied.get(remote_path)
+      if local_path is None:
+        local_path = str(Path(tmp) / f"{len(copied)}-{Path(remote_path).name}")
+        scp_get(dev, remote_path, local_path, timeout=timeout)
+        copied[remote_path] = local_path
+      with open(local_path, "rb") as f:
+        yield from _read_chunks(f, offset, length)
+      return
+    with tempfile.TemporaryDirectory(prefix="triage-") as tmp:
+      local_path = str(Path(tmp) / Path(remote_path).name)
+      scp_get(dev, remote_path, local_path, timeout=timeout)
+      with open(local_path, "rb") as f:
+        yield from _read_chunks(f, offset, length)
+    return
+  if timeout:
+    sftp.get_channel().settimeout(timeout)
+  with sftp, sftp.open(remote_path, "rb") as f:
+    size = f.stat().st_size
+    end = size if length is None else min(size, offset + length)
+    if offset >= end:
+      return
+    # Not prefetch(), which keeps reading up to end however slowly the chunks
+    # are taken and would buffer the whole file
+    while offset < end:
+      window = [(start, min(CHUNK_SIZE, end - start))
+                for start in range(offset, min(end, offset + SFTP_READ_AHEAD * CHUNK_SIZE), CHUNK_SIZE)]
+      for chunk in f.readv(window):
+        if not chunk:
+          # Truncated while being read
+          return
+        yield chunk
+      offset = window[-1][0] + window[-1][1]
+
+
+@contextmanager
+def local_copies(dev):
+  """
+  Within the block, a file ssh_read() has to fetch over SCP is copied once and
+  later reads of it come from that copy, which doesn't see what the device
+  writes to the file afterwards
+  """
+  if getattr(dev, '_scp_copies', None) is not None:
+    yield
+    return
+  with tempfile.TemporaryDirectory(prefix="triage-") as tmp:
+    dev._scp_copies = (tmp, {})
+    try:
+      yield
+    finally:
+      dev._scp_copies = None
+
+
+def read_file(dev, remote_path, offset=0, length=None):
+  """
+  Yield the bytes of remote_path from offset, up to length bytes, without
+  saving the file locally. Devices with their own read_file, such as
+  recording/replaying or profiled ones, handle the read themselves
+  """
+  dev_read_file = getattr(dev, 'read_file', None)
+  if dev_read_file is not None:
+    return dev_read_file(remote_path, offset, length)
+  return ssh_read(dev, remote_path, offset, length)
+
+
+def get_file(dev, remote_path, local_path):
+  """
+  Copy remote_path from the device. Devices with their own get_file, such as
+  recording/replaying or profiled ones, handle the copy themselves
+  """
+  dev_get_file = getattr(dev, 'get_file', None)
+  if dev_get_file is not None:
+    return dev_get_file(remote_path, local_path)
+  scp_get(dev, remote_path, local_path)
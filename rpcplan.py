@@ -0,0 +1,272 @@
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+# Characters of an unparsed reply handed to the parser at a time
+CHUNK_SIZE = 64 * 1024
+
+
+def rpc_request(rpc, **args):
+  """The RPC element dev.rpc sends, i.e. rpc_request('get-interface-information', extensive=True)"""
+  from lxml import etree
+
+  request = etree.Element(rpc.replace('_', '-'))
+  for name, values in args.items():
+    for value in values if isinstance(values, (list, tuple)) else [values]:
+      if value is False:
+        continue
+      arg = etree.SubElement(request, name.replace('_', '-'))
+      if not isinstance(value, bool):
+        arg.text = value
+  return request
+
+
+def table_request(table_cls, **args):
+  """The RPC element table_cls(dev).get(**args) sends"""
+  return rpc_request(table_cls.GET_RPC, **dict(table_cls.GET_ARGS, **args))
+
+
+def request_key(rpc_cmd_e):
+  # Junos doesn't mind the order of the arguments
+  return (rpc_cmd_e.tag, tuple(sorted(rpc_cmd_e.attrib.items())),
+          tuple(sorted((arg.tag, (arg.text or '').strip()) for arg in rpc_cmd_e)))
+
+
+class StreamedReply(object):
+  """Unparsed reply of an RPC, iterated as chunks of XML. size is its length"""
+
+  __slots__ = ('size', '_chunks')
+
+  def __init__(self, size, chunks):
+    self.size = size
+    self._chunks = chunks
+
+  def __iter__(self):
+    return iter(self._chunks)
+
+
+def _text_chunks(raw):
+  for start in range(0, len(raw), CHUNK_SIZE):
+    yield raw[start:start + CHUNK_SIZE].encode()
+
+
+class FutureReply(object):
+  """
+  Reply of a sent RPC from a Future of what parse() turns into the reply, parsed
+  anew for each caller. stream() turns it into a StreamedReply
+  """
+
+  def __init__(self, future, parse, stream=None):
+    self._future = future
+    self._parse = parse
+    self._stream = stream
+
+  def done(self):
+    return self._future.done()
+
+  def _raw(self, timeout):
+    from ncclient.operations.errors import TimeoutExpiredError
+
+    try:
+      return self._future.result(timeout)
+    except FutureTimeoutError:
+      raise TimeoutExpiredError("ncclient timed out while waiting for an rpc reply.")
+
+  def result(self, timeout=None):
+    return self._parse(self._raw(timeout))
+
+  def stream(self, timeout=None):
+    return self._stream(self._raw(timeout))
+
+
+class _NcclientReply(object):
+  """Reply of an RPC sent on the ncclient session of a PyEZ device without waiting for it"""
+
+  def __init__(self, dev, rpc_cmd_e):
+    from ncclient.operations.retrieve import Dispatch
+
+    self._conn = conn = dev._conn
+    self._rpc = Dispatch(conn._session, device_handler=conn._device_handler, async_mode=True,
+                         timeout=conn.timeout, raise_mode=conn.raise_mode,
+                         huge_tree=conn.huge_tree).request(rpc_cmd_e)
+    self._taken = False
+
+  def done(self):
+    return self._rpc.event.is_set()
+
+  def _wait(self, timeout):
+    from ncclient.operations.errors import TimeoutExpiredError
+
+    if not self._rpc.event.wait(timeout):
+      raise TimeoutExpiredError("ncclient timed out while waiting for an rpc reply.")
+    if self._rpc.error:
+      raise self._rpc.error
+    return self._rpc.reply
+
+  def result(self, timeout=None):
+    # What ncclient does once a synchronous RPC's reply is in, followed by PyEZ's
+    # Device._rpc_reply
+    from ncclient.operations.rpc import RaiseMode, RPCError
+    from ncclient.xml_ import NCElement, to_ele
+
+    conn = self._conn
+    handler = conn._device_handler
+    reply = self._wait(timeout)
+    if self._taken:
+      # The transform edits the parsed reply in place, so every caller after the
+      # first gets a copy of its own
+      reply = type(reply)(reply._raw, huge_tree=conn.huge_tree)
+      if hasattr(reply, 'set_parsing_error_transform'):
+        reply.set_parsing_error_transform(handler.reply_parsing_error_transform(type(reply)))
+    self._taken = True
+    reply.parse()
+    if reply.error is not None and not handler.is_rpc_error_exempt(reply.error.message):
+      if conn.raise_mode == RaiseMode.ALL or (conn.raise_mode == RaiseMode.ERRORS and
+                                              reply.error.severity == "error"):
+        if len(reply.errors) > 1:
+          raise RPCError(to_ele(reply._raw), errs=reply.errors)
+        raise reply.error
+    return NCElement(reply, handler.transform_reply(), huge_tree=conn.huge_tree)._NCElement__doc
+
+  def stream(self, timeout=None):
+    # ncclient only parses the reply when asked to, so the text the session
+    # received is all there is of it until then
+    raw = self._wait(timeout)._raw
+    return StreamedReply(len(raw), _text_chunks(raw))
+
+
+def _sender(dev):
+  """What sends an RPC on the session of dev without waiting for its reply, None if nothing can"""
+  from jnpr.junos import Device
+
+  owner = next(cls for cls in type(dev).__mro__ if '_rpc_reply' in vars(cls))
+  if '_send_rpc' in vars(owner):
+    return dev._send_rpc
+  if owner is Device:
+    return lambda rpc_cmd_e: _NcclientReply(dev, rpc_cmd_e)
+  return None
+
+
+def send_rpc(dev, rpc_cmd_e):
+  """
+  Send rpc_cmd_e on the session of dev without waiting for its reply. Returns
+  what result(timeout) and stream(timeout) wait for the reply on, or None when
+  dev can only answer one RPC at a time, e.g. a RecordingDevice
+  """
+  sender = _sender(dev)
+  return sender(rpc_cmd_e) if sender is not None else None
+
+
+def stream_rpc(dev, rpc_cmd_e):
+  """
+  The reply to rpc_cmd_e as a StreamedReply, so it can be parsed as it's read
+  instead of all at once. None when dev can only hand out parsed replies, in
+  which case nothing is sent. Only devices created through planned_device() can
+  stream
+  """
+  from jnpr.junos.exception import RpcError, RpcTimeoutError
+  from ncclient.operations.errors import TimeoutExpiredError
+  from ncclient.operations.rpc import RPCError
+
+  if not hasattr(dev, '_rpc_plan') or _sender(dev) is None:
+    return None
+  # Raised like Device.execute would, as nothing else sees this RPC
+  try:
+    return dev._rpc_reply(rpc_cmd_e, stream=True)
+  except TimeoutExpiredError:
+    raise RpcTimeoutError(dev, rpc_cmd_e.tag, dev.timeout)
+  except RPCError as err:
+    raise RpcError(cmd=rpc_cmd_e, rsp=getattr(err, 'xml', None), errs=err)
+
+
+def planned_device(factory):
+  """Wrap a Device class or factory so an RpcPlan can answer the RPCs of the devices it creates"""
+  def create(*vargs, **kvargs):
+    dev = factory(*vargs, **kvargs)
+    rpc_reply = dev._rpc_reply
+
+    # Shadows Device._rpc_reply before anything else does, so the profiler and
+    # deadlines see each operation wait for its reply
+    def planned_rpc_reply(rpc_cmd_e, ignore_warning=False, filter_xml=None, stream=False):
+      plan = dev._rpc_plan
+      if stream:
+        pending = plan.pending(rpc_cmd_e) if plan is not None else None
+        return (pending or send_rpc(dev, rpc_cmd_e)).stream(dev._conn.timeout)
+      if plan is None or ignore_warning or filter_xml is not None:
+        return rpc_reply(rpc_cmd_e, ignore_warning=ignore_warning, filter_xml=filter_xml)
+      return plan.reply(rpc_cmd_e, rpc_reply)
+
+    dev._rpc_plan = None
+    dev._rpc_reply = planned_rpc_reply
+    return dev
+  return create
+
+
+class RpcPlan(object):
+  """
+  Context manager sending the RPCs the operations are going to make back to
+  back as soon as the session is open, instead of one at a time as each
+  operation gets to them. The device works through them while the operations
+  parse and print the replies already in, and every RPC of the operations picks
+  up its reply from the plan. Identical requests are sent once.
+
+  requests are RPC elements, or (element, then) where then(reply) returns the
+  requests that depend on that reply, sent as soon as it's in. Only devices
+  created through planned_device() are planned for
+  """
+
+  def __init__(self, dev, requests):
+    self._dev = dev
+    self._requests = requests
+    self._sent = {}
+    self._then = []
+
+  def __enter__(self):
+    if hasattr(self._dev, '_rpc_plan'):
+      self._send(self._requests)
+      self._dev._rpc_plan = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if getattr(self._dev, '_rpc_plan', None) is self:
+      self._dev._rpc_plan = None
+
+  def _send(self, requests):
+    for request in requests:
+      request, then = request if isinstance(request, tuple) else (request, None)
+      key = request_key(request)
+      if key not in self._sent:
+        try:
+          pending = send_rpc(self._dev, request)
+        except Exception:
+          pending = None
+        if pending is None:
+          # Whatever wasn't sent is requested by the operations themselves
+          return
+        self._sent[key] = pending
+      if then is not None:
+        self._then.append((self._sent[key], then))
+
+  def _send_dependent(self):
+    for entry in [entry for entry in self._then if entry[0].done()]:
+      self._then.remove(entry)
+      pending, then = entry
+      try:
+        requests = then(pending.result(0))
+      except Exception:
+        # The operation gets the same error when it asks for the reply
+        continue
+      self._send(requests)
+
+  def pending(self, rpc_cmd_e):
+    """What the reply to rpc_cmd_e is waited for on when it was sent ahead, else None"""
+    self._send_dependent()
+    return self._sent.get(request_key(rpc_cmd_e))
+
+  def reply(self, rpc_cmd_e, rpc_reply):
+    """The reply to rpc_cmd_e, from the plan when it was sent ahead, else from rpc_reply"""
+    pending = self.pending(rpc_cmd_e)
+    if pending is None:
+      return rpc_reply(rpc_cmd_e)
+    reply = pending.result(self._dev._conn.timeout)
+    self._send_dependent()
+    return reply
@@ -0,0 +1,79 @@
+import json
+import operator
+from exceptions import InvalidThreshold
+
+
+OPERATORS = {
+  '<': operator.lt,
+  '<=': operator.le,
+  '>': operator.gt,
+  '>=': operator.ge,
+  '==': operator.eq,
+  '!=': operator.ne,
+}
+
+
+# Rate thresholds are written as '<operator> <number>/<unit>' i.e. '> 5/min'
+RATE_UNITS = {
+  's': 1,
+  'min': 60,
+  'h': 3600,
+}
+
+
+def _to_number(val):
+  try:
+    return int(val)
+  except ValueError:
+    return float(val)
+
+
+class Threshold(object):
+  __slots__ = ('counter', 'text', 'compare', 'value', 'unit', 'per')
+
+  def __init__(self, counter, text):
+    self.counter = counter
+    self.text = text
+    self.unit = None
+    self.per = None
+    try:
+      oper, val = str(text).split()
+      self.compare = OPERATORS[oper]
+      if '/' in val:
+        val, self.unit = val.split('/')
+        self.per = RATE_UNITS[self.unit]
+      self.value = _to_number(val)
+    except (KeyError, ValueError):
+      raise InvalidThreshold(counter, f"'{text}' is not '<operator> <number>' or '<operator> <number>/<unit>'")
+
+  @property
+  def is_rate(self):
+    return self.per is not None
+
+  def rate(self, increase, seconds):
+    """Convert an increase over seconds into this threshold's unit"""
+    return increase / seconds * self.per
+
+  def reached(self, actual):
+    return self.compare(actual, self.value)
+
+
+def load_thresholds(path="thresholds.json", counters=None):
+  """
+  Parse thresholds.json once into {group: [Threshold, ...]}. When counters maps
+  group names to the counters available for that group, unknown groups and
+  counters are rejected so a typo fails at startup rather than being ignored
+  """
+  with open(path, "r") as f:
+    json_thresholds = json.load(f)
+
+  thresholds = {}
+  for group, group_thresholds in json_thresholds.items():
+    if counters is not None and group not in counters:
+      raise InvalidThreshold(group, "unknown group")
+    thresholds[group] = []
+    for counter, text in group_thresholds.items():
+      if counters is not None and counter not in counters[group]:
+        raise InvalidThreshold(counter, f"unknown counter for group '{group}'")
+      thresholds[group].append(Threshold(counter, text))
+  return thresholds
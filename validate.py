@@ -2,8 +2,6 @@ import re
 import sys
 from colorama import Fore, Style
 from exceptions import InvalidInput
-from netaddr import IPAddress, IPNetwork
-from netaddr.core import AddrFormatError
 from getpass import getpass
 from retrying import retry
 
@@ -94,6 +92,9 @@ def validate_choice(prompt, input_min=None, input_max=None, cli_input=None, defa
 
 @retry(stop_max_attempt_number=5, retry_on_exception=_retry_if_invalid_input)
 def validate_ip_address(prompt, input_min=None, input_max=None, cli_input=None, default=None, choices=None):
+  from netaddr import IPAddress
+  from netaddr.core import AddrFormatError
+
   prompt = _update_prompt(prompt, default)
   user_input = _check_input(prompt, cli_input, default)
   if len(user_input.split('.')) != 4:
@@ -109,6 +110,9 @@ def validate_ip_address(prompt, input_min=None, input_max=None, cli_input=None,
 
 @retry(stop_max_attempt_number=5, retry_on_exception=_retry_if_invalid_input)
 def validate_ip_network(prompt, input_min=None, input_max=None, cli_input=None, default=None, choices=None):
+  from netaddr import IPNetwork
+  from netaddr.core import AddrFormatError
+
   prompt = _update_prompt(prompt, default)
   user_input = _check_input(prompt, cli_input, default)
   if len(user_input.split('.')) != 4 or '/' not in user_input: